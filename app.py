@@ -6,14 +6,17 @@ import json
 import httplib2
 import os
 import bottle
-import sqlite3
 import time 
-from spellchecker import SpellChecker
 import re
-spell = SpellChecker()
+import tempfile
+from query import QueryEngine, MAX_RESULTS, RESULTS_PER_PAGE
+from calculator import calculate
+from prefork import serve
 
-db_conn = sqlite3.connect("crawler_data.db")
-db_conn.row_factory = sqlite3.Row
+# searches the index the crawler last published, see snapshots.py; until it
+# has published one, its database is searched directly. With SERVE_MAPPED=1
+# published indexes are served from a memory-mapped file, see serving.py
+engine = QueryEngine("index", fallback="crawler_data.db", mapped=os.environ.get("SERVE_MAPPED") == "1")
 
 
 with open("oauthSecrets.json") as f:
@@ -23,12 +26,23 @@ CLIENT_SECRET = secrets["web"]["client_secret"]
 
 HISTORY_FILE = "user_search_history.json"
 
+# with SERVE_WORKERS=n the frontend is served by n worker processes with
+# debug mode off, see prefork.py
+WORKERS = int(os.environ.get("SERVE_WORKERS", "0"))
+
 history = {}
 session_opts = {
     'session.type': 'memory',
     'session.cookie_expires': 300,
     'session.auto': True
 }
+if WORKERS > 1:
+    # workers do not share memory, so sessions are kept in files
+    session_opts.update({
+        'session.type': 'file',
+        'session.data_dir': './sessions/data',
+        'session.lock_dir': './sessions/lock',
+    })
 app = SessionMiddleware(bottle.app(), session_opts)
 
 def load_history():
@@ -40,8 +54,12 @@ def load_history():
 def save_history(user_email, search_history):
     all_history = load_history()
     all_history[user_email] = search_history
-    with open(HISTORY_FILE, 'w') as f:
+    # replaced whole, so other workers never read a half-written file; each
+    # save has a file of its own, as the threads of a worker share its pid
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(HISTORY_FILE)),
+                                     prefix=os.path.basename(HISTORY_FILE) + '.', delete=False) as f:
         json.dump(all_history, f)
+    os.replace(f.name, HISTORY_FILE)
 
 def process_query(query):
     words = query.lower().split()
@@ -124,122 +142,59 @@ def logout():
     session.delete() 
     redirect('/')
     
-def is_math_expression(query):
-    """Check if the query is a valid math expression, excluding single numbers."""
-    try:
-        result = eval(query)
-        if isinstance(result, (int, float)) and query.isdigit():
-            return False
-        return True
-    except (SyntaxError, NameError, ZeroDivisionError):
-        return False
-    
 @route('/results')
 def results():
     session = request.environ.get('beaker.session')
     query = request.query.keywords
     page = int(request.query.page or 1) 
+    # with mode=and only pages with every word match, see conjunctive.py
+    mode = request.query.mode
 
     if not query:
         redirect('/')
 
 
-    math_result = None
-
-    if is_math_expression(query):
-        try:
-            math_result = eval(query)
-            return template(
-                'templates/results',
-                query=query,
-                math_result=math_result,
-                results=[],
-                total_results=0,
-                current_page=page,
-                total_pages=0,
-                user_email=session.get('user_email'),
-                processing_time=0,
-                corrections_made=False,
-                corrected_query=None
-            )
-        except Exception as e:
-            math_result = None
-
-
-    corrected_query = ' '.join(spell.correction(word) for word in query.split())
+    # arithmetic is answered rather than searched for, see calculator.py
+    math_result = calculate(query)
+
+    if math_result is not None:
+        return template(
+            'templates/results',
+            query=query,
+            mode=mode,
+            math_result=math_result,
+            results=[],
+            total_results=0,
+            current_page=page,
+            total_pages=0,
+            user_email=session.get('user_email'),
+            processing_time=0,
+            corrections_made=False,
+            corrected_query=None
+        )
+
+
+    # corrected against the words of the index, see spelling.py
+    corrected_query = engine.correction(query)
     corrections_made = corrected_query != query
 
 
-    if session.get('last_query') == query:
-        start_time = time.time()
-        print("Using cached results")
-        all_results = session.get('cached_results', [])
-        processing_time = time.time() - start_time 
-    else:
-        print("Fetching new results")
-        start_time = time.time() 
-        keywords = [word.lower() for word in query.split()]
-        cur = db_conn.cursor()
-
-    
-        doc_scores = {}
-        for word in keywords:
-            cur.execute("SELECT id FROM Lexicon WHERE word = ?", (word,))
-            word_id_row = cur.fetchone()
-            if not word_id_row:
-                continue 
-
-            word_id = word_id_row['id']
-            cur.execute("SELECT doc_id FROM InvertedIndex WHERE word_id = ?", (word_id,))
-            doc_ids = [row['doc_id'] for row in cur.fetchall()]
-
-            for doc_id in doc_ids:
-                cur.execute("SELECT score FROM PageRank WHERE doc_id = ?", (doc_id,))
-                score_row = cur.fetchone()
-                score = float(score_row['score']) if score_row else 0
-
-                if doc_id in doc_scores:
-                    doc_scores[doc_id] += score
-                else:
-                    doc_scores[doc_id] = score
-
-    
-        sorted_doc_scores = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
+    # results are cached for every user, see query.py; urls and titles are
+    # looked up for the page being shown
+    start_time = time.time() 
+    total_results, hits = engine.search(query, conjunctive=mode == "and")
+    processing_time = time.time() - start_time 
 
-    
-        all_results = []
-        for doc_id, score in sorted_doc_scores:
-            cur.execute("SELECT url, title FROM DocumentIndex WHERE id = ?", (doc_id,))
-            doc_row = cur.fetchone()
-            if doc_row:
-                all_results.append({
-                    'url': doc_row['url'],
-                    'title': doc_row['title'],
-                    'score': score
-                })
-
-        processing_time = time.time() - start_time 
 
-    
-        session['last_query'] = query
-        session['cached_results'] = all_results
-        session['processing_time'] = processing_time
-        session.save()
-
-
-    results_per_page = 10
-    total_results = len(all_results)
-    total_pages = (total_results + results_per_page - 1) // results_per_page
-    start_index = (page - 1) * results_per_page
-    end_index = start_index + results_per_page
-    results = [
-        (result['url'], result['title'], result['score'])
-        for result in all_results[start_index:end_index]
-    ]
+    # every match is counted, but only the best MAX_RESULTS are kept to page
+    # through
+    total_pages = (len(hits) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE
+    results = engine.page(hits, page)
 
     return template(
         'templates/results',
         query=query,
+        mode=mode,
         corrected_query=corrected_query,
         corrections_made=corrections_made,
         math_result=math_result, 
@@ -252,6 +207,33 @@ def results():
     )
 
 
+@route('/api/search')
+def api_search():
+    """A page of results for machine clients, as compact JSON: the query is
+    q, k results per page, mode=and for conjunctive queries. Searches with
+    the same engine as /results, without templates, spelling correction or
+    sessions, see QueryEngine.search_page."""
+    bottle.response.content_type = 'application/json'
+    query = request.query.q
+    try:
+        page = int(request.query.page or 1)
+        k = int(request.query.k or RESULTS_PER_PAGE)
+    except ValueError:
+        page = k = 0
+    if not query.strip() or page < 1 or not 0 < k <= MAX_RESULTS:
+        bottle.response.status = 400
+        return json.dumps({"error": "q is required, page must be at least 1 and k between 1 and %d" % MAX_RESULTS},
+                          separators=(',', ':'))
+    found = engine.search_page(query, page, k, conjunctive=request.query.mode == 'and')
+    return json.dumps(found, separators=(',', ':'))
+
+
+@route('/stats')
+def stats():
+    """How well the result cache is doing, as JSON."""
+    return engine.cache.stats()
+
+
 @error(404)
 def error404(error):
     return template(
@@ -270,5 +252,8 @@ def error404(error):
 
 
 if __name__ == "__main__":
-    run(app=app, host='0.0.0.0', port=8082, debug=True)
+    if WORKERS:
+        serve(app, host='0.0.0.0', port=8082, workers=WORKERS)
+    else:
+        run(app=app, host='0.0.0.0', port=8082, debug=True)
     # run(app=app, host='localhost', port=8082, debug=True)
@@ -0,0 +1,107 @@
+"""Answering arithmetic queries, such as 2 * (3 + 4), without eval.
+
+eval runs any Python a user types in, and even plain arithmetic can take
+the server down: 9**9**9 has hundreds of millions of digits and takes
+minutes to compute. calculate instead parses the query with ast and walks
+the tree itself, allowing only numbers, + - * / // % ** and parentheses. It
+refuses anything that would grow too large before computing it: exponents
+above MAX_EXPONENT, and integers of more than MAX_BITS bits. Expressions
+are also capped at MAX_LENGTH characters and MAX_STEPS nodes. Every step is
+then cheap, so an expression costs microseconds at most.
+
+Queries containing anything but digits, operators, parentheses, dots and
+spaces are not parsed at all, so keyword queries cost a regular expression
+match."""
+import ast
+import operator
+import re
+
+MAX_LENGTH = 200
+MAX_STEPS = 100
+MAX_EXPONENT = 1000
+MAX_BITS = 4096
+
+# what a query must look like to be parsed: an operator between numbers
+PATTERN = re.compile(r"[\d.\s()+\-*/%]*\d[\d.\s()]*[+\-*/%][\d.\s()+\-*/%]*")
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+class CalculatorError(ValueError):
+    """The expression is not arithmetic calculate will compute."""
+
+
+def _bits(value):
+    return value.bit_length() if isinstance(value, int) else 0
+
+
+def _check_size(op, left, right):
+    """Refuse `left` op `right` if it would take long to compute."""
+    if op is ast.Pow:
+        if abs(right) > MAX_EXPONENT:
+            raise CalculatorError("exponent too large")
+        if isinstance(right, int) and _bits(left) * right > MAX_BITS:
+            raise CalculatorError("result too large")
+    elif op is ast.Mult and _bits(left) + _bits(right) > MAX_BITS:
+        raise CalculatorError("result too large")
+
+
+def _evaluate(node, steps):
+    steps.append(node)
+    if len(steps) > MAX_STEPS:
+        raise CalculatorError("expression too long")
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, steps)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+        return OPERATORS[type(node.op)](_evaluate(node.operand, steps))
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        left = _evaluate(node.left, steps)
+        right = _evaluate(node.right, steps)
+        _check_size(type(node.op), left, right)
+        value = OPERATORS[type(node.op)](left, right)
+        # such as a negative number to a fractional power
+        if isinstance(value, complex):
+            raise CalculatorError("not a real number")
+        return value
+    raise CalculatorError("not arithmetic")
+
+
+def looks_like_math(query):
+    """Whether `query` could be arithmetic, which is cheap to check."""
+    return len(query) <= MAX_LENGTH and PATTERN.fullmatch(query) is not None
+
+
+def evaluate(expression):
+    """The value of the arithmetic `expression`. Raises CalculatorError if it
+    is not arithmetic, or too costly, and ArithmeticError if it cannot be
+    computed, such as a division by zero."""
+    if len(expression) > MAX_LENGTH:
+        raise CalculatorError("expression too long")
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except (SyntaxError, ValueError):
+        raise CalculatorError("not arithmetic")
+    return _evaluate(tree, [])
+
+
+def calculate(query):
+    """The value of `query` if it is arithmetic, or None if it is a search,
+    such as a single number, or cannot be computed."""
+    if not looks_like_math(query):
+        return None
+    try:
+        return evaluate(query)
+    except (CalculatorError, ArithmeticError):
+        return None
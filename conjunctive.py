@@ -0,0 +1,68 @@
+"""Conjunctive (AND) queries.
+
+A query is searched as an OR of its words by default, which reads the
+whole posting list of every word. In a conjunctive query, documents must
+match every one of its groups: a single word, or words joined by OR, such
+as "cheap (flights OR trains)" written as "cheap flights OR trains". They
+score as in any other query, their PageRank once for every query word they
+contain.
+
+Groups are intersected rarest first, ordered by the document frequency the
+index keeps for every word (the doc_count of its Postings row, or the
+length of its list in a serving file). The matches so far are always the
+shorter side, so each intersection looks every one of them up in the next
+list by binary search (numpy's searchsorted, one galloping pass over the
+longer list) instead of walking that list. Its cost grows with the rarest
+list, not the longest one, and as soon as nothing matches anymore the
+remaining lists are not read at all."""
+import numpy as np
+from topk import doc_ranks, top_k
+
+
+def contains(doc_ids, found):
+    """Which of the sorted `doc_ids` are in the sorted array `found`."""
+    if not len(found):
+        return np.zeros(len(doc_ids), dtype=bool)
+    # in the type of `found`, which numpy would otherwise copy to convert
+    at = np.searchsorted(found, doc_ids.astype(found.dtype))
+    return found[np.minimum(at, len(found) - 1)] == doc_ids
+
+
+def intersect(doc_ids, found):
+    """The ids in both sorted arrays, looking up the shorter in the longer."""
+    if len(doc_ids) > len(found):
+        doc_ids, found = found, doc_ids
+    return doc_ids[contains(doc_ids, found)]
+
+
+def search_groups(groups, k, postings, frequencies, ranks):
+    """The `k` best documents matching every one of `groups`, lists of word
+    ids, as (doc_id, score) pairs with the best first, and how many documents
+    matched in all. `postings` returns the sorted document ids of a word and
+    `frequencies` the number of documents of each of a list of words, so that
+    groups are read rarest first. Also returns how many postings were read."""
+    words = [word for group in groups for word in group]
+    if not groups or not all(groups):
+        return 0, [], 0
+    distinct = sorted(set(words))
+    frequency = dict(zip(distinct, frequencies(distinct)))
+
+    read = {}
+    matches = None
+    for group in sorted(groups, key=lambda group: sum(frequency[word] for word in set(group))):
+        for word in set(group):
+            if word not in read:
+                read[word] = postings(word)
+        found = [read[word] for word in set(group)]
+        found = found[0] if len(found) == 1 else np.unique(np.concatenate(found))
+        matches = found if matches is None else intersect(matches, found)
+        if not len(matches):
+            break
+
+    matches = matches.astype(np.int64)
+    counts = np.zeros(len(matches), dtype=np.int64)
+    if len(matches):
+        for word in distinct:
+            counts += words.count(word) * contains(matches, read[word])
+    return (len(matches), top_k(matches, doc_ranks(ranks, matches) * counts, k),
+            sum(len(found) for found in read.values()))
@@ -19,24 +19,208 @@
 # THE SOFTWARE.
 import urllib3
 from urllib.parse import urlparse, urldefrag, urljoin
-from urllib.request import urlopen
-from bs4 import BeautifulSoup, Tag
-from collections import defaultdict
+from urllib.error import HTTPError
+from html.parser import HTMLParser
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from itertools import islice
 import re
 import os
+import time
+import hashlib
 import sqlite3
+import numpy as np
+from pagerank import LinkGraph, power_iteration
+from frontier import (Frontier, BloomFilter, HostScheduler, RobotsCache, Disallowed, RobotsUnavailable, normalize_url,
+                      host_of, QUEUED, FAILED, DISALLOWED)
+import postings
+from postings import SQL_BATCH_SIZE, add_columns, iter_postings, remove_postings
+from shards import attach_shards
+from spimi import IndexBuilder
+from stopwords import IGNORED_WORDS
+import snapshots
 
 def attr(elem, attr):
     """An html attribute from an html element. E.g. <a href="">, then
     attr(elem, "href") will get the href or an empty string."""
     try:
-        return elem[attr]
+        return elem[attr] or ""
     except:
         return ""
 
 
 WORD_SEPARATORS = re.compile(r'\s|\n|\r|\t|[^a-zA-Z0-9\-_]')
 
+# how the crawler introduces itself to web servers and their robots.txt
+USER_AGENT = "ece326-crawler"
+
+
+# tags that never have any content or a closing tag
+VOID_TAGS = {'area', 'base', 'basefont', 'br', 'col', 'embed', 'frame', 'hr', 'img', 'input', 'keygen', 'link',
+             'meta', 'param', 'source', 'track', 'wbr'}
+
+
+def chunks(items, size=SQL_BATCH_SIZE):
+    """Split a list into consecutive slices of at most `size` items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class LRUCache(OrderedDict):
+    """A dict of at most `maxsize` items. Once it is full, adding an item
+    drops the one that was used least recently."""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def connection_pool(num_pools=100, pool_size=10, user_agent=USER_AGENT):
+    """An HTTP client for fetch that keeps connections open for reuse: up to
+    `pool_size` idle connections to each of the `num_pools` hosts used most
+    recently. Pages are requested gzip or deflate compressed and decompressed
+    as they are read. The client can be shared by any number of fetcher
+    threads."""
+    return urllib3.PoolManager(num_pools=num_pools, maxsize=pool_size,
+                               headers=urllib3.make_headers(accept_encoding=True, user_agent=user_agent))
+
+
+def fetch(pool, url, timeout, etag=None, last_modified=None, robots=None):
+    """Download a page using the client `pool` made by connection_pool. This
+    runs on the crawler's fetcher threads, so it deliberately has no access
+    to the crawler or its database connection.
+
+    Returns the body of the page along with its ETag and Last-Modified
+    headers. If the validators from an earlier download are passed in, the
+    request is conditional, and the body is None when the server answers
+    that the page has not been modified. With a RobotsCache as `robots`,
+    urls that robots.txt disallows raise Disallowed instead, and urls of
+    hosts whose robots.txt could not be downloaded raise RobotsUnavailable."""
+    if robots is not None and not robots.allowed(pool, url, timeout):
+        raise Disallowed(url)
+
+    headers = dict(pool.headers)
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    response = pool.request("GET", url, headers=headers, timeout=timeout)
+    if response.status == 304:
+        return None, response.headers.get("ETag") or etag, response.headers.get("Last-Modified") or last_modified
+    if response.status >= 400:
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+    return response.data, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+
+def content_hash(html):
+    """A fingerprint of a page's contents, to tell whether it changed."""
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    return hashlib.blake2b(html, digest_size=16).hexdigest()
+
+
+def count_words(words):
+    """Collapse the (word, font_size) pairs collected from a page into one
+    (word, tf, font) triple per word: how often it occurs on the page and the
+    largest font it is shown in. Stray closing tags can push the font size
+    below the normal one, so fonts are counted from 0."""
+    counts = {}
+    for word, font_size in words:
+        tf, font = counts.get(word, (0, 0))
+        counts[word] = (tf + 1, max(font, font_size))
+    return [(word, tf, font) for word, (tf, font) in counts.items()]
+
+
+class DocumentParser(HTMLParser):
+    """Streams an html document through a crawler's indexing callbacks in a
+    single pass, without building a tree. The crawler's _enter and _exit
+    handlers are called as tags open and close, text goes to _add_text, and
+    everything inside the crawler's _ignored_tags is skipped."""
+
+    def __init__(self, bot):
+        super().__init__(convert_charrefs=True)
+        self._bot = bot
+        self._stack = []
+
+        # when inside an ignored tag, its name and how deeply it is nested
+        self._skip_tag = None
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth += 1
+            return
+
+        elem = dict(attrs)
+        if tag in VOID_TAGS:
+            self._bot._enter[tag](elem)
+            self._bot._exit[tag](elem)
+        elif tag in self._bot._ignored_tags:
+            # ignore this tag and everything in it
+            self._skip_tag = tag
+            self._skip_depth = 1
+        else:
+            self._bot._enter[tag](elem)
+            self._stack.append((tag, elem))
+
+    def handle_startendtag(self, tag, attrs):
+        if self._skip_tag is not None:
+            return
+
+        elem = dict(attrs)
+        self._bot._enter[tag](elem)
+        self._bot._exit[tag](elem)
+
+    def handle_endtag(self, tag):
+        if self._skip_tag is not None:
+            if tag == self._skip_tag:
+                self._skip_depth -= 1
+                if not self._skip_depth:
+                    self._skip_tag = None
+            return
+
+        # close everything up to the matching open tag, if there is one;
+        # stray closing tags are dropped
+        if any(name == tag for name, _ in self._stack):
+            while True:
+                name, elem = self._stack.pop()
+                self._bot._exit[name](elem)
+                if name == tag:
+                    break
+
+    def handle_data(self, data):
+        if self._skip_tag is None:
+            self._bot._add_text(data)
+
+    def handle_comment(self, data):
+        # comments have always been indexed like any other text
+        self.handle_data(data)
+
+    def unknown_decl(self, data):
+        if data.startswith("CDATA["):
+            self.handle_data(data[6:])
+
+    def close(self):
+        """Finish parsing, closing any tags the document left open."""
+        super().close()
+        while self._stack:
+            name, elem = self._stack.pop()
+            self._bot._exit[name](elem)
+
 
 class crawler(object):
     """Represents 'Googlebot'. Populates a database by crawling and indexing
@@ -70,13 +254,12 @@ class crawler(object):
             title TEXT
         );
         """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS InvertedIndex (
-            word_id INTEGER,
-            doc_id INTEGER,
-            PRIMARY KEY (word_id, doc_id)
-        );
-        """)
+
+        add_columns(cur, "DocumentIndex", (("etag", "TEXT"), ("last_modified", "TEXT"), ("content_hash", "TEXT"),
+                                           ("words", "BLOB"), ("length", "INTEGER")))
+
+        # the posting lists, see postings.py
+        postings.create_tables(cur)
         cur.execute("""
         CREATE TABLE IF NOT EXISTS Links (
             from_doc_id INTEGER,
@@ -90,6 +273,56 @@ class crawler(object):
             score REAL
         );
         """)
+        # the files the posting lists are split over, see shards.py
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS Shards (
+            id INTEGER PRIMARY KEY,
+            path TEXT
+        );
+        """)
+
+        # every url the crawler has come across, see frontier.py
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS Frontier (
+            url TEXT PRIMARY KEY,
+            host TEXT,
+            depth INTEGER,
+            priority INTEGER,
+            status INTEGER
+        );
+        """)
+        if add_columns(cur, "Frontier", (("host", "TEXT"),)):
+            conn.create_function("host_of", 1, host_of, deterministic=True)
+            cur.execute("UPDATE Frontier SET host = host_of(url)")
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS frontier_queue ON Frontier (status, priority, depth);
+        """)
+        # the queue of each host, see HostScheduler
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS frontier_host ON Frontier (host, status, priority);
+        """)
+
+        # links added or removed since PageRank was last computed, recorded by
+        # triggers so every writer of Links is covered
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS LinkChanges (
+            from_doc_id INTEGER,
+            to_doc_id INTEGER,
+            PRIMARY KEY (from_doc_id, to_doc_id)
+        );
+        """)
+        cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS links_inserted AFTER INSERT ON Links
+        BEGIN
+            INSERT OR IGNORE INTO LinkChanges (from_doc_id, to_doc_id) VALUES (NEW.from_doc_id, NEW.to_doc_id);
+        END;
+        """)
+        cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS links_deleted AFTER DELETE ON Links
+        BEGIN
+            INSERT OR IGNORE INTO LinkChanges (from_doc_id, to_doc_id) VALUES (OLD.from_doc_id, OLD.to_doc_id);
+        END;
+        """)
 
         conn.commit()
         conn.close()
@@ -98,31 +331,58 @@ class crawler(object):
     def close_connection(self):
         if self.db_conn:
             self.db_conn.close()
+            self.db_conn = None
             print("Database connection closed.")
             
     def __del__(self):
         self.close_connection()
 
-    def __init__(self, db_conn = None, url_file = None, db_path="crawler_data.db"):
+    def __init__(self, db_conn = None, url_file = None, db_path="crawler_data.db", seen_error_rate=0.001,
+                 num_shards=1, lexicon_cache=100000):
         """Initialize the crawler with a connection to the database to populate
-        and with the file containing the list of seed URLs to begin indexing."""
+        and with the file containing the list of seed URLs to begin indexing.
+
+        `seen_error_rate` is the false positive rate of the filter of known
+        urls; a false positive only costs a database lookup. A new database
+        gets its posting lists split over `num_shards` files, see shards.py;
+        an existing one keeps the shards it has. The ids of the
+        `lexicon_cache` words used most recently are kept in memory."""
         if db_conn is None:
             self.db_conn = sqlite3.connect(db_path)
             print(f"Database connection initialized at {db_path}.")
         else:
             self.db_conn = db_conn
         self.initialize_database(db_path=db_path)
-        self._url_queue = []
-        self._doc_id_cache = {}
-        self._word_id_cache = {}
-        
-        
-
-        self._lexicon = {}
-        self._inverted_index = {}
-        self._document_index = {}
-        self._links = {}
+        self._db_path = db_path
+        self._shards = attach_shards(self.db_conn, db_path, num_shards)
+        self._frontier = Frontier(self.db_conn)
+        self._robots = RobotsCache(USER_AGENT)
+        # ids of Lexicon words, only ever holding committed ones
+        self._lexicon = LRUCache(lexicon_cache)
+        # collects postings instead of InvertedIndex during index_pages
+        self._builder = None
+
+        # every url that has a DocumentIndex row
+        self._seen_urls = BloomFilter(error_rate=seen_error_rate)
+        for (url,) in self.db_conn.execute("SELECT url FROM DocumentIndex"):
+            self._seen_urls.add(url)
+
+        self._init_parser()
+
+        # get all urls into the queue; seeds that were already crawled by an
+        # earlier run are not fetched again
+        try:
+            with open(url_file, 'r') as f:
+                seeds = [self._fix_url(line.strip(), "") for line in f if line.strip()]
+                with self.db_conn:
+                    self._frontier.add((url, 0) for url in seeds if url)
+        except (IOError, TypeError):
+            pass
 
+    def _init_parser(self):
+        """Set up the tag handlers and the state used while parsing a page.
+        Needs no database, so parse workers can use it too, see
+        init_parse_worker."""
         # functions to call when entering and exiting specific tags
         self._enter = defaultdict(lambda *a, **ka: self._visit_ignore)
         self._exit = defaultdict(lambda *a, **ka: self._visit_ignore)
@@ -158,7 +418,11 @@ class crawler(object):
         self._exit['h3'] = self._increase_font_factor(-5)
         self._exit['h4'] = self._increase_font_factor(-4)
         self._exit['h5'] = self._increase_font_factor(-3)
-        self._exit['title'] = self._increase_font_factor(-7)
+        def exit_title(*args, **kargs):
+            self._exit_title(*args, **kargs)
+            self._increase_font_factor(-7)(*args, **kargs)
+
+        self._exit['title'] = exit_title
 
         # never go in and parse these tags
         self._ignored_tags = {'meta', 'script', 'link', 'meta', 'embed', 'iframe', 'frame', 'noscript', 'object', 'svg',
@@ -166,13 +430,7 @@ class crawler(object):
                               'param'}
 
         # set of words to ignore
-        self._ignored_words = {'', 'the', 'of', 'at', 'on', 'in', 'is', 'it', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h',
-                               'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z',
-                               'and', 'or'}
-
-        # TODO remove me in real version
-        self._mock_next_doc_id = 1
-        self._mock_next_word_id = 1
+        self._ignored_words = IGNORED_WORDS
 
         # keep track of some info about the page we are currently parsing
         self._curr_depth = 0
@@ -180,18 +438,17 @@ class crawler(object):
         self._curr_doc_id = 0
         self._font_size = 0
         self._curr_words = None
-
-        # get all urls into the queue
-        try:
-            with open(url_file, 'r') as f:
-                for line in f:
-                    self._url_queue.append((self._fix_url(line.strip(), ""), 0))
-        except IOError:
-            pass
+        self._curr_length = 0
+        self._curr_links = None
+        self._curr_title = None
+        self._title_parts = None
+        self._curr_validators = (None, None, None)
+        self._curr_replace = False
 
     def _fix_url(self, curr_url, rel):
         """Given a url and either something relative to that url or another url,
-        get a properly parsed url."""
+        get a properly parsed url in canonical form, or None if it is not a
+        web page we can crawl."""
 
         rel_l = rel.lower()
         if rel_l.startswith("http://") or rel_l.startswith("https://"):
@@ -200,7 +457,7 @@ class crawler(object):
         # compute the new url based on import
         curr_url = urldefrag(curr_url)[0]
         parsed_url = urlparse(curr_url)
-        return urljoin(parsed_url.geturl(), rel)
+        return normalize_url(urljoin(parsed_url.geturl(), rel))
 
     def _increase_font_factor(self, factor):
         """Increade/decrease the current font size."""
@@ -214,116 +471,285 @@ class crawler(object):
         """Ignore visiting this type of tag"""
         pass
 
-    def _add_text(self, elem):
-        """Add some text to the document. This records word ids and word font sizes
-        into the self._curr_words list for later processing."""
-        words = WORD_SEPARATORS.split(elem.string.lower())
+    def _add_text(self, text):
+        """Add some text to the document. This records words and word font sizes
+        into the self._curr_words list for later processing. Words are only
+        resolved to word ids once the whole document has been parsed, see
+        _add_words_to_document."""
+        if self._title_parts is not None:
+            self._title_parts.append(text)
+
+        words = WORD_SEPARATORS.split(text.lower())
         for word in words:
             word = word.strip()
             if word in self._ignored_words:
                 continue
-            self._curr_words.append((self.word_id(word), self._font_size))
-
-    def _text_of(self, elem):
-        """Get the text inside some element without any tags."""
-        if isinstance(elem, Tag):
-            text = []
-            for sub_elem in elem:
-                text.append(self._text_of(sub_elem))
-
-            return " ".join(text)
-        else:
-            return elem.string
-
-    def _index_document(self, soup):
-        """Traverse the document in depth-first order and call functions when entering
-        and leaving tags. When we come accross some text, add it into the index. This
-        handles ignoring tags that we have no business looking at."""
-
-        class DummyTag(object):
-            next = False
-            name = ''
-
-        class NextTag(object):
-            def __init__(self, obj):
-                self.next = obj
-
-        tag = soup.html
-        stack = [DummyTag(), soup.html]
-
-        while tag and tag.next:
-            tag = tag.next
-
-            # html tag
-            if isinstance(tag, Tag):
-
-                if tag.parent != stack[-1]:
-                    self._exit[stack[-1].name.lower()](stack[-1])
-                    stack.pop()
-
-                tag_name = tag.name.lower()
-
-                # ignore this tag and everything in it
-                if tag_name in self._ignored_tags:
-                    if tag.nextSibling:
-                        tag = NextTag(tag.nextSibling)
-                    else:
-                        self._exit[stack[-1].name.lower()](stack[-1])
-                        stack.pop()
-                        tag = NextTag(tag.parent.nextSibling)
-
+            self._curr_words.append((word, self._font_size))
+
+    def _index_document(self, html):
+        """Stream the document through a DocumentParser, which calls functions
+        when entering and leaving tags and adds any text it comes across into
+        the index. This handles ignoring tags that we have no business looking
+        at."""
+        if isinstance(html, bytes):
+            try:
+                html = html.decode("utf-8")
+            except UnicodeDecodeError:
+                html = html.decode("latin-1")
+
+        parser = DocumentParser(self)
+        parser.feed(html)
+        parser.close()
+
+    def _parse_page(self, url, html):
+        """Parse one page without touching the database. Returns its words as
+        (word, tf, font) triples, see count_words, the number of words on the
+        page, the urls it links to and its title."""
+        self._curr_url = url
+        self._font_size = 0
+        self._curr_words = []
+        self._curr_links = []
+        self._curr_title = None
+        self._title_parts = None
+        self._index_document(html)
+        return count_words(self._curr_words), len(self._curr_words), self._curr_links, self._curr_title
+
+    def _store_page(self, url, doc_id, depth, parsed, validators, replace=False):
+        """Write a page parsed by _parse_page to the database in one go, along
+        with its `validators` (ETag, Last-Modified and content hash). If the
+        page was `replace`d since it was last indexed, its old postings and
+        links are dropped first."""
+        self._curr_words, self._curr_length, self._curr_links, self._curr_title = parsed
+        self._curr_validators = validators
+        self._curr_replace = replace
+        self._curr_depth = depth + 1
+        self._curr_url = url
+        self._curr_doc_id = doc_id
+        self._add_words_to_document()
+
+    def _index_page(self, url, doc_id, depth, html, etag=None, last_modified=None, replace=False):
+        """Parse and index the contents of one fetched page, then write
+        everything we learned about it to the database in one go."""
+        self._store_page(url, doc_id, depth, self._parse_page(url, html), (etag, last_modified, content_hash(html)),
+                         replace)
+
+    def crawl(self, depth=2, timeout=3, concurrency=1, merge_every=1000, parse_workers=0, parse_queue=None,
+              num_pools=100, pool_size=None, per_host=2, host_delay=0.0):
+        """Crawl the web!
+
+        Up to `concurrency` pages are downloaded at the same time on a pool of
+        fetcher threads. They share one HTTP client, which keeps up to
+        `pool_size` (by default `concurrency`) connections open to each of
+        the last `num_pools` hosts, so pages on a host fetched before are
+        downloaded over a connection that is already open.
+
+        Fetchers are handed urls by a HostScheduler: no more than `per_host`
+        pages of one host are downloaded at a time, downloads from a host
+        start at least `host_delay` seconds apart, or further if its
+        robots.txt asks for a longer Crawl-delay, and pages robots.txt
+        disallows are not downloaded at all. Meanwhile other hosts keep the
+        fetchers busy.
+
+        Indexing stays on the calling thread, so SQLite only ever sees a
+        single writer. With `parse_workers`, pages are parsed on that many
+        processes instead, and the calling thread only writes what they
+        found to the database; once `parse_queue` pages (twice the
+        number of workers by default) wait to be parsed or written, no new
+        fetches are started until the writer catches up.
+
+        Urls to visit come from the persistent frontier, and every indexed
+        page is committed together with its frontier updates. If a crawl is
+        interrupted, calling crawl() again on the same database continues
+        with the pages that were not finished.
+
+        New postings are merged into the compressed posting lists after every
+        `merge_every` indexed pages, and once more at the end."""
+        parse_queue = parse_queue or 2 * parse_workers
+        http = connection_pool(num_pools, pool_size or concurrency)
+        scheduler = HostScheduler(self._frontier, self._robots, per_host, host_delay)
+        in_flight = {}
+        parsing = {}
+        indexed = 0
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool, \
+                (ProcessPoolExecutor(parse_workers, initializer=init_parse_worker) if parse_workers
+                 else nullcontext()) as parser:
+            while True:
+
+                # keep the fetchers busy; the scheduler only hands out urls we
+                # have not fetched yet, that are not too deep and whose host
+                # can take another request right now
+                if len(in_flight) < concurrency and (parser is None or len(parsing) < parse_queue):
+                    for url, depth_ in scheduler.pop(concurrency - len(in_flight), depth):
+                        doc_id = self.document_id(url)
+                        etag, last_modified, old_hash = self._document_validators(doc_id)
+                        future = pool.submit(fetch, http, url, timeout, etag, last_modified, self._robots)
+                        in_flight[future] = (url, doc_id, depth_, old_hash)
+
+                if not in_flight and not parsing:
+                    # every queued url is on a host we have to wait for
+                    if scheduler.next_ready() is None:
+                        break
+                    time.sleep(scheduler.next_ready())
                     continue
 
-                # enter the tag
-                self._enter[tag_name](tag)
-                stack.append(tag)
-
-            # text (text, cdata, comments, etc.)
-            else:
-                self._add_text(tag)
-
-    def crawl(self, depth=2, timeout=3):
-        """Crawl the web!"""
-        seen = set()
-
-        while len(self._url_queue):
-
-            url, depth_ = self._url_queue.pop()
-
-            # skip this url; it's too deep
-            if depth_ > depth:
-                continue
-
-            doc_id = self.document_id(url)
-
-            # we've already seen this document
-            if doc_id in seen:
-                continue
+                # index whatever has finished downloading or parsing; this
+                # queues up the outgoing links for the next round of fetches.
+                # Stop waiting when a host becomes ready again, too.
+                done, _ = wait(list(in_flight) + list(parsing), timeout=scheduler.next_ready(),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    parsed = future in parsing
+                    if parsed:
+                        url, doc_id, depth_, validators, replace = parsing.pop(future)
+                    else:
+                        url, doc_id, depth_, old_hash = in_flight.pop(future)
+                        scheduler.done(url)
+                    try:
+                        if parsed:
+                            self._store_page(url, doc_id, depth_, future.result()[0], validators, replace)
+                        else:
+                            html, etag, last_modified = future.result()
+                            new_hash = None if html is None else content_hash(html)
+
+                            # nothing to do for pages that have not changed
+                            # since they were last indexed
+                            if new_hash is None or new_hash == old_hash:
+                                with self.db_conn:
+                                    self.db_conn.execute("UPDATE DocumentIndex SET etag = ?, last_modified = ? "
+                                                         "WHERE id = ?", (etag, last_modified, doc_id))
+                                    self._frontier.finish(url)
+                                print("    unchanged url=" + repr(url))
+                                continue
+
+                            if parser is not None:
+                                # the page is written once a worker parsed it
+                                parsing[parser.submit(parse_pages, [(url, html)])] = (
+                                    url, doc_id, depth_, (etag, last_modified, new_hash), old_hash is not None)
+                                continue
+                            self._index_page(url, doc_id, depth_, html, etag, last_modified,
+                                             replace=old_hash is not None)
+                        print("    url=" + repr(url))
+
+                        indexed += 1
+                        if indexed % merge_every == 0:
+                            self.merge_postings()
+
+                    except Disallowed:
+                        print("    disallowed by robots.txt url=" + repr(url))
+                        with self.db_conn:
+                            self._frontier.finish(url, DISALLOWED)
+                    except RobotsUnavailable as e:
+                        # the scheduler holds the host back until robots.txt
+                        # is tried again
+                        print("    robots.txt unavailable url=" + repr(url))
+                        with self.db_conn:
+                            self._frontier.finish(url, QUEUED if e.retry_at is not None else FAILED)
+                    except Exception as e:
+                        print(e)
+                        with self.db_conn:
+                            self._frontier.finish(url, FAILED)
+        http.clear()
+        self.merge_postings()
+        self.page_rank(incremental=True)
+
+    def recrawl(self, depth=2, timeout=3, concurrency=1, merge_every=1000, parse_workers=0, num_pools=100,
+                pool_size=None, per_host=2, host_delay=0.0):
+        """Visit every page that was already crawled again, and index the ones
+        that changed. Pages are fetched with conditional requests, so servers
+        can answer with 304 Not Modified instead of the whole page, and pages
+        whose contents hash the same as last time are not reindexed."""
+        with self.db_conn:
+            self._frontier.requeue()
+        self.crawl(depth=depth, timeout=timeout, concurrency=concurrency, merge_every=merge_every,
+                   parse_workers=parse_workers, num_pools=num_pools, pool_size=pool_size, per_host=per_host,
+                   host_delay=host_delay)
+
+    def index_pages(self, pages, parse_workers=None, batch_size=16, parse_queue=None, merge_every=1000,
+                    memory_budget=None):
+        """Index (url, html) pairs that are already at hand, such as a local
+        copy of a site, without fetching anything. The pages are parsed in
+        batches of `batch_size` on `parse_workers` processes, one per core by
+        default, while the calling thread writes the results to the database.
+        At most `parse_queue` batches (twice the number of workers by default)
+        are handed out at a time, so `pages` can be a generator over a corpus
+        much larger than memory. The links found are queued in the frontier
+        for a later crawl. Returns the number of pages indexed.
+
+        With a `memory_budget` in bytes, postings are not staged in the
+        InvertedIndex table but collected by an IndexBuilder, which spills
+        them to temporary files whenever they outgrow the budget and merges
+        them all into the posting lists at the end, see spimi.py. Pages only
+        count as indexed once that merge is committed."""
+        parse_workers = parse_workers or os.cpu_count()
+        parse_queue = parse_queue or 2 * parse_workers
+        pages = iter(pages)
+        parsing = {}
+        indexed = 0
+        if memory_budget is not None:
+            self._builder = IndexBuilder(memory_budget)
 
-            seen.add(doc_id)  # mark this document as haven't been visited
+        try:
+            with ProcessPoolExecutor(parse_workers, initializer=init_parse_worker) as parser:
+                while True:
+                    while len(parsing) < parse_queue:
+                        batch = list(islice(pages, batch_size))
+                        if not batch:
+                            break
+                        parsing[parser.submit(parse_pages, batch)] = [(url, content_hash(html))
+                                                                      for url, html in batch]
+                    if not parsing:
+                        break
+
+                    # batches are written in the order they were handed out,
+                    # so documents get the same ids on every run
+                    future = next(iter(parsing))
+                    batch = parsing.pop(future)
+                    with self.db_conn:
+                        doc_ids, _ = self._resolve_ids("DocumentIndex", "url", [url for url, _ in batch],
+                                                       seen=self._seen_urls)
+                    for (url, new_hash), parsed in zip(batch, future.result()):
+                        doc_id = doc_ids[url]
+                        old_hash = self._document_validators(doc_id)[2]
+                        if new_hash == old_hash:
+                            continue
+                        # the builder holds content hashes back, so a page
+                        # indexed earlier in this build has none yet
+                        replace = old_hash is not None or (self._builder is not None and
+                                                           self._document_words(doc_id) is not None)
+                        self._store_page(url, doc_id, 0, parsed, (None, None, new_hash), replace=replace)
+
+                        indexed += 1
+                        if self._builder is None and indexed % merge_every == 0:
+                            self.merge_postings()
+            self.merge_postings()
+
+            if self._builder is not None:
+                with self.db_conn:
+                    merged = self._builder.merge(self.db_conn, self._shards)
+                    self.db_conn.executemany("UPDATE DocumentIndex SET content_hash = ? WHERE id = ?",
+                                             ((new_hash, doc_id) for doc_id, new_hash in self._builder.hashes()))
+                print(f"Merged {merged} postings from {len(self._builder)} runs into the posting lists.")
+        finally:
+            if self._builder is not None:
+                self._builder.close()
+                self._builder = None
+        return indexed
+
+    def _document_words(self, doc_id):
+        """The encoded ids of the words of a document the last time it was
+        indexed, or None."""
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT words FROM DocumentIndex WHERE id = ?", (doc_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
 
-            socket = None
-            try:
-                socket = urlopen(url, timeout=timeout)
-                soup = BeautifulSoup(socket.read(), features="html.parser")
-
-                self._curr_depth = depth_ + 1
-                self._curr_url = url
-                self._curr_doc_id = doc_id
-                self._font_size = 0
-                self._curr_words = []
-                self._index_document(soup)
-                self._add_words_to_document()
-                print("    url=" + repr(self._curr_url))
-
-
-            except Exception as e:
-                print(e)
-                pass
-            finally:
-                if socket:
-                    socket.close()
-        self.page_rank()
+    def _document_validators(self, doc_id):
+        """The ETag, Last-Modified header and content hash stored for a
+        document the last time it was indexed."""
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT etag, last_modified, content_hash FROM DocumentIndex WHERE id = ?", (doc_id,))
+        return cur.fetchone() or (None, None, None)
         
 
     # # TODO remove me in real version
@@ -343,51 +769,70 @@ class crawler(object):
     #     self.word_id(word) = ret_id
     #     return ret_id
 
+    def _resolve_ids(self, table, column, keys, cache=None, seen=None):
+        """Map every key in `keys` to the id of its row in `table`, inserting rows
+        for keys we have never seen. Keys in `cache` come straight out of it,
+        and keys that the `seen` filter has definitely never seen are inserted
+        without looking for them first. Everything else is looked up and
+        inserted in batches rather than one statement per key. Nothing is
+        committed here, so nothing is put in `cache` either: the ids should
+        only go in once they are committed, as a rollback takes them back.
+
+        Returns a dict of key -> id and the list of keys that were inserted."""
+        ids = {}
+        missing = []
+        for key in keys:
+            if key in ids:
+                continue
+            if cache is not None and key in cache:
+                ids[key] = cache[key]
+            else:
+                ids[key] = None
+                missing.append(key)
+
+        new_keys = []
+        if missing:
+            cur = self.db_conn.cursor()
+            lookup = missing if seen is None else [key for key in missing if key in seen]
+            for batch in chunks(lookup):
+                cur.execute("SELECT id, %s FROM %s WHERE %s IN (%s)" % (
+                    column, table, column, ",".join("?" * len(batch))), batch)
+                for row_id, key in cur.fetchall():
+                    ids[key] = row_id
+
+            new_keys = [key for key in missing if ids[key] is None]
+            if new_keys:
+                # we are the only writer, so ids can be handed out up front
+                # and the rows inserted with a single executemany
+                cur.execute("SELECT COALESCE(MAX(id), 0) FROM %s" % table)
+                next_id = cur.fetchone()[0] + 1
+                rows = list(zip(range(next_id, next_id + len(new_keys)), new_keys))
+                cur.executemany("INSERT INTO %s (id, %s) VALUES (?, ?)" % (table, column), rows)
+                ids.update((key, row_id) for row_id, key in rows)
+                if seen is not None:
+                    for key in new_keys:
+                        seen.add(key)
+
+        return ids, new_keys
+
     def word_id(self, word):
         """Get the word ID of a specific word and update the inverted index."""
-        cur = self.db_conn.cursor()
-        
-        # Check if the word exists in the Lexicon
-        cur.execute("SELECT id FROM Lexicon WHERE word = ?", (word,))
-        result = cur.fetchone()
-        
-        if result:
-            word_id = result[0]
-        else:
-            # Insert the new word into the Lexicon
-            cur.execute("INSERT INTO Lexicon (word) VALUES (?)", (word,))
-            self.db_conn.commit()
-            word_id = cur.lastrowid
-
-        # Add the word ID to the inverted index
-        if word_id not in self._inverted_index:
-            self._inverted_index[word_id] = set()
-        self._inverted_index[word_id].add(self._curr_doc_id)
+        word_id = self._resolve_ids("Lexicon", "word", [word], self._lexicon)[0][word]
 
         # Update the database inverted index
-        cur.execute("INSERT OR IGNORE INTO InvertedIndex (word_id, doc_id) VALUES (?, ?)",
-                    (word_id, self._curr_doc_id))
+        cur = self.db_conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO %s.InvertedIndex (word_id, doc_id) VALUES (?, ?)" %
+                    self._shard_of(self._curr_doc_id), (word_id, self._curr_doc_id))
         self.db_conn.commit()
+        self._lexicon[word] = word_id
 
         return word_id
 
 
     def document_id(self, url):
         """Get the document ID for a specific URL."""
-        cur = self.db_conn.cursor()
-        
-        cur.execute("SELECT id FROM DocumentIndex WHERE url = ?", (url,))
-        result = cur.fetchone()
-        
-        if result:
-            doc_id = result[0]
-        else:
-            cur.execute("INSERT INTO DocumentIndex (url) VALUES (?)", (url,))
-            self.db_conn.commit()
-            doc_id = cur.lastrowid
-
-        self._doc_id_cache[url] = doc_id
-        self._document_index[doc_id] = url
+        doc_id = self._resolve_ids("DocumentIndex", "url", [url], seen=self._seen_urls)[0][url]
+        self.db_conn.commit()
 
         return doc_id
 
@@ -405,122 +850,220 @@ class crawler(object):
         cur.execute("INSERT OR IGNORE INTO Links (from_doc_id, to_doc_id) VALUES (?, ?)",
                     (from_doc_id, to_doc_id))
         self.db_conn.commit()
-        
-        # Update the in-memory links structure
-        if from_doc_id not in self._links:
-            self._links[from_doc_id] = set()
-        self._links[from_doc_id].add(to_doc_id)
 
 
     def _visit_title(self, elem):
-        """Called when visiting the <title> tag."""
-        title_text = self._text_of(elem).strip()
+        """Called when visiting the <title> tag. The title's text is collected
+        by _add_text until the tag is closed."""
+        self._title_parts = []
+
+    def _exit_title(self, elem):
+        """Called when leaving the <title> tag."""
+        title_text = " ".join(self._title_parts).strip()
+        self._title_parts = None
         print("document title=" + repr(title_text))
 
-        # TODO update document title for document id self._curr_doc_id
+        # written to DocumentIndex along with the rest of the document
+        self._curr_title = title_text
 
     def _visit_a(self, elem):
         """Called when visiting <a> tags."""
         # print("    a tag=" + repr(elem))
 
         dest_url = self._fix_url(self._curr_url, attr(elem, "href"))
+        if dest_url is None:
+            return
 
         # print "href="+repr(dest_url), \
         #      "title="+repr(attr(elem,"title")), \
-        #      "alt="+repr(attr(elem,"alt")), \
-        #      "text="+repr(self._text_of(elem))
+        #      "alt="+repr(attr(elem,"alt"))
 
-        # add the just found URL to the url queue
-        self._url_queue.append((dest_url, self._curr_depth))
-
-        # add a link entry into the database from the current document to the
-        # other document
-        self.add_link(self._curr_doc_id, self.document_id(dest_url))
+        # remember the link from the current document to the other document;
+        # it is written to the database, and the just found URL added to the
+        # frontier, in _add_words_to_document
+        self._curr_links.append(dest_url)
 
         # TODO add title/alt/text to index for destination url
 
     def _add_words_to_document(self):
-        # TODO: knowing self._curr_doc_id and the list of all words and their
-        #       font sizes (in self._curr_words), add all the words into the
-        #       database for this document
-        print("    num words=" + str(len(self._curr_words)))
+        """Write everything collected for the current document to the database:
+        new Lexicon and DocumentIndex rows, the document's postings, its
+        outgoing links, its title and its frontier updates. All of it goes out
+        in a single transaction, so indexing a page costs one commit instead
+        of one per word and link."""
+        doc_id = self._curr_doc_id
+        shard = self._shard_of(doc_id)
+
+        with self.db_conn:
+            word_ids, _ = self._resolve_ids("Lexicon", "word", [word for word, _, _ in self._curr_words],
+                                            self._lexicon)
+            self._curr_words = [(word_ids[word], tf, font) for word, tf, font in self._curr_words]
+
+            link_ids, _ = self._resolve_ids("DocumentIndex", "url", self._curr_links,
+                                            seen=self._seen_urls)
+
+            cur = self.db_conn.cursor()
+            old_words = None
+            if self._curr_replace:
+                old_words = postings.decode(self._document_words(doc_id))
+                remove_postings(self.db_conn, doc_id, old_words, schema=shard)
+                cur.execute("DELETE FROM Links WHERE from_doc_id = ?", (doc_id,))
+
+            words = sorted(word_id for word_id, _, _ in self._curr_words)
+            validators = self._curr_validators
+            if self._builder is None:
+                cur.executemany("INSERT OR REPLACE INTO %s.InvertedIndex (word_id, doc_id, tf, font) "
+                                "VALUES (?, ?, ?, ?)" % shard,
+                                [(word_id, doc_id, tf, font) for word_id, tf, font in self._curr_words])
+            else:
+                # the content hash is written once the builder is merged
+                validators = validators[:2] + (None,)
+            links = set(link_ids.values())
+            cur.executemany("INSERT OR IGNORE INTO Links (from_doc_id, to_doc_id) VALUES (?, ?)",
+                            [(doc_id, to_doc_id) for to_doc_id in links])
+            cur.execute("""
+            UPDATE DocumentIndex SET title = ?, etag = ?, last_modified = ?, content_hash = ?, words = ?, length = ?
+            WHERE id = ?
+            """, (self._curr_title,) + validators + (postings.encode(words), self._curr_length, doc_id))
+
+            # urls we already knew about are in the frontier already, but may
+            # have been queued deeper than this page finds them
+            self._frontier.add((url, self._curr_depth) for url in link_ids)
+            self._frontier.finish(self._curr_url)
+
+        # only once the page is committed
+        for word, word_id in word_ids.items():
+            self._lexicon[word] = word_id
+        if self._builder is not None:
+            if old_words is not None:
+                self._builder.remove(doc_id, old_words)
+            found = np.array(self._curr_words, dtype=np.int64).reshape(-1, 3)
+            self._builder.add(doc_id, found[:, 0], found[:, 1], found[:, 2], self._curr_validators[2])
+
+        print("    num words=" + str(self._curr_length))
+
+    def _shard_of(self, doc_id):
+        """The schema the postings of the document `doc_id` are under."""
+        return self._shards[doc_id % len(self._shards)]
 
     def get_inverted_index(self):
-        """Get the inverted index."""
-        return self._inverted_index
+        """Get the inverted index, as a dict of word id -> set of document ids
+        read from the database."""
+        # a word's documents can be spread over every shard
+        inverted_index = defaultdict(set)
+        for shard in self._shards:
+            for word_id, (doc_ids, _, _) in iter_postings(self.db_conn, shard):
+                inverted_index[word_id].update(doc_ids.tolist())
+        return dict(inverted_index)
     
     def get_resolved_inverted_index(self):
         """Generate a resolved inverted index with human-readable words and URLs."""
         resolved_index = {}
         cur = self.db_conn.cursor()
-        cur.execute("SELECT word_id, doc_id FROM InvertedIndex")
-        inverted_index = cur.fetchall()
+        cur.execute("SELECT id, word FROM Lexicon")
+        words = dict(cur.fetchall())
+        cur.execute("SELECT id, url FROM DocumentIndex")
+        urls = dict(cur.fetchall())
 
-        for word_id, doc_id in inverted_index:
-            word = self._word_id_cache.get(word_id, f"UnknownWord({word_id})")
-            url = self._document_index.get(doc_id, f"UnknownURL({doc_id})")
-            if word not in resolved_index:
-                resolved_index[word] = []
-            resolved_index[word].append(url)
+        for word_id, doc_ids in self.get_inverted_index().items():
+            word = words.get(word_id, f"UnknownWord({word_id})")
+            resolved_index[word] = [urls.get(doc_id, f"UnknownURL({doc_id})") for doc_id in sorted(doc_ids)]
 
         return resolved_index
 
-        
-    def page_rank(self, num_iterations=20, initial_pr=1.0):
-        from collections import defaultdict
-        import numpy as np
-
+    def merge_postings(self):
+        """Fold the postings written since the last merge into the compressed
+        posting lists, see postings.py."""
+        with self.db_conn:
+            merged = sum(postings.merge_postings(self.db_conn, schema=shard) for shard in self._shards)
+        print(f"Merged {merged} postings into the posting lists.")
+
+    def publish(self, root="index", keep=2):
+        """Publish the index as it is now for the frontend to search, as a new
+        generation under `root`, keeping the newest `keep` generations, see
+        snapshots.py. Crawling can go on meanwhile without the frontend
+        seeing any of it until the next publish."""
+        self.merge_postings()
+        directory = snapshots.publish(self.db_conn, self._db_path, root, keep)
+        print(f"Published the index as {directory}.")
+        return directory
+
+    def page_rank(self, num_iterations=100, tolerance=1e-6, incremental=False, region_hops=None):
+        """Compute the PageRank of every document in the Links graph and store
+        the scores in the PageRank table. Iteration stops once the scores
+        change by less than `tolerance` (L1), or after `num_iterations`.
+
+        With `incremental`, iteration starts from the scores already in the
+        PageRank table, so after a small recrawl it converges in a few
+        iterations. If `region_hops` is given as well, only documents at most
+        that many links downstream of a link added or removed since the last
+        run are recomputed and written back; all others keep their stored
+        scores."""
         cur = self.db_conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM Links")
-        count = cur.fetchone()[0]
-        print(f"Number of entries in 'Links': {count}")
+        cur.execute("SELECT from_doc_id, to_doc_id FROM Links")
+        graph = LinkGraph(cur.fetchall())
+        print(f"Number of entries in 'Links': {graph.num_edges()}")
 
-        page_rank = defaultdict(lambda: float(initial_pr))
-        num_outgoing_links = defaultdict(float)
-        incoming_link_sets = defaultdict(set)
-        incoming_links = defaultdict(lambda: np.array([]))
-        damping_factor = 0.85
+        ranks = None
+        active = None
+        if incremental:
+            cur.execute("SELECT doc_id, score FROM PageRank")
+            stored = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 2)
+            indices, found = graph.index_of(stored[:, 0].astype(np.int64))
+            ranks = np.full(len(graph), np.nan)
+            ranks[indices[found]] = stored[found, 1]
 
-        cur.execute("SELECT from_doc_id, to_doc_id FROM Links")
-        links = cur.fetchall()
+            # documents without a stored score start out with an average one
+            unscored = np.isnan(ranks)
+            ranks[unscored] = 1.0 / max(len(graph), 1)
 
-        for from_id, to_id in links:
-            num_outgoing_links[int(from_id)] += 1.0
-            incoming_link_sets[to_id].add(int(from_id))
+            if region_hops is not None:
+                cur.execute("SELECT from_doc_id, to_doc_id FROM LinkChanges")
+                changed = np.array(cur.fetchall(), dtype=np.int64).ravel()
+                indices, found = graph.index_of(changed)
+                active = graph.downstream(indices[found], region_hops) | unscored
 
-        for _, to_id in links:
-            if to_id not in num_outgoing_links:
-                num_outgoing_links[int(to_id)] = 1.0
+        ranks, iterations = power_iteration(graph, ranks, tolerance=tolerance, max_iterations=num_iterations,
+                                            active=active)
+        updated = graph.doc_ids if active is None else graph.doc_ids[active]
+        updated_ranks = ranks if active is None else ranks[active]
 
-        for doc_id in incoming_link_sets:
-            incoming_links[doc_id] = np.array([from_doc_id for from_doc_id in incoming_link_sets[doc_id]])
+        with self.db_conn:
+            cur.executemany("INSERT OR REPLACE INTO PageRank (doc_id, score) VALUES (?, ?)",
+                            zip(updated.tolist(), updated_ranks.tolist()))
+            cur.execute("DELETE FROM LinkChanges")
 
-        num_documents = float(len(num_outgoing_links))
-        lead = (1.0 - damping_factor) / num_documents
-        partial_PR = np.vectorize(lambda doc_id: page_rank[doc_id] / num_outgoing_links[doc_id])
+        print(f"PageRank scores of {len(updated)} documents updated in the database after "
+              f"{iterations} iterations.")
+        return dict(zip(graph.doc_ids.tolist(), ranks.tolist()))
 
-        for _ in range(num_iterations):
-            for doc_id in num_outgoing_links:
-                tail = 0.0
-                if len(incoming_links[doc_id]):
-                    tail = damping_factor * partial_PR(incoming_links[doc_id]).sum()
-                page_rank[doc_id] = lead + tail
 
-        for doc_id, score in page_rank.items():
-            cur.execute("""
-            INSERT OR REPLACE INTO PageRank (doc_id, score) VALUES (?, ?)
-            """, (int(doc_id), float(score)))
-        self.db_conn.commit()
 
-        print("PageRank scores updated in the database.")
-        return page_rank
+
+# the crawler a parse worker process parses pages with
+_parse_bot = None
+
+
+def init_parse_worker():
+    """Set up a parse worker process. Its crawler only ever parses, so it has
+    no database connection."""
+    global _parse_bot
+    _parse_bot = crawler.__new__(crawler)
+    _parse_bot.db_conn = None
+    _parse_bot._init_parser()
 
 
+def parse_pages(pages):
+    """Parse a batch of (url, html) pages in a parse worker process. Returns
+    what crawler._parse_page found on each of them, which is much smaller
+    than the pages themselves."""
+    return [_parse_bot._parse_page(url, html) for url, html in pages]
 
 
 if __name__ == "__main__":
     bot = crawler(url_file= "urls.txt")
-    bot.crawl(depth=1)
+    bot.crawl(depth=1, concurrency=8)
+    bot.publish()
     # print(bot.get_resolved_inverted_index())
     # print(bot.get_inverted_index())
     
@@ -122,7 +122,7 @@ def setup_instance(public_ip):
     
     commands = [
     "pkill -f app.py || echo 'app.py not running'",  
-    "cd /home/ec2-user/ECE326-Lab && nohup python3 app.py > output.log 2>&1 &"  
+    "cd /home/ec2-user/ECE326-Lab && SERVE_WORKERS=$(nproc) nohup python3 app.py > output.log 2>&1 &"  
     ]
     for command in commands:
         stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=False, timeout=5)
@@ -0,0 +1,414 @@
+"""SQLite-backed crawl frontier.
+
+Every URL the crawler discovers gets one row in the Frontier table, holding
+the depth it was found at, its priority and how far along fetching it is.
+The table doubles as the crawler's seen set, and because it lives in the
+crawler's database a crawl that dies can be picked up where it stopped.
+
+Before a URL gets that far it is put in canonical form by normalize_url, and
+a BloomFilter of every URL already known lets the crawler skip the database
+lookup for URLs that are definitely new.
+
+URLs are handed to the fetchers by a HostScheduler, which keeps every host
+to its own politeness limits, including those in its robots.txt, while
+crawling as many hosts at once as it can."""
+import hashlib
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+import urllib3
+
+# status of a URL in the frontier
+QUEUED = 0
+FETCHING = 1
+DONE = 2
+FAILED = 3
+DISALLOWED = 4
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """The canonical form of an absolute url, so that different spellings of
+    the same page are only crawled once: the scheme and host are lowercased,
+    the default port, user info and fragment are dropped, and an empty path
+    becomes "/". Returns None for urls that are not http or https."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+
+    host = parts.hostname
+    if ":" in host:
+        host = "[" + host + "]"
+    try:
+        port = parts.port
+    except ValueError:
+        return None
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        host += ":" + str(port)
+
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, ""))
+
+
+def host_of(url):
+    """The host (and port, if any) of a normalized url, which the frontier
+    keeps a queue for."""
+    return urlsplit(url).netloc
+
+
+class BloomFilter(object):
+    """A compact set of strings that answers "definitely not seen" or "probably
+    seen". Membership tests are wrong for at most about `error_rate` of the
+    strings that were never added.
+
+    The filter starts out sized for `capacity` strings and adds a bigger,
+    slightly stricter slice whenever the current one fills up, so the error
+    rate holds however many strings end up in it."""
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self._slices = []
+        self._count = 0
+        self._add_slice(capacity, error_rate / 2)
+
+    def _add_slice(self, capacity, error_rate):
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        self._slices.append((bytearray((num_bits + 7) // 8), num_bits, num_hashes, capacity, error_rate))
+
+    def _hash(self, key):
+        """Two independent 64 bit hashes of `key`, for double hashing."""
+        digest = hashlib.blake2b(key.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        digest = int.from_bytes(digest, "little")
+        return digest & 0xFFFFFFFFFFFFFFFF, digest >> 64
+
+    def __contains__(self, key):
+        h1, h2 = self._hash(key)
+        for bits, num_bits, num_hashes, _, _ in self._slices:
+            p = h1 % num_bits
+            step = h2 % (num_bits - 1) + 1
+            for _ in range(num_hashes):
+                if not bits[p >> 3] & (1 << (p & 7)):
+                    break
+                p = (p + step) % num_bits
+            else:
+                return True
+        return False
+
+    def add(self, key):
+        """Add `key` to the set."""
+        bits, num_bits, num_hashes, capacity, error_rate = self._slices[-1]
+        if self._count >= capacity:
+            self._add_slice(capacity * 2, error_rate / 2)
+            bits, num_bits, num_hashes, capacity, error_rate = self._slices[-1]
+            self._count = 0
+
+        h1, h2 = self._hash(key)
+        p = h1 % num_bits
+        step = h2 % (num_bits - 1) + 1
+        for _ in range(num_hashes):
+            bits[p >> 3] |= 1 << (p & 7)
+            p = (p + step) % num_bits
+        self._count += 1
+
+    def size_in_bytes(self):
+        return sum(len(bits) for bits, _, _, _, _ in self._slices)
+
+
+class Frontier(object):
+    """The crawl frontier stored in the Frontier table of `db_conn`.
+
+    Nothing here commits: changes become durable with the next commit on the
+    connection, which the crawler issues once per indexed page. A page's
+    postings, its outgoing links and the frontier updates for it are thus
+    checkpointed together."""
+
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        # changes whenever urls are queued again wholesale, and the hosts
+        # that had urls queued since new_hosts was last called, see
+        # HostScheduler
+        self.version = 0
+        self._new_hosts = set()
+
+        # URLs that were being fetched when a previous crawl stopped go back
+        # into the queue
+        with self.db_conn:
+            self.db_conn.execute("UPDATE Frontier SET status = ? WHERE status = ?", (QUEUED, FETCHING))
+
+    def add(self, urls):
+        """Queue (url, depth) pairs, shallowest first. URLs already in the
+        frontier are left alone, except that a queued URL found again at a
+        smaller depth moves up. Returns the hosts that had urls queued or
+        moved up."""
+        by_host = defaultdict(list)
+        for url, depth in urls:
+            host = host_of(url)
+            by_host[host].append((url, host, depth, depth, QUEUED, QUEUED))
+
+        # one statement per host tells which hosts changed
+        cur = self.db_conn.cursor()
+        changed = set()
+        for host, rows in by_host.items():
+            cur.executemany("""
+            INSERT INTO Frontier (url, host, depth, priority, status) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET depth = excluded.depth, priority = excluded.priority
+            WHERE status = ? AND excluded.depth < depth
+            """, rows)
+            if cur.rowcount > 0:
+                changed.add(host)
+        self._new_hosts |= changed
+        return changed
+
+    def new_hosts(self):
+        """The hosts add queued urls of since this was last called."""
+        hosts, self._new_hosts = self._new_hosts, set()
+        return hosts
+
+    def pop(self, n, max_depth):
+        """Take up to `n` queued URLs that are at most `max_depth` deep, in
+        priority order, and mark them as being fetched. Returns (url, depth)
+        pairs."""
+        cur = self.db_conn.cursor()
+        cur.execute("""
+        SELECT url, depth FROM Frontier WHERE status = ? AND depth <= ?
+        ORDER BY priority, rowid LIMIT ?
+        """, (QUEUED, max_depth, n))
+        urls = cur.fetchall()
+        cur.executemany("UPDATE Frontier SET status = ? WHERE url = ?", [(FETCHING, url) for url, _ in urls])
+        return urls
+
+    def pop_host(self, host, n, max_depth):
+        """Like pop, but only takes urls of `host`."""
+        cur = self.db_conn.cursor()
+        cur.execute("""
+        SELECT url, depth FROM Frontier WHERE host = ? AND status = ? AND depth <= ?
+        ORDER BY priority, rowid LIMIT ?
+        """, (host, QUEUED, max_depth, n))
+        urls = cur.fetchall()
+        cur.executemany("UPDATE Frontier SET status = ? WHERE url = ?", [(FETCHING, url) for url, _ in urls])
+        return urls
+
+    def hosts(self, max_depth):
+        """Every host with queued urls that are at most `max_depth` deep."""
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT DISTINCT host FROM Frontier WHERE status = ? AND depth <= ?", (QUEUED, max_depth))
+        return [host for (host,) in cur.fetchall()]
+
+    def finish(self, url, status=DONE):
+        """Record that fetching `url` succeeded or failed."""
+        self.db_conn.execute("UPDATE Frontier SET status = ? WHERE url = ?", (status, url))
+
+    def requeue(self):
+        """Queue every url that was already fetched, or failed to be, again."""
+        self.db_conn.execute("UPDATE Frontier SET status = ? WHERE status IN (?, ?, ?)",
+                             (QUEUED, DONE, FAILED, DISALLOWED))
+        self.version += 1
+
+    def __len__(self):
+        """The number of URLs still waiting to be fetched."""
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM Frontier WHERE status = ?", (QUEUED,))
+        return cur.fetchone()[0]
+
+
+class Disallowed(Exception):
+    """Raised for urls that robots.txt forbids us to fetch."""
+
+
+class RobotsUnavailable(Exception):
+    """Raised for urls of a host whose robots.txt could not be downloaded.
+    It is tried again at `retry_at`, on the clock of the RobotsCache, or if
+    that is None, not before its ttl is up."""
+
+    def __init__(self, url, retry_at):
+        super().__init__(url)
+        self.retry_at = retry_at
+
+
+class RobotsCache(object):
+    """The robots.txt rules of every host, downloaded when the first page of
+    the host is fetched and kept for `ttl` seconds. Shared by the fetcher
+    threads; a host's rules are only ever downloaded by one of them.
+
+    As robots.txt asks, a host whose robots.txt is missing may be crawled
+    freely, and one whose robots.txt the host refuses to serve is not
+    crawled at all. A host that does not answer may only be down for a
+    moment, so its urls raise RobotsUnavailable instead, and its robots.txt
+    is downloaded again after `retry_ttl` seconds, up to `retries` times in
+    a row before it is given the full `ttl`."""
+
+    def __init__(self, user_agent="*", ttl=24 * 3600, retry_ttl=60, retries=3, clock=time.monotonic):
+        self.user_agent = user_agent
+        self._ttl = ttl
+        self._retry_ttl = retry_ttl
+        self._retries = retries
+        self._clock = clock
+        # (rules, when they expire) per host; rules are None while the
+        # host's robots.txt is unavailable
+        self._rules = {}
+        self._failures = defaultdict(int)
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _download(self, pool, scheme, host, timeout):
+        """The rules of `host`, or None if the host did not answer."""
+        rules = RobotFileParser()
+        try:
+            response = pool.request("GET", "%s://%s/robots.txt" % (scheme, host), timeout=timeout, retries=1)
+        except urllib3.exceptions.HTTPError:
+            return None
+
+        if 400 <= response.status < 500:
+            rules.allow_all = True
+        elif response.status >= 300:
+            rules.disallow_all = True
+        else:
+            rules.parse(response.data.decode("utf-8", "replace").splitlines())
+        return rules
+
+    def rules(self, pool, url, timeout):
+        """The RobotFileParser for the host of `url`, downloaded with the
+        urllib3 `pool` if we do not have it yet. Raises RobotsUnavailable if
+        it cannot be downloaded."""
+        parts = urlsplit(url)
+        host = parts.netloc
+        with self._lock:
+            lock = self._locks[host]
+        with lock:
+            rules, expires = self._rules.get(host, (None, 0))
+            if self._clock() >= expires:
+                rules = self._download(pool, parts.scheme, host, timeout)
+                if rules is not None:
+                    self._failures.pop(host, None)
+                    self._rules[host] = rules, self._clock() + self._ttl
+                else:
+                    self._failures[host] += 1
+                    self._rules[host] = None, self._clock() + (self._retry_ttl if self._retrying(host) else
+                                                               self._ttl)
+            if rules is None:
+                raise RobotsUnavailable(url, self.retry_at(host))
+        return rules
+
+    def _retrying(self, host):
+        return 0 < self._failures.get(host, 0) <= self._retries
+
+    def retry_at(self, host):
+        """When the robots.txt of `host`, which could not be downloaded last
+        time, is tried again, or None if it is not being retried."""
+        rules, expires = self._rules.get(host, (None, 0))
+        return expires if host in self._rules and rules is None and self._retrying(host) else None
+
+    def allowed(self, pool, url, timeout):
+        """Whether robots.txt lets us fetch `url`."""
+        return self.rules(pool, url, timeout).can_fetch(self.user_agent, url)
+
+    def known(self, host):
+        """Whether the rules of `host` were downloaded already."""
+        return self._rules.get(host, (None, 0))[0] is not None
+
+    def crawl_delay(self, host):
+        """The Crawl-delay robots.txt asks for on `host`, in seconds, or None
+        if it asks for none or was not downloaded yet."""
+        rules, _ = self._rules.get(host, (None, 0))
+        return rules.crawl_delay(self.user_agent) if rules else None
+
+
+class HostScheduler(object):
+    """Chooses which queued urls of `frontier` are fetched next, keeping one
+    queue per host. At most `per_host` pages of a host are fetched at a
+    time, and fetches from a host start at least `delay` seconds apart, or
+    as far apart as the Crawl-delay of the host's robots.txt in `robots`
+    asks if that is longer. No second page of a host is fetched before its
+    robots.txt is known, and none at all while it is unavailable and waiting
+    to be downloaded again.
+
+    Hosts wait in a heap ordered by when they may next be fetched from, so
+    fetchers are only ever handed urls of hosts that are ready right now."""
+
+    def __init__(self, frontier, robots=None, per_host=2, delay=0.0, clock=time.monotonic):
+        self._frontier = frontier
+        self._robots = robots
+        self._per_host = per_host
+        self._delay = delay
+        self._clock = clock
+
+        # (ready time, host) of every host that is not at its limit
+        self._heap = []
+        self._waiting = set()
+        # fetches in flight, and when the last fetch started, per host
+        self._busy = defaultdict(int)
+        self._started = {}
+        self._version = None
+
+    def _push(self, host):
+        busy = self._busy.get(host, 0)
+        if host in self._waiting or busy >= self._per_host:
+            return
+        if busy and self._robots is not None and not self._robots.known(host):
+            return
+        self._waiting.add(host)
+        heapq.heappush(self._heap, (self._ready_at(host), host))
+
+    def _ready_at(self, host):
+        # the delay is looked up again every time, as the host's robots.txt
+        # may have come in since its last fetch started
+        ready_at = self._started[host] + self._host_delay(host) if host in self._started else 0
+        retry_at = self._robots.retry_at(host) if self._robots is not None else None
+        return max(ready_at, retry_at or 0)
+
+    def _host_delay(self, host):
+        crawl_delay = self._robots.crawl_delay(host) if self._robots is not None else None
+        return max(self._delay, crawl_delay or 0)
+
+    def pop(self, n, max_depth):
+        """Take up to `n` queued (url, depth) pairs at most `max_depth` deep,
+        from hosts that can be fetched from right now."""
+        # only the hosts urls were queued for since the last call can have
+        # anything new, unless the whole frontier was queued again
+        if self._frontier.version != self._version:
+            self._version = self._frontier.version
+            self._frontier.new_hosts()
+            hosts = self._frontier.hosts(max_depth)
+        else:
+            hosts = self._frontier.new_hosts()
+        for host in hosts:
+            self._push(host)
+
+        now = self._clock()
+        urls = []
+        while self._heap and len(urls) < n and self._heap[0][0] <= now:
+            _, host = heapq.heappop(self._heap)
+            self._waiting.discard(host)
+            if self._ready_at(host) > now:
+                # its robots.txt became unavailable since it was pushed
+                self._push(host)
+                continue
+            popped = self._frontier.pop_host(host, 1, max_depth)
+            if not popped:
+                # nothing left to fetch on this host
+                continue
+            urls.extend(popped)
+            self._busy[host] += 1
+            self._started[host] = now
+            self._push(host)
+        return urls
+
+    def done(self, url):
+        """Record that fetching a url handed out by pop finished."""
+        host = host_of(url)
+        self._busy[host] -= 1
+        if not self._busy[host]:
+            del self._busy[host]
+        self._push(host)
+
+    def next_ready(self):
+        """Seconds until the next waiting host can be fetched from, or None if
+        no host is waiting."""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self._clock())
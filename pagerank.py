@@ -0,0 +1,108 @@
+"""Array-backed PageRank over the crawler's link graph.
+
+The graph is loaded from the Links table once into numpy arrays and every
+power iteration is a handful of whole-array operations, so there is no
+per-document Python work inside the loop."""
+import numpy as np
+
+DAMPING_FACTOR = 0.85
+
+
+class LinkGraph(object):
+    """The link graph as arrays over dense node indices 0..n-1.
+
+    doc_ids[i] is the document id of node i, and edge k links node src[k] to
+    node dst[k]. Edges are kept sorted by destination, so the incoming links
+    of each node are contiguous."""
+
+    def __init__(self, links):
+        """Build the graph from an iterable of (from_doc_id, to_doc_id) pairs."""
+        edges = np.array(links, dtype=np.int64).reshape(-1, 2)
+        self.doc_ids, nodes = np.unique(edges, return_inverse=True)
+        nodes = nodes.reshape(-1, 2)
+
+        # sort the edges by destination so incoming links are contiguous
+        order = np.argsort(nodes[:, 1], kind="stable")
+        self.src = nodes[order, 0]
+        self.dst = nodes[order, 1]
+
+        self.out_degree = np.bincount(self.src, minlength=len(self.doc_ids))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def num_edges(self):
+        return len(self.src)
+
+    def index_of(self, doc_ids):
+        """Map document ids to node indices. Returns the indices and a mask of
+        which of the given documents are in the graph at all; indices where
+        the mask is False are meaningless."""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        indices = np.searchsorted(self.doc_ids, doc_ids)
+        found = indices < len(self.doc_ids)
+        found[found] = self.doc_ids[indices[found]] == doc_ids[found]
+        return indices, found
+
+    def downstream(self, nodes, hops):
+        """A mask of the nodes reachable from `nodes` (a mask or an array of
+        indices) by following at most `hops` links."""
+        reached = np.zeros(len(self), dtype=bool)
+        reached[nodes] = True
+        frontier = reached.copy()
+        for _ in range(hops):
+            step = np.zeros(len(self), dtype=bool)
+            step[self.dst[frontier[self.src]]] = True
+            frontier = step & ~reached
+            if not frontier.any():
+                break
+            reached |= frontier
+        return reached
+
+
+def power_iteration(graph, ranks=None, damping=DAMPING_FACTOR, tolerance=1e-6, max_iterations=100, active=None):
+    """Run power iteration on `graph` until the L1 change between two
+    iterations drops below `tolerance`, or for at most `max_iterations`.
+
+    Dangling nodes (pages without outgoing links) spread their rank evenly
+    over every page, so the scores always sum to 1. Iteration starts from
+    `ranks` if given, e.g. the scores of a previous run, otherwise from the
+    uniform distribution. If `active` is a mask of nodes, only those nodes are
+    updated and every other node keeps its starting score. Returns the
+    scores, indexed like graph.doc_ids, and the number of iterations run."""
+    n = len(graph)
+    if n == 0:
+        return np.zeros(0), 0
+
+    if ranks is None:
+        ranks = np.full(n, 1.0 / n)
+    else:
+        ranks = np.asarray(ranks, dtype=np.float64)
+        ranks = ranks / ranks.sum()
+
+    src, dst = graph.src, graph.dst
+    if active is not None:
+        # only the links into active nodes can change anything
+        into_active = active[dst]
+        src, dst = src[into_active], dst[into_active]
+    else:
+        active = slice(None)
+
+    dangling = graph.out_degree == 0
+    # share of a source's rank that flows along each of its edges
+    edge_weight = 1.0 / np.maximum(graph.out_degree, 1)[src]
+    lead = (1.0 - damping) / n
+
+    iterations = 0
+    while iterations < max_iterations:
+        iterations += 1
+        incoming = np.bincount(dst, weights=ranks[src] * edge_weight, minlength=n)
+        new_ranks = ranks.copy()
+        new_ranks[active] = lead + damping * (incoming[active] + ranks[dangling].sum() / n)
+
+        delta = np.abs(new_ranks - ranks).sum()
+        ranks = new_ranks
+        if delta < tolerance:
+            break
+
+    return ranks, iterations
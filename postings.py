@@ -0,0 +1,272 @@
+"""Compressed posting lists.
+
+Each word's postings are kept in one row of the Postings table as three
+parallel BLOBs: the sorted document ids, delta-encoded, and for each of those
+documents the word's term frequency and the largest font size it appeared
+in. All three are packed as varints (7 bits per byte, high bit set on every
+byte but the last of a number). Encoding and decoding work on whole numpy
+arrays at a time.
+
+The crawler first writes new postings to the InvertedIndex table, one row
+per (word_id, doc_id), which is cheap to append to. merge_postings folds
+those rows into the blobs every so often, and readers look at both.
+
+Every function takes the `schema` name the two tables live under, so they
+work the same on index shards attached to a connection, see shards.py."""
+import numpy as np
+
+# most words we look up or update with a single `IN (...)` query;
+# comfortably under SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+SQL_BATCH_SIZE = 500
+
+
+def pack(values):
+    """Pack an array of non-negative integers into varint bytes."""
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b""
+
+    # number of bytes each value needs
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        sizes += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(sizes) - sizes
+
+    out = np.empty(sizes.sum(), dtype=np.uint8)
+    for i in range(sizes.max()):
+        has_byte = sizes > i
+        byte = (values[has_byte] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        byte[sizes[has_byte] > i + 1] |= np.uint64(0x80)
+        out[starts[has_byte] + i] = byte
+    return out.tobytes()
+
+
+def unpack(blob):
+    """Unpack the bytes written by pack into an array of integers."""
+    if not blob:
+        return np.zeros(0, dtype=np.int64)
+    data = np.frombuffer(blob, dtype=np.uint8)
+
+    # the last byte of every varint is the one without the high bit
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # position of every byte within its varint
+    offsets = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    values = (data & 0x7F).astype(np.uint64) << (7 * offsets).astype(np.uint64)
+    return np.add.reduceat(values, starts).astype(np.int64)
+
+
+def encode(doc_ids):
+    """Pack a sorted array of distinct document ids into bytes."""
+    doc_ids = np.asarray(doc_ids, dtype=np.uint64)
+    return pack(np.diff(doc_ids, prepend=np.uint64(0)))
+
+
+def decode(blob):
+    """Unpack the bytes written by encode into a sorted array of document ids."""
+    return np.cumsum(unpack(blob))
+
+
+def _empty():
+    return tuple(np.zeros(0, dtype=np.int64) for _ in range(3))
+
+
+def _unpack_row(doc_ids, tfs, fonts):
+    """The arrays of one Postings row. Rows merged before term frequencies and
+    font sizes were recorded count every word once, in the normal font."""
+    doc_ids = decode(doc_ids)
+    tfs = unpack(tfs) if tfs is not None else np.ones(len(doc_ids), dtype=np.int64)
+    fonts = unpack(fonts) if fonts is not None else np.zeros(len(doc_ids), dtype=np.int64)
+    return doc_ids, tfs, fonts
+
+
+def _pack_row(word_id, doc_ids, tfs, fonts):
+    return word_id, len(doc_ids), encode(doc_ids), pack(tfs), pack(fonts)
+
+
+def _staged(rows):
+    """Posting arrays from (doc_id, tf, font) rows of InvertedIndex."""
+    rows = np.array([(doc_id, 1 if tf is None else tf, font or 0) for doc_id, tf, font in rows],
+                    dtype=np.int64).reshape(-1, 3)
+    return rows[:, 0], rows[:, 1], rows[:, 2]
+
+
+def _combine(old, new):
+    """Merge two sets of posting arrays. Where both have a posting for the
+    same document, the one in `new` wins."""
+    doc_ids, tfs, fonts = (np.concatenate(pair) for pair in zip(old, new))
+    order = np.argsort(doc_ids, kind="stable")
+    doc_ids, tfs, fonts = doc_ids[order], tfs[order], fonts[order]
+
+    # keep the last posting of every document
+    last = np.ones(len(doc_ids), dtype=bool)
+    last[:-1] = doc_ids[:-1] != doc_ids[1:]
+    return doc_ids[last], tfs[last], fonts[last]
+
+
+def add_columns(cur, table, columns, schema="main"):
+    """Add the (name, type) `columns` that `table` was created without, for
+    databases made before they existed. Returns the names of the columns that
+    were added."""
+    cur.execute("PRAGMA %s.table_info(%s)" % (schema, table))
+    existing = {row[1] for row in cur.fetchall()}
+    added = []
+    for column, column_type in columns:
+        if column not in existing:
+            cur.execute("ALTER TABLE %s.%s ADD COLUMN %s %s" % (schema, table, column, column_type))
+            added.append(column)
+    return added
+
+
+def create_tables(cur, schema="main"):
+    """Create the InvertedIndex and Postings tables in the database attached
+    to the connection of `cur` as `schema`, if they do not exist yet, and add
+    the columns that tables made by older crawlers lack. The rows of an old
+    InvertedIndex then read as postings of unknown term frequency and font,
+    see _staged."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS %s.InvertedIndex (
+        word_id INTEGER,
+        doc_id INTEGER,
+        tf INTEGER,
+        font INTEGER,
+        PRIMARY KEY (word_id, doc_id)
+    );
+    """ % schema)
+    # lets a changed page's old postings be removed when it is reindexed
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS %s.inverted_index_doc ON InvertedIndex (doc_id);
+    """ % schema)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS %s.Postings (
+        word_id INTEGER PRIMARY KEY,
+        doc_count INTEGER,
+        doc_ids BLOB,
+        tfs BLOB,
+        fonts BLOB
+    );
+    """ % schema)
+    add_columns(cur, "InvertedIndex", (("tf", "INTEGER"), ("font", "INTEGER")), schema)
+    add_columns(cur, "Postings", (("tfs", "BLOB"), ("fonts", "BLOB")), schema)
+
+
+def read_postings(db_conn, word_id, schema="main"):
+    """The postings of the word `word_id`: the sorted ids of every document
+    containing it, and the word's term frequency and largest font size in
+    each of them, as three arrays."""
+    cur = db_conn.cursor()
+    cur.execute("SELECT doc_ids, tfs, fonts FROM %s.Postings WHERE word_id = ?" % schema, (word_id,))
+    row = cur.fetchone()
+    result = _unpack_row(*row) if row else _empty()
+
+    # postings written since the last merge
+    cur.execute("SELECT doc_id, tf, font FROM %s.InvertedIndex WHERE word_id = ?" % schema, (word_id,))
+    staged = cur.fetchall()
+    if staged:
+        result = _combine(result, _staged(staged))
+    return result
+
+
+def read_doc_ids(db_conn, word_id, schema="main"):
+    """The sorted ids of every document containing the word `word_id`, the
+    first array read_postings returns, without unpacking the term
+    frequencies and font sizes, which search does not score with."""
+    cur = db_conn.cursor()
+    cur.execute("SELECT doc_ids FROM %s.Postings WHERE word_id = ?" % schema, (word_id,))
+    row = cur.fetchone()
+    doc_ids = decode(row[0]) if row else np.zeros(0, dtype=np.int64)
+
+    # postings written since the last merge
+    cur.execute("SELECT doc_id FROM %s.InvertedIndex WHERE word_id = ?" % schema, (word_id,))
+    staged = cur.fetchall()
+    if staged:
+        doc_ids = np.union1d(doc_ids, np.array(staged, dtype=np.int64).reshape(-1))
+    return doc_ids
+
+
+def document_frequencies(db_conn, word_ids, schema="main"):
+    """How many documents contain each of `word_ids`, as the Postings table
+    recorded it at the last merge."""
+    cur = db_conn.cursor()
+    cur.execute("SELECT word_id, doc_count FROM %s.Postings WHERE word_id IN (%s)" %
+                (schema, ",".join("?" * len(word_ids))), list(word_ids))
+    found = dict(cur.fetchall())
+    return [found.get(word_id, 0) for word_id in word_ids]
+
+
+def iter_postings(db_conn, schema="main"):
+    """Every word id in the index, with its postings as read_postings returns
+    them."""
+    cur = db_conn.cursor()
+    cur.execute("SELECT word_id FROM {0}.Postings UNION SELECT word_id FROM {0}.InvertedIndex".format(schema))
+    for (word_id,) in cur.fetchall():
+        yield word_id, read_postings(db_conn, word_id, schema)
+
+
+def add_postings(db_conn, words, batch_size=SQL_BATCH_SIZE, schema="main"):
+    """Fold new postings into the compressed posting lists. `words` is a list
+    of (word_id, (doc_ids, tfs, fonts)) with every word at most once; a new
+    posting replaces the one a document already has. Does not commit."""
+    cur = db_conn.cursor()
+    for i in range(0, len(words), batch_size):
+        batch = words[i:i + batch_size]
+        cur.execute("SELECT word_id, doc_ids, tfs, fonts FROM %s.Postings WHERE word_id IN (%s)" %
+                    (schema, ",".join("?" * len(batch))), [word_id for word_id, _ in batch])
+        existing = {row[0]: _unpack_row(*row[1:]) for row in cur.fetchall()}
+
+        packed = []
+        for word_id, run in batch:
+            if word_id in existing:
+                run = _combine(existing[word_id], run)
+            packed.append(_pack_row(word_id, *run))
+        cur.executemany("INSERT OR REPLACE INTO %s.Postings (word_id, doc_count, doc_ids, tfs, fonts) "
+                        "VALUES (?, ?, ?, ?, ?)" % schema, packed)
+
+
+def merge_postings(db_conn, batch_size=SQL_BATCH_SIZE, schema="main"):
+    """Fold the rows of InvertedIndex into the compressed posting lists and
+    empty it. Does not commit. Returns the number of postings merged."""
+    cur = db_conn.cursor()
+    cur.execute("SELECT word_id, doc_id, tf, font FROM %s.InvertedIndex ORDER BY word_id, doc_id" % schema)
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    staged = _staged(row[1:] for row in rows)
+
+    # split the staged rows into one run of postings per word
+    word_ids, starts = np.unique(np.array([row[0] for row in rows], dtype=np.int64), return_index=True)
+    runs = list(zip(*(np.split(column, starts[1:]) for column in staged)))
+    add_postings(db_conn, list(zip(word_ids.tolist(), runs)), batch_size, schema)
+
+    cur.execute("DELETE FROM %s.InvertedIndex" % schema)
+    return len(rows)
+
+
+def remove_postings(db_conn, doc_id, word_ids, batch_size=SQL_BATCH_SIZE, schema="main"):
+    """Take the document `doc_id` out of the posting lists of `word_ids`, both
+    merged and staged. Does not commit."""
+    cur = db_conn.cursor()
+    cur.execute("DELETE FROM %s.InvertedIndex WHERE doc_id = ?" % schema, (doc_id,))
+
+    word_ids = [int(word_id) for word_id in word_ids]
+    for i in range(0, len(word_ids), batch_size):
+        batch = word_ids[i:i + batch_size]
+        cur.execute("SELECT word_id, doc_ids, tfs, fonts FROM %s.Postings WHERE word_id IN (%s)" %
+                    (schema, ",".join("?" * len(batch))), batch)
+        packed = []
+        emptied = []
+        for row in cur.fetchall():
+            doc_ids, tfs, fonts = _unpack_row(*row[1:])
+            keep = doc_ids != doc_id
+            if keep.any():
+                packed.append(_pack_row(row[0], doc_ids[keep], tfs[keep], fonts[keep]))
+            else:
+                emptied.append((row[0],))
+        cur.executemany("INSERT OR REPLACE INTO %s.Postings (word_id, doc_count, doc_ids, tfs, fonts) "
+                        "VALUES (?, ?, ?, ?, ?)" % schema, packed)
+        cur.executemany("DELETE FROM %s.Postings WHERE word_id = ?" % schema, emptied)
@@ -0,0 +1,121 @@
+"""Serving the frontend from several processes.
+
+bottle.run serves with wsgiref, which answers one request at a time in a
+single process. serve opens the listening socket once and then forks
+`workers` processes, which all accept connections from that socket and
+each answer up to `threads` requests at once. A worker that dies is
+replaced, and stopping the parent stops them all.
+
+Nothing a worker uses may be opened before the fork: the children would
+share it. The QueryEngine of app.py only opens the index on its first
+search, so making it at import time is fine, and every worker then has its
+own connections, or its own map of the serving file, and its own result
+cache. Whatever must be shared between workers, such as sessions, has to
+live outside of them."""
+import os
+import signal
+import socket
+import sys
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+WORKERS = os.cpu_count() or 1
+THREADS = 8
+BACKLOG = 1024
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """A wsgiref server answering up to `threads` requests at once, each in
+    a thread of its own, on a socket that is already listening. While all
+    are busy it accepts no more connections, so other workers take them."""
+
+    daemon_threads = True
+
+    def __init__(self, sock, handler=WSGIRequestHandler, threads=THREADS):
+        super().__init__(sock.getsockname()[:2], handler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        # what server_bind would have done, without binding again
+        host, self.server_port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.setup_environ()
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Does not log every request to stderr, as debug mode does."""
+
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+def listen(host, port):
+    """The socket for every worker to accept connections from. It does not
+    block, so a worker woken for a connection another one accepted first
+    goes back to waiting rather than hang in accept."""
+    sock = socket.create_server((host, port), backlog=BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+def _work(app, sock, threads):
+    server = ThreadingWSGIServer(sock, QuietHandler, threads)
+    server.set_app(app)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve(app, host="0.0.0.0", port=8082, workers=WORKERS, threads=THREADS):
+    """Serve the WSGI `app` on `host`:`port` from `workers` processes of
+    `threads` threads each, until interrupted or terminated."""
+    sock = listen(host, port)
+    if workers <= 1:
+        try:
+            _work(app, sock, threads)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    children = set()
+    # terminating the parent stops the workers as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            while len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    try:
+                        _work(app, sock, threads)
+                    finally:
+                        os._exit(0)
+                children.add(pid)
+            pid, _ = os.wait()
+            children.discard(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
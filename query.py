@@ -0,0 +1,270 @@
+"""Answering search queries for the frontend.
+
+A query costs a fixed number of database round trips however many words it
+has or documents it matches: one to look up all of its words in the
+Lexicon, the bulk search of every shard, see ShardedIndex, and one to fetch
+the url and title of the documents on the page being shown. The rest of
+the matches are kept only as (doc_id, score) pairs, so turning the page
+never searches again.
+
+Those are kept in a ResultCache shared by every user, keyed by the query
+and the generation of the index it was answered from, so popular queries
+are answered without searching at all."""
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from snapshots import Snapshots
+from spelling import SpellingCorrector
+from stopwords import IGNORED_WORDS
+
+# most results a query keeps, across all result pages
+MAX_RESULTS = 1000
+RESULTS_PER_PAGE = 10
+
+# how many queries the result cache holds, and for how many seconds
+CACHE_SIZE = 1024
+CACHE_TTL = 300
+
+# shorter words are left as they are typed, as almost any word is that
+# close to them
+MIN_CORRECTED_LENGTH = 3
+
+# least seconds between spelling correctors built from the crawler's
+# database, which changes with every page indexed
+SPELLING_INTERVAL = 60
+
+
+def query_words(query):
+    """The words of a search query, as they are stored in the Lexicon."""
+    return [word.lower() for word in query.split()]
+
+
+def query_groups(query):
+    """The groups of words of a conjunctive query, see conjunctive.py: every
+    word is a group of its own, except that words joined by OR are one.
+    Words the crawler never indexes are left out, as no document could
+    have them; so is a lowercase or, which is one of them."""
+    groups = []
+    joined = False
+    for token in query.split():
+        word = token.lower()
+        if token == "OR" and groups:
+            joined = True
+        elif word in IGNORED_WORDS:
+            joined = False
+        elif joined:
+            groups[-1].append(word)
+            joined = False
+        else:
+            groups.append([word])
+    return groups
+
+
+def normalize_query(query, conjunctive=False):
+    """The form of `query` results are cached under: queries that only
+    differ in case or spacing have the same results."""
+    if conjunctive:
+        return "AND " + " ".join(" OR ".join(group) for group in query_groups(query))
+    return " ".join(query_words(query))
+
+
+class ResultCache(object):
+    """The results of the `maxsize` queries asked most recently, each for at
+    most `ttl` seconds. Any number of threads can share it.
+
+    Results are held as arrays rather than lists of pairs, which makes them
+    about seven times smaller."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The (total, hits) stored under `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self._clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        _, total, doc_ids, scores = entry
+        return total, list(zip(doc_ids.tolist(), scores.tolist()))
+
+    def put(self, key, total, hits):
+        """Store the (total, hits) search returned under `key`."""
+        doc_ids = np.array([doc_id for doc_id, _ in hits], dtype=np.int64)
+        scores = np.array([score for _, score in hits], dtype=np.float64)
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, total, doc_ids, scores)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """How well the cache is doing, as a dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class QueryEngine(object):
+    """Searches the index published under `root`, or the crawler's database
+    at `fallback` until one is published, see Snapshots. Results are cached
+    in `cache`, a ResultCache, which is emptied whenever a new generation of
+    the index is published. With `mapped`, published generations are
+    searched through their serving file instead of SQLite, see serving.py."""
+
+    def __init__(self, root="index", fallback=None, max_results=MAX_RESULTS, cache=None, mapped=False):
+        self.snapshots = Snapshots(root, fallback, mapped)
+        self.max_results = max_results
+        self.cache = cache if cache is not None else ResultCache()
+        self._version = None
+        # the (version, SpellingCorrector) of the generation it was built
+        # from, and the thread building the next one, if any
+        self._spelling_lock = threading.Lock()
+        self._spelling = None
+        self._spelling_thread = None
+        self._spelling_started = None
+
+    def search(self, query, conjunctive=False):
+        """The best `max_results` documents for `query`, as (doc_id, score)
+        pairs with the best first, and how many documents matched in all.
+        A word that appears twice in the query counts twice.
+
+        A `conjunctive` query only matches documents with all of its words,
+        or one of every group of words joined by OR, see query_groups."""
+        groups = query_groups(query) if conjunctive else [query_words(query)]
+        words = [word for group in groups for word in group]
+        with self.snapshots.current() as generation:
+            version = generation.version()
+            if version != self._version:
+                # nothing cached for an older generation is asked for again
+                self.cache.clear()
+                self._version = version
+            key = (version, normalize_query(query, conjunctive))
+            found = self.cache.get(key)
+            if found is not None:
+                return found
+
+            ids = generation.lookup_words(words)
+            if conjunctive:
+                total, hits = generation.index.search_groups(
+                    [[ids[word] for word in group if word in ids] for group in groups], self.max_results)
+            else:
+                total, hits = generation.index.search([ids[word] for word in words if word in ids],
+                                                      self.max_results)
+        self.cache.put(key, total, hits)
+        return total, hits
+
+    def page(self, hits, page=1, per_page=RESULTS_PER_PAGE):
+        """The (url, title, score) of the documents on page `page` of `hits`,
+        as returned by search. Documents the index no longer has are left
+        out."""
+        hits = hits[(page - 1) * per_page:page * per_page]
+        with self.snapshots.current() as generation:
+            documents = generation.lookup_documents([doc_id for doc_id, _ in hits])
+        return [documents[doc_id] + (score,) for doc_id, score in hits if doc_id in documents]
+
+    def search_page(self, query, page=1, per_page=RESULTS_PER_PAGE, conjunctive=False):
+        """One page of the results of `query`, for the JSON API: a dict of
+        the results, as url, title and score, how many documents matched and
+        how many are kept, and how many milliseconds searching and looking
+        up the page took."""
+        start = time.perf_counter()
+        total, hits = self.search(query, conjunctive)
+        searched = time.perf_counter()
+        results = self.page(hits, page, per_page)
+        done = time.perf_counter()
+        return {
+            "query": query,
+            "page": page,
+            "total": total,
+            "kept": len(hits),
+            "results": [{"url": url, "title": title, "score": score} for url, title, score in results],
+            "timing": {"search_ms": round(1000 * (searched - start), 3), "page_ms": round(1000 * (done - searched), 3),
+                       "total_ms": round(1000 * (done - start), 3)},
+        }
+
+    def correction(self, query):
+        """`query` with every word the index does not have replaced by the
+        closest one it does, see spelling.py. Words the crawler never
+        indexes, and very short ones, are kept.
+
+        The corrector of a generation takes seconds to build, so it is built
+        in the background, see prepare_spelling, and until it is ready the
+        one of the previous generation answers. Before the first one is
+        ready, queries are returned as they are."""
+        corrector = self.prepare_spelling()
+        if corrector is None:
+            return query
+        corrected = []
+        for word in query.split():
+            if word.lower() in IGNORED_WORDS or len(word) < MIN_CORRECTED_LENGTH:
+                corrected.append(word)
+                continue
+            closest = corrector.correction(word.lower())
+            corrected.append(word if closest == word.lower() else closest)
+        return " ".join(corrected)
+
+    def prepare_spelling(self, wait=False):
+        """Start building the spelling corrector of the current generation
+        on a thread of its own, unless it is built or being built already,
+        and return the newest corrector that is ready, or None. With `wait`,
+        first wait for the build to finish.
+
+        The crawler's database changes with every page indexed, so its
+        corrector is rebuilt at most every SPELLING_INTERVAL seconds."""
+        with self.snapshots.current() as generation:
+            version = generation.version()
+            immutable = generation.immutable
+        with self._spelling_lock:
+            stale = self._spelling is None or self._spelling[0] != version
+            due = immutable or self._spelling_started is None or \
+                time.monotonic() - self._spelling_started >= SPELLING_INTERVAL
+            if stale and due and self._spelling_thread is None:
+                self._spelling_started = time.monotonic()
+                self._spelling_thread = threading.Thread(target=self._build_spelling, daemon=True)
+                self._spelling_thread.start()
+            thread = self._spelling_thread
+        if wait and thread is not None:
+            thread.join()
+        with self._spelling_lock:
+            return self._spelling[1] if self._spelling is not None else None
+
+    def _build_spelling(self):
+        try:
+            # the generation stays open while it is read, even if a newer
+            # one is published meanwhile
+            with self.snapshots.current() as generation:
+                version = generation.version()
+                vocabulary = generation.vocabulary()
+            corrector = SpellingCorrector(vocabulary)
+            with self._spelling_lock:
+                self._spelling = (version, corrector)
+        finally:
+            with self._spelling_lock:
+                self._spelling_thread = None
+
+    def close(self):
+        self.snapshots.close()
@@ -0,0 +1,247 @@
+"""A read-only binary index for the frontend to memory-map.
+
+Searching a snapshot through SQLite costs a few statements, and the rows
+they return are turned into Python objects and numpy arrays on every query.
+export instead writes everything search needs into one file, laid out so
+that it can be used in place:
+
+    header    MAGIC, then the (offset, length) of every section in SECTIONS
+    words     every word of the Lexicon, in UTF-8, sorted bytewise
+    word_ends where each word ends in `words`, as uint64
+    post_ends where each word's postings end in `doc_ids`, as uint64
+    doc_ids   every word's sorted document ids one after the other, as uint32
+    ranks     the PageRank of every document, indexed by document id
+    urls      every document's url, in UTF-8, indexed by document id
+    url_ends  where each url ends in `urls`, as uint64
+    titles    and title_ends, the same for titles
+    flags     per document id: PRESENT if it is a document, TITLED if it has
+              a title
+
+MappedIndex maps the file and makes numpy arrays of the sections without
+copying them, so opening it takes no time whatever its size, and worker
+processes mapping the same file share a single copy of it in the page
+cache. Words are found by binary search of the sorted words. A word's
+number in the file takes the place of its Lexicon id."""
+import mmap
+import os
+import sqlite3
+import struct
+from bisect import bisect_left
+import numpy as np
+from conjunctive import search_groups
+from postings import read_doc_ids
+from shards import load_page_ranks, shard_files
+from topk import doc_ranks, top_k
+
+MAGIC = b"ECE326IX"
+
+# the sections of the file in the order they are written, with their type
+SECTIONS = (("words", np.uint8), ("word_ends", np.uint64), ("post_ends", np.uint64), ("doc_ids", np.uint32),
+            ("ranks", np.float64), ("urls", np.uint8), ("url_ends", np.uint64), ("titles", np.uint8),
+            ("title_ends", np.uint64), ("flags", np.uint8))
+HEADER = struct.Struct("<8s%dq" % (2 * len(SECTIONS)))
+
+# bits of the flags section
+PRESENT = 1
+TITLED = 2
+
+# name of the file in a published generation, see snapshots.py
+SERVING_FILE = "serving.idx"
+
+
+def serving_path(db_path):
+    """Where the serving file of the database at `db_path` is exported to."""
+    return os.path.join(os.path.dirname(db_path), SERVING_FILE)
+
+
+class _Writer(object):
+    """Writes the sections of a serving file in order, each aligned to 8 bytes
+    so that its array can be used in place."""
+
+    def __init__(self, f):
+        self._f = f
+        self.sections = []
+        f.write(b"\0" * HEADER.size)
+
+    def begin(self):
+        self._f.write(b"\0" * (-self._f.tell() % 8))
+        self.sections.append([self._f.tell(), 0])
+
+    def write(self, data):
+        data = data.tobytes() if isinstance(data, np.ndarray) else data
+        self._f.write(data)
+        self.sections[-1][1] += len(data)
+
+    def section(self, data):
+        self.begin()
+        self.write(data)
+
+    def strings(self, strings):
+        """A section of `strings` and one of where each of them ends."""
+        encoded = [s.encode() for s in strings]
+        self.section(b"".join(encoded))
+        self.section(np.cumsum([len(s) for s in encoded], dtype=np.uint64))
+
+    def finish(self):
+        self._f.seek(0)
+        self._f.write(HEADER.pack(MAGIC, *(n for section in self.sections for n in section)))
+
+
+def export(db_path, path):
+    """Write the index of the database at `db_path`, and of its shards, to a
+    serving file at `path`. The database should not change meanwhile, as a
+    published snapshot does not. Returns the number of words written."""
+    main = sqlite3.connect(db_path)
+    shards = [sqlite3.connect(shard) for shard in shard_files(main, db_path)] or [main]
+    try:
+        cur = main.cursor()
+        # SQLite compares text bytewise, as MappedIndex does
+        cur.execute("SELECT word, id FROM Lexicon ORDER BY word")
+        words = cur.fetchall()
+        ranks = load_page_ranks(main)
+        cur.execute("SELECT id, url, title FROM DocumentIndex")
+        documents = cur.fetchall()
+
+        with open(path + ".tmp", "wb") as f:
+            out = _Writer(f)
+            out.strings(word for word, _ in words)
+            # where the postings of each word end is only known once they
+            # are written, so that section is filled in afterwards
+            ends = np.zeros(len(words), dtype=np.uint64)
+            out.section(ends)
+            out.begin()
+            for i, (_, word_id) in enumerate(words):
+                found = np.concatenate([read_doc_ids(conn, word_id) for conn in shards])
+                if len(found) and found.max() > np.iinfo(np.uint32).max:
+                    raise ValueError("document id %d does not fit a serving file" % found.max())
+                out.write(np.sort(found).astype(np.uint32))
+                ends[i] = (ends[i - 1] if i else 0) + len(found)
+            f.seek(out.sections[2][0])
+            f.write(ends.tobytes())
+            f.seek(0, os.SEEK_END)
+
+            size = max(len(ranks), max((doc_id for doc_id, _, _ in documents), default=-1) + 1)
+            out.section(np.concatenate([ranks, np.zeros(size - len(ranks))]))
+            urls = [""] * size
+            titles = [""] * size
+            flags = np.zeros(size, dtype=np.uint8)
+            for doc_id, url, title in documents:
+                urls[doc_id] = url or ""
+                titles[doc_id] = title or ""
+                flags[doc_id] = PRESENT | (TITLED if title is not None else 0)
+            out.strings(urls)
+            out.strings(titles)
+            out.section(flags)
+            out.finish()
+        os.replace(path + ".tmp", path)
+    finally:
+        for conn in set(shards + [main]):
+            conn.close()
+    return len(words)
+
+
+class _Strings(object):
+    """The strings of a section and its ends section as a sequence of bytes,
+    for bisect."""
+
+    def __init__(self, data, ends):
+        self._data = data
+        self._ends = ends
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, i):
+        start = int(self._ends[i - 1]) if i else 0
+        return self._data[start:int(self._ends[i])].tobytes()
+
+
+class MappedIndex(object):
+    """A serving file written by export, mapped into memory. It is searched
+    and looked up the way a snapshots.Generation is, so it can stand in for
+    one, and like one it never changes."""
+
+    immutable = True
+
+    def __init__(self, path):
+        self.path = path
+        self._users = 0
+        self._retired = False
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self._map)
+        if header[0] != MAGIC:
+            raise ValueError("%s is not a serving file" % path)
+        sections = {}
+        for i, (name, dtype) in enumerate(SECTIONS):
+            offset, length = header[1 + 2 * i:3 + 2 * i]
+            sections[name] = np.frombuffer(self._map, dtype=dtype, count=length // np.dtype(dtype).itemsize,
+                                           offset=offset)
+        self._sections = sections
+        self._words = _Strings(sections["words"], sections["word_ends"])
+        self._urls = _Strings(sections["urls"], sections["url_ends"])
+        self._titles = _Strings(sections["titles"], sections["title_ends"])
+
+    @property
+    def index(self):
+        return self
+
+    def version(self):
+        return self.path
+
+    def lookup_words(self, words):
+        """The numbers of those of `words` that are in the file, as a dict."""
+        found = {}
+        for word in set(words):
+            encoded = word.encode()
+            i = bisect_left(self._words, encoded)
+            if i < len(self._words) and self._words[i] == encoded:
+                found[word] = i
+        return found
+
+    def lookup_documents(self, doc_ids):
+        """The (url, title) of each of `doc_ids`, as a dict."""
+        flags = self._sections["flags"]
+        found = {}
+        for doc_id in set(doc_ids):
+            if 0 <= doc_id < len(flags) and flags[doc_id] & PRESENT:
+                found[doc_id] = (self._urls[doc_id].decode(),
+                                 self._titles[doc_id].decode() if flags[doc_id] & TITLED else None)
+        return found
+
+    def vocabulary(self):
+        """Every word in the file, with the number of documents containing
+        it, as (word, frequency) pairs."""
+        ends = self._sections["post_ends"]
+        frequencies = np.diff(ends, prepend=np.uint64(0)).tolist()
+        return [(self._words[i].decode(), frequencies[i]) for i in range(len(self._words))]
+
+    def postings(self, word):
+        """The sorted ids of the documents containing the word numbered `word`."""
+        ends = self._sections["post_ends"]
+        start = int(ends[word - 1]) if word else 0
+        return self._sections["doc_ids"][start:int(ends[word])]
+
+    def frequencies(self, words):
+        """How many documents contain each of the words numbered `words`."""
+        ends = self._sections["post_ends"]
+        return [int(ends[word]) - (int(ends[word - 1]) if word else 0) for word in words]
+
+    def search(self, word_ids, k):
+        """What ShardedIndex.search returns, for word numbers from
+        lookup_words."""
+        found = [self.postings(word) for word in word_ids]
+        doc_ids, counts = np.unique(np.concatenate(found or [np.zeros(0, dtype=np.uint32)]), return_counts=True)
+        doc_ids = doc_ids.astype(np.int64)
+        return len(doc_ids), top_k(doc_ids, doc_ranks(self._sections["ranks"], doc_ids) * counts, k)
+
+    def search_groups(self, groups, k):
+        """What ShardedIndex.search_groups returns, for word numbers from
+        lookup_words."""
+        total, top, _ = search_groups(groups, k, self.postings, self.frequencies, self._sections["ranks"])
+        return total, top
+
+    def close(self):
+        # the map can only be closed once no array uses it anymore
+        self._sections = self._words = self._urls = self._titles = None
+        self._map.close()
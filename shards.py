@@ -0,0 +1,203 @@
+"""Document-partitioned index shards.
+
+A single database file caps both how big the index can grow and how many
+queries can read it at once. With more than one shard, the posting lists
+(the InvertedIndex and Postings tables) are split over that many SQLite files
+next to the crawler's database, document d going to shard d % num_shards.
+Everything else, Lexicon, DocumentIndex, Links, PageRank and the frontier,
+stays in the main file, so word and document ids mean the same in every
+shard. The Shards table of the main file lists the shard files.
+
+The crawler attaches every shard to its connection, so a page's postings
+are committed together with everything else about it. Queries open one
+connection per shard and search the shards in parallel, see ShardedIndex."""
+import heapq
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
+import numpy as np
+import postings
+from conjunctive import search_groups
+from postings import document_frequencies, read_doc_ids
+from topk import MAX_TERMS, doc_ranks, has_impact_postings, search_impact, top_k
+
+
+def connect(path, immutable=False):
+    """A connection to the database at `path` that threads can share. An
+    `immutable` connection is read-only and does no locking at all, which is
+    only safe on files nothing writes to anymore, such as published
+    snapshots, see snapshots.py."""
+    if not immutable:
+        return sqlite3.connect(path, check_same_thread=False)
+    return sqlite3.connect("file:%s?immutable=1" % pathname2url(os.path.abspath(path)), uri=True,
+                           check_same_thread=False)
+
+
+def shard_paths(db_path, num_shards):
+    """Where the shards of the database at `db_path` are created."""
+    root, ext = os.path.splitext(db_path)
+    return ["%s.shard%d%s" % (root, i, ext) for i in range(num_shards)]
+
+
+def shard_files(db_conn, db_path):
+    """The paths of the shard files of the database at `db_path`, in shard
+    order, or an empty list if it is not sharded."""
+    cur = db_conn.cursor()
+    try:
+        cur.execute("SELECT path FROM Shards ORDER BY id")
+    except sqlite3.OperationalError:
+        # made before databases could be sharded
+        return []
+    directory = os.path.dirname(db_path)
+    return [os.path.join(directory, path) for (path,) in cur.fetchall()]
+
+
+def attach_shards(db_conn, db_path, num_shards=1):
+    """Attach the shards of the database at `db_path` to `db_conn` as shard0,
+    shard1, and so on, splitting it into `num_shards` shards if it is not
+    sharded yet. A database that is already sharded keeps its shards. Returns
+    the schema names the posting lists are under, in shard order; for a
+    database with a single shard that is just "main"."""
+    paths = shard_files(db_conn, db_path)
+    if paths and num_shards not in (1, len(paths)):
+        raise ValueError("%s has %d shards, not %d" % (db_path, len(paths), num_shards))
+
+    if not paths and num_shards > 1:
+        if num_shards > db_conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED):
+            raise ValueError("SQLite can attach at most %d shards" % db_conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED))
+        cur = db_conn.cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM Postings) OR EXISTS (SELECT 1 FROM InvertedIndex)")
+        if cur.fetchone()[0]:
+            raise ValueError("%s already has postings and cannot be sharded" % db_path)
+        paths = shard_paths(db_path, num_shards)
+        with db_conn:
+            db_conn.executemany("INSERT INTO Shards (id, path) VALUES (?, ?)",
+                                [(i, os.path.basename(path)) for i, path in enumerate(paths)])
+
+    if not paths:
+        return ["main"]
+    cur = db_conn.cursor()
+    schemas = []
+    for i, path in enumerate(paths):
+        schema = "shard%d" % i
+        cur.execute("ATTACH DATABASE ? AS %s" % schema, (path,))
+        postings.create_tables(cur, schema)
+        schemas.append(schema)
+    db_conn.commit()
+    return schemas
+
+
+def load_page_ranks(db_conn):
+    """The PageRank of every document as an array indexed by document id, 0
+    for documents that have none."""
+    cur = db_conn.cursor()
+    cur.execute("SELECT doc_id, score FROM PageRank")
+    rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 2)
+    doc_ids = rows[:, 0].astype(np.int64)
+    ranks = np.zeros(doc_ids.max() + 1 if len(doc_ids) else 0)
+    ranks[doc_ids] = rows[:, 1]
+    return ranks
+
+
+def search_shard(db_conn, word_ids, k, ranks):
+    """The part of ShardedIndex.search for the one shard on `db_conn`, with
+    `ranks` from load_page_ranks, reading every posting of `word_ids`. Also
+    returns how many postings were read."""
+    found = [read_doc_ids(db_conn, word_id) for word_id in word_ids]
+    doc_ids, counts = np.unique(np.concatenate(found or [np.zeros(0, dtype=np.int64)]), return_counts=True)
+    return len(doc_ids), top_k(doc_ids, doc_ranks(ranks, doc_ids) * counts, k), sum(len(ids) for ids in found)
+
+
+def search_shard_groups(db_conn, groups, k, ranks):
+    """The part of ShardedIndex.search_groups for the one shard on `db_conn`,
+    see conjunctive.py."""
+    return search_groups(groups, k, lambda word_id: read_doc_ids(db_conn, word_id),
+                         lambda word_ids: document_frequencies(db_conn, word_ids), ranks)
+
+
+class ShardedIndex(object):
+    """Searches the index of the database at `db_path` with one connection
+    and one thread per shard, so that the shards are read in parallel.
+
+    PageRank scores are kept in memory and reloaded whenever the database
+    was changed since they were last read. An `immutable` index is opened
+    without locking, see connect. Any other is the crawler's own database,
+    which may have been made by an older crawler, so its posting tables are
+    brought up to date first, see postings.create_tables."""
+
+    def __init__(self, db_path, immutable=False):
+        self._main = connect(db_path, immutable)
+        self._shards = [connect(path, immutable) for path in shard_files(self._main, db_path)] or [self._main]
+        if not immutable:
+            for conn in self._shards:
+                with conn:
+                    postings.create_tables(conn.cursor())
+        # published snapshots have impact-ordered posting lists, see topk.py
+        self._impact = [has_impact_postings(conn) for conn in self._shards]
+        self._pool = ThreadPoolExecutor(max_workers=len(self._shards))
+        self._ranks = None
+        self._version = None
+
+    def __len__(self):
+        return len(self._shards)
+
+    def _page_ranks(self):
+        # data_version changes whenever another connection commits
+        cur = self._main.cursor()
+        cur.execute("PRAGMA data_version")
+        version = cur.fetchone()[0]
+        if version != self._version:
+            self._ranks = load_page_ranks(self._main)
+            self._version = version
+        return self._ranks
+
+    def search(self, word_ids, k):
+        """The `k` best documents containing any of `word_ids`, as (doc_id,
+        score) pairs with the best first, and how many documents matched in
+        all. A document scores its PageRank once for every one of `word_ids`
+        it contains. Every shard finds its own k best documents, and those
+        are merged.
+
+        Shards with impact-ordered posting lists stop reading them as soon as
+        their top k is certain, see topk.py; the number of matches is then
+        only a lower bound."""
+        ranks = self._page_ranks()
+        futures = []
+        for conn, impact in zip(self._shards, self._impact):
+            early = impact and 0 < len(set(word_ids)) <= MAX_TERMS
+            futures.append(self._pool.submit(search_impact if early else search_shard, conn, word_ids, k, ranks))
+        return self._merge(futures, k)
+
+    def search_groups(self, groups, k):
+        """Like search, but only for documents containing a word of every one
+        of `groups`, lists of word ids, see conjunctive.py."""
+        ranks = self._page_ranks()
+        return self._merge([self._pool.submit(search_shard_groups, conn, groups, k, ranks) for conn in self._shards],
+                           k)
+
+    def document_frequencies(self):
+        """How many documents contain each word, as a dict by word id, see
+        document_frequencies."""
+        found = {}
+        for conn in self._shards:
+            cur = conn.cursor()
+            cur.execute("SELECT word_id, doc_count FROM Postings")
+            for word_id, count in cur.fetchall():
+                found[word_id] = found.get(word_id, 0) + count
+        return found
+
+    @staticmethod
+    def _merge(futures, k):
+        total = 0
+        hits = []
+        for future in futures:
+            count, top, _ = future.result()
+            total += count
+            hits.extend(top)
+        return total, heapq.nsmallest(k, hits, key=lambda hit: (-hit[1], hit[0]))
+
+    def close(self):
+        self._pool.shutdown()
+        for conn in set(self._shards + [self._main]):
+            conn.close()
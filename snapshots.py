@@ -0,0 +1,236 @@
+"""Publishing the index to the frontend as immutable snapshots.
+
+The crawler commits to its database page by page, so a frontend reading the
+same file sees half-built posting lists and competes with the crawler for
+its locks. Instead, the crawler publishes a copy of the whole index, main
+file and shards, as a new generation: a numbered directory under a
+snapshot root, such as index/7/. The copy is made with SQLite's online
+backup, so it is consistent, in a temporary directory that is renamed into
+place once complete. Then the CURRENT file in the root is atomically
+replaced to name the main file of the new generation.
+
+A published generation is never written to again, so the frontend opens it
+immutable, without any locking. Snapshots notices when CURRENT changes and
+moves new searches to the new generation, while searches already running
+finish on the one they started on. A generation is closed once nothing
+uses it anymore, and publishing deletes all but the newest few."""
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from shards import ShardedIndex, connect, load_page_ranks, shard_files
+from serving import MappedIndex, export, serving_path
+from topk import build_impact_postings
+
+CURRENT = "CURRENT"
+
+
+def lookup_words(db_conn, words):
+    """The Lexicon ids of those of `words` that are in it, as a dict."""
+    words = sorted(set(words))
+    if not words:
+        return {}
+    cur = db_conn.cursor()
+    cur.execute("SELECT word, id FROM Lexicon WHERE word IN (%s)" % ",".join("?" * len(words)), words)
+    return dict(cur.fetchall())
+
+
+def lookup_documents(db_conn, doc_ids):
+    """The (url, title) of each of `doc_ids`, as a dict."""
+    doc_ids = sorted(set(doc_ids))
+    if not doc_ids:
+        return {}
+    cur = db_conn.cursor()
+    cur.execute("SELECT id, url, title FROM DocumentIndex WHERE id IN (%s)" % ",".join("?" * len(doc_ids)),
+                doc_ids)
+    return {doc_id: (url, title) for doc_id, url, title in cur.fetchall()}
+
+
+def generations(root):
+    """The numbers of the generations published under `root`, oldest first."""
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def current_database(root):
+    """The main file of the current generation under `root`, as CURRENT
+    names it, or None if nothing was published there yet."""
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            return os.path.join(root, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def publish(db_conn, db_path, root, keep=2):
+    """Copy the database at `db_path`, open as `db_conn`, and its attached
+    shards into a new generation under `root` and make it the current one.
+    The newest `keep` generations are kept, older ones are deleted. Returns
+    the directory of the new generation."""
+    os.makedirs(root, exist_ok=True)
+    generation = str((generations(root) or [0])[-1] + 1)
+    building = os.path.join(root, generation + ".tmp")
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+
+    # the shards are attached as shard0, shard1 and so on, see
+    # attach_shards, and every one keeps its file name, so the Shards table
+    # stays right
+    copies = [("main", db_path)] + [("shard%d" % i, path) for i, path in enumerate(shard_files(db_conn, db_path))]
+    for schema, path in copies:
+        target = sqlite3.connect(os.path.join(building, os.path.basename(path)))
+        db_conn.backup(target, name=schema)
+        target.close()
+
+    # the PageRank scores of a snapshot never change, so its posting lists
+    # can be ordered by them, see topk.py
+    main_path = os.path.join(building, os.path.basename(db_path))
+    main = sqlite3.connect(main_path)
+    ranks = load_page_ranks(main)
+    main.close()
+    for _, path in copies[1:] or copies:
+        target = sqlite3.connect(os.path.join(building, os.path.basename(path)))
+        with target:
+            build_impact_postings(target, ranks)
+        target.close()
+    # and the frontend can serve it from a single mapped file, see serving.py
+    export(main_path, serving_path(main_path))
+
+    directory = os.path.join(root, generation)
+    os.rename(building, directory)
+    with open(os.path.join(root, CURRENT + ".tmp"), "w") as f:
+        f.write(os.path.join(generation, os.path.basename(db_path)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(os.path.join(root, CURRENT + ".tmp"), os.path.join(root, CURRENT))
+
+    # readers that still have an old generation open keep reading it, as
+    # removing a file does not take it away from whoever has it open
+    for old in generations(root)[:-keep]:
+        shutil.rmtree(os.path.join(root, str(old)), ignore_errors=True)
+    return directory
+
+
+class Generation(object):
+    """One generation of the index, opened for searching: `index` is its
+    ShardedIndex and `db_conn` a connection to its main file, for looking up
+    words and documents."""
+
+    def __init__(self, db_path, immutable=True):
+        self.path = db_path
+        self.immutable = immutable
+        self.index = ShardedIndex(db_path, immutable)
+        self.db_conn = connect(db_path, immutable)
+        self.db_conn.row_factory = sqlite3.Row
+        self._users = 0
+        self._retired = False
+
+    def version(self):
+        """Changes whenever what the generation holds does: a published one
+        never changes, while the crawler's database does with every commit."""
+        if self.immutable:
+            return self.path
+        cur = self.db_conn.cursor()
+        cur.execute("PRAGMA data_version")
+        return self.path, cur.fetchone()[0]
+
+    def lookup_words(self, words):
+        return lookup_words(self.db_conn, words)
+
+    def lookup_documents(self, doc_ids):
+        return lookup_documents(self.db_conn, doc_ids)
+
+    def vocabulary(self):
+        """Every word of the Lexicon, with the number of documents containing
+        it, as (word, frequency) pairs."""
+        frequencies = self.index.document_frequencies()
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT id, word FROM Lexicon")
+        return [(word, frequencies.get(word_id, 0)) for word_id, word in cur.fetchall()]
+
+    def close(self):
+        self.index.close()
+        self.db_conn.close()
+
+
+class Snapshots(object):
+    """The current generation of the index published under `root`, for any
+    number of threads to search. Until something is published there, the
+    crawler's database at `fallback` is searched directly. With `mapped`,
+    generations are searched through their serving file, see serving.py,
+    where they have one.
+
+    Whether a new generation was published is checked every time a search
+    starts, which costs a stat of the CURRENT file."""
+
+    def __init__(self, root, fallback=None, mapped=False):
+        self._root = root
+        self._fallback = fallback
+        self._mapped = mapped
+        self._lock = threading.Lock()
+        self._stat = None
+        self._generation = None
+
+    def _current_stat(self):
+        try:
+            stat = os.stat(os.path.join(self._root, CURRENT))
+        except FileNotFoundError:
+            return None
+        # CURRENT is replaced, never written in place
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _open(self):
+        db_path = current_database(self._root)
+        if db_path is not None:
+            if self._mapped and os.path.exists(serving_path(db_path)):
+                return MappedIndex(serving_path(db_path))
+            return Generation(db_path)
+        if self._fallback is not None:
+            return Generation(self._fallback, immutable=False)
+        return None
+
+    def acquire(self):
+        """The current generation, switching to a newly published one first.
+        It stays open until it is released again."""
+        with self._lock:
+            stat = self._current_stat()
+            if self._generation is None or stat != self._stat:
+                self._stat = stat
+                old, self._generation = self._generation, self._open()
+                if old is not None:
+                    self._retire(old)
+            if self._generation is None:
+                raise FileNotFoundError("nothing was published under %s" % self._root)
+            self._generation._users += 1
+            return self._generation
+
+    def release(self, generation):
+        """Done searching `generation`, as returned by acquire."""
+        with self._lock:
+            generation._users -= 1
+            if generation._retired and not generation._users:
+                generation.close()
+
+    def _retire(self, generation):
+        generation._retired = True
+        if not generation._users:
+            generation.close()
+
+    @contextmanager
+    def current(self):
+        """acquire and release around a `with` block."""
+        generation = self.acquire()
+        try:
+            yield generation
+        finally:
+            self.release(generation)
+
+    def close(self):
+        with self._lock:
+            if self._generation is not None:
+                self._retire(self._generation)
+                self._generation = None
@@ -0,0 +1,126 @@
+"""Spelling correction from the words of the index.
+
+A general English dictionary knows nothing of the names and jargon of the
+pages crawled, and generating every edit of a query word to look it up costs
+milliseconds a word. SpellingCorrector instead follows SymSpell: every word
+of the Lexicon is indexed up front under each string that deleting up to
+`max_distance` of its first `prefix_length` letters makes. A query word's
+candidates are then the words indexed under one of its own few deletes, and
+the closest of those by edit distance wins, the one found in the most
+documents if several are as close.
+
+Words already in the Lexicon are never corrected, and corrections are
+memoized, so correcting the words of a query usually costs a dict lookup
+each. Indexing the first `prefix_length` letters only keeps the number of
+deletes of long words down, and so the memory the index takes."""
+from functools import lru_cache
+
+MAX_DISTANCE = 2
+PREFIX_LENGTH = 7
+CACHE_SIZE = 10000
+
+
+def deletes(word, distance):
+    """Every string made by deleting at most `distance` letters of `word`,
+    `word` itself included."""
+    found = {word}
+    edges = {word}
+    for _ in range(distance):
+        edges = {edge[:i] + edge[i + 1:] for edge in edges for i in range(len(edge))} - found
+        found |= edges
+    return found
+
+
+def edit_distance(a, b, limit):
+    """The number of insertions, deletions, substitutions and swaps of
+    adjacent letters that turn `a` into `b`, or `limit` + 1 if more than
+    `limit` are needed."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # the letters both start and end with cost nothing
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < min(len(a), len(b)) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+    if not a or not b:
+        return max(len(a), len(b))
+    two_back = None
+    one_back = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(one_back[j] + 1, row[j - 1] + 1, one_back[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], two_back[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+        two_back, one_back = one_back, row
+    return one_back[-1] if one_back[-1] <= limit else limit + 1
+
+
+class SpellingCorrector(object):
+    """Corrects words to the closest of the (word, frequency) pairs of
+    `vocabulary`, such as Generation.vocabulary returns. At most
+    `cache_size` corrections are memoized."""
+
+    def __init__(self, vocabulary, max_distance=MAX_DISTANCE, prefix_length=PREFIX_LENGTH, cache_size=CACHE_SIZE):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self._frequencies = {}
+        self._deletes = {}
+        for word, frequency in vocabulary:
+            self._frequencies[word] = frequency
+            for delete in deletes(word[:prefix_length], max_distance):
+                self._deletes.setdefault(delete, []).append(word)
+        self._closest = lru_cache(maxsize=cache_size)(self._closest)
+
+    def __len__(self):
+        return len(self._frequencies)
+
+    def __contains__(self, word):
+        return word in self._frequencies
+
+    def correction(self, word):
+        """The word of the vocabulary closest to `word`, or `word` itself if
+        it is in the vocabulary or nothing is close enough."""
+        if word in self._frequencies:
+            return word
+        return self._closest(word)
+
+    def cache_info(self):
+        """How the memoized corrections are doing, see functools.lru_cache."""
+        return self._closest.cache_info()
+
+    def _closest(self, word):
+        # a word within distance d of `word` shares with it a string both
+        # make by deleting at most d letters, so once a word at distance d is
+        # found, deletes of more than d letters cannot find a closer one
+        best = None
+        limit = self.max_distance
+        prefix = word[:self.prefix_length]
+        seen = set()
+        level = {prefix}
+        visited = set(level)
+        for deleted in range(self.max_distance + 1):
+            if best is not None and deleted > best[0]:
+                break
+            for delete in level:
+                for candidate in self._deletes.get(delete, ()):
+                    # nor can words that reach the same string by deleting
+                    # more letters than that
+                    if candidate in seen or min(len(candidate), self.prefix_length) - len(delete) > limit:
+                        continue
+                    seen.add(candidate)
+                    distance = edit_distance(word, candidate, limit)
+                    if distance <= limit:
+                        key = (distance, -self._frequencies[candidate], candidate)
+                        if best is None or key < best:
+                            best = key
+                            limit = distance
+            level = {delete[:i] + delete[i + 1:] for delete in level for i in range(len(delete))} - visited
+            visited |= level
+        return best[2] if best is not None else word
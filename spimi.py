@@ -0,0 +1,175 @@
+"""Building posting lists in bounded memory.
+
+Indexing a large corpus through the InvertedIndex table costs a row per
+posting, and merging them means holding all of them at once. An
+IndexBuilder instead collects the postings of the pages indexed in one
+build in memory, single-pass in-memory indexing (SPIMI) style, in flat
+numpy arrays. Whenever those take up a third of the memory budget they are
+sorted by word and document and spilled to a temporary file as a run: one
+block of postings per word, in word order. The third leaves room for the
+copies sorting makes.
+
+merge then k-way merges all runs with heapq.merge, reading a single word's
+block from every run at a time, and folds each word's postings into the
+Postings table of the shard its documents belong to. So however large the
+corpus, the postings held in memory are bounded by the budget plus the
+posting lists of one word.
+
+A document indexed again within the same build leaves a tombstone (tf 0)
+for each of its old words, so words it no longer contains do not come
+back when the runs are merged."""
+import heapq
+import struct
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
+from postings import SQL_BATCH_SIZE, add_postings
+
+# a block of a run: the word id and how many postings follow, each of them
+# (doc_id, tf, font) as int64
+BLOCK_HEADER = struct.Struct("<qq")
+
+# rough per-document cost of the small arrays and tuples kept for it
+DOCUMENT_OVERHEAD = 512
+
+
+class IndexBuilder(object):
+    """Collects postings in at most `memory_budget` bytes, spilling them to
+    temporary files in `directory` (the system default if None), until
+    merge writes them to the database.
+
+    The content hash of every page is held back until then as well, see
+    hashes, so a build that dies before merging leaves its pages looking
+    never indexed and they are indexed again the next time."""
+
+    def __init__(self, memory_budget=64 * 2 ** 20, directory=None):
+        self.memory_budget = memory_budget
+        self._directory = directory
+        self._chunks = []
+        self._hashes = []
+        self._size = 0
+        self._runs = []
+        self._hash_file = None
+
+    def __len__(self):
+        """The number of runs spilled so far."""
+        return len(self._runs)
+
+    def add(self, doc_id, word_ids, tfs, fonts, content_hash=None):
+        """Add the postings of the document `doc_id`: its words, with the term
+        frequency and font size of each."""
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        columns = (word_ids, np.full(len(word_ids), doc_id, dtype=np.int64),
+                   np.asarray(tfs, dtype=np.int64), np.asarray(fonts, dtype=np.int64))
+        self._chunks.append(columns)
+        self._size += 4 * word_ids.nbytes + DOCUMENT_OVERHEAD
+        if content_hash is not None:
+            self._hashes.append((doc_id, content_hash))
+        if 3 * self._size > self.memory_budget:
+            self._spill()
+
+    def remove(self, doc_id, word_ids):
+        """Drop the postings added for `doc_id` in this build from the posting
+        lists of `word_ids`."""
+        zeros = np.zeros(len(word_ids), dtype=np.int64)
+        self.add(doc_id, word_ids, zeros, zeros)
+
+    def _spill(self):
+        if not self._chunks:
+            return
+        word_ids, doc_ids, tfs, fonts = (np.concatenate(column) for column in zip(*self._chunks))
+        self._chunks = []
+        self._size = 0
+
+        # the sort is stable, so of two postings of a word and document the
+        # last one added comes last, and that is the one kept
+        order = np.lexsort((doc_ids, word_ids))
+        word_ids = word_ids[order]
+        rows = np.stack([doc_ids[order], tfs[order], fonts[order]], axis=1)
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = (word_ids[:-1] != word_ids[1:]) | (rows[:-1, 0] != rows[1:, 0])
+        word_ids, rows = word_ids[last], rows[last]
+
+        run = tempfile.TemporaryFile(dir=self._directory)
+        words, starts, counts = np.unique(word_ids, return_index=True, return_counts=True)
+        for word_id, start, count in zip(words.tolist(), starts.tolist(), counts.tolist()):
+            run.write(BLOCK_HEADER.pack(word_id, count))
+            run.write(rows[start:start + count].tobytes())
+        self._runs.append(run)
+
+        if self._hashes:
+            if self._hash_file is None:
+                self._hash_file = tempfile.TemporaryFile("w+", dir=self._directory)
+            self._hash_file.writelines("%d %s\n" % pair for pair in self._hashes)
+            self._hashes = []
+
+    @staticmethod
+    def _read_run(run):
+        """The (word_id, rows) blocks of a run, one at a time."""
+        run.seek(0)
+        while True:
+            header = run.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            word_id, count = BLOCK_HEADER.unpack(header)
+            yield word_id, np.frombuffer(run.read(24 * count), dtype=np.int64).reshape(count, 3)
+
+    def merge(self, db_conn, schemas=("main",), batch_size=SQL_BATCH_SIZE):
+        """Merge every run into the Postings tables under `schemas`, document
+        d going to schemas[d % len(schemas)]. Does not commit. Returns the
+        number of postings merged."""
+        self._spill()
+        pending = [[] for _ in schemas]
+        sizes = [0 for _ in schemas]
+        merged = 0
+
+        # runs were spilled in order, and heapq.merge keeps that order among
+        # blocks of the same word
+        blocks = heapq.merge(*(self._read_run(run) for run in self._runs), key=itemgetter(0))
+        for word_id, group in groupby(blocks, key=itemgetter(0)):
+            rows = np.concatenate([rows for _, rows in group])
+            rows = rows[np.argsort(rows[:, 0], kind="stable")]
+            last = np.ones(len(rows), dtype=bool)
+            last[:-1] = rows[:-1, 0] != rows[1:, 0]
+            rows = rows[last & (rows[:, 1] > 0)]
+            merged += len(rows)
+
+            shards = rows[:, 0] % len(schemas)
+            for shard, words in enumerate(pending):
+                found = rows[shards == shard]
+                if len(found):
+                    words.append((word_id, (found[:, 0], found[:, 1], found[:, 2])))
+                    sizes[shard] += found.nbytes
+                # a batch of common words can be large, so batches are
+                # bounded by the budget as well
+                if len(words) >= batch_size or 3 * sizes[shard] > self.memory_budget:
+                    add_postings(db_conn, words, batch_size, schemas[shard])
+                    words.clear()
+                    sizes[shard] = 0
+
+        for schema, words in zip(schemas, pending):
+            add_postings(db_conn, words, batch_size, schema)
+        return merged
+
+    def hashes(self):
+        """The (doc_id, content_hash) pairs of the documents added, in the
+        order they were added."""
+        if self._hash_file is not None:
+            self._hash_file.seek(0)
+            for line in self._hash_file:
+                doc_id, content_hash = line.split()
+                yield int(doc_id), content_hash
+        yield from self._hashes
+
+    def close(self):
+        """Delete the runs, merged or not, and start over empty."""
+        for run in self._runs:
+            run.close()
+        if self._hash_file is not None:
+            self._hash_file.close()
+        self._chunks = []
+        self._hashes = []
+        self._size = 0
+        self._runs = []
+        self._hash_file = None
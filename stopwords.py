@@ -0,0 +1,10 @@
+"""The words the crawler never indexes.
+
+They are never in the Lexicon, so the frontend has to know them too, so
+that it neither takes them for misspellings nor requires them in
+conjunctive queries. This module is shared by both and imports nothing,
+so the frontend does not load the crawler to get them."""
+
+IGNORED_WORDS = frozenset({'', 'the', 'of', 'at', 'on', 'in', 'is', 'it', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i',
+                           'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z', 'and',
+                           'or'})
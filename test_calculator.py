@@ -0,0 +1,41 @@
+import unittest
+import time
+from calculator import CalculatorError, calculate, evaluate, looks_like_math
+
+
+class TestCalculator(unittest.TestCase):
+    def test_arithmetic(self):
+        """Test if arithmetic queries are computed as Python would."""
+        for expression in ("1 + 2", "2 * (3 + 4)", "7 / 2", "7 // 2", "-7 % 3", "2 ** 10", "2 ** -1", "1.5 * 4",
+                           "-(3 - 5)", " 10 - 2 - 3 ", "((1))+2", "2 ** 0.5", "3 * -2"):
+            self.assertEqual(calculate(expression), eval(expression), expression)
+
+    def test_not_arithmetic(self):
+        """Test if searches, single numbers and broken expressions are left alone."""
+        for query in ("apple pie", "42", "-5", "1 2", "1 +", "(1 + 2", "__import__('os')", "1 + x", "1e5 + 1",
+                      "a * b", "2 ** 3 and 1", "", "1 / 0", "(-8) ** 0.5", "3 @ 4"):
+            self.assertIsNone(calculate(query), query)
+        self.assertFalse(looks_like_math("ece326 lab 3"))
+        self.assertTrue(looks_like_math("(1 + 2) * 3"))
+        with self.assertRaises(CalculatorError):
+            evaluate("[1] * 3")
+        with self.assertRaises(CalculatorError):
+            evaluate("'a' * 3")
+        with self.assertRaises(ZeroDivisionError):
+            evaluate("1 % 0")
+
+    def test_bounded(self):
+        """Test if expressions that would take long to compute are refused before they are."""
+        start = time.monotonic()
+        for expression in ("9 ** 9 ** 9", "2 ** 100000", "10 ** 999 * 10 ** 999 * 10 ** 999 * 10 ** 999 * 10 ** 999",
+                           "+".join(["1"] * 150), "1.0001 ** 100000", "(2 ** 1000) ** 1000"):
+            with self.assertRaises(CalculatorError, msg=expression):
+                evaluate(expression)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual(evaluate("2 ** 1000"), 2 ** 1000)
+        self.assertIsNone(calculate("9**9**9"))
+        self.assertIsNone(calculate("1" + "+1" * 200))
+
+
+if __name__ == "__main__":
+    unittest.main()
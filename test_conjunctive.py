@@ -0,0 +1,70 @@
+import unittest
+import numpy as np
+from conjunctive import contains, intersect, search_groups
+
+
+class TestSearchGroups(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        # word w is in about 1 of every w documents, word 50 in none
+        self.lists = {word_id: np.flatnonzero(rng.random(3000) < 1.0 / word_id) for word_id in range(1, 50)}
+        self.lists[50] = np.zeros(0, dtype=np.int64)
+        self.ranks = np.round(rng.random(3000), 2)
+        self.read = []
+
+    def postings(self, word_id):
+        self.read.append(word_id)
+        return self.lists[word_id]
+
+    def frequencies(self, word_ids):
+        return [len(self.lists[word_id]) for word_id in word_ids]
+
+    def search(self, groups, k=20):
+        return search_groups(groups, k, self.postings, self.frequencies, self.ranks)
+
+    def expected(self, groups, k=20):
+        """Every document checked against every group."""
+        words = [word_id for group in groups for word_id in group]
+        hits = []
+        for doc_id in range(3000):
+            if all(any(doc_id in self.lists[word_id] for word_id in group) for group in groups):
+                count = sum(doc_id in self.lists[word_id] for word_id in words)
+                hits.append((doc_id, self.ranks[doc_id] * count))
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return len(hits), hits[:k]
+
+    def test_same_as_checking_every_document(self):
+        """Test if intersecting rarest first finds the documents that match every group, scored as in OR queries."""
+        for groups in ([[1]], [[1], [2]], [[2], [3], [3]], [[1], [3, 4]], [[5, 7], [2, 9]], [[1, 1], [1]],
+                       [[4], [6], [8]], [[1], [50]], [[1, 50]]):
+            total, top, _ = self.search(groups)
+            expected_total, expected_top = self.expected(groups)
+            self.assertEqual(total, expected_total, groups)
+            self.assertEqual([doc_id for doc_id, _ in top], [doc_id for doc_id, _ in expected_top], groups)
+            np.testing.assert_allclose([score for _, score in top], [score for _, score in expected_top])
+        self.assertEqual(self.search([]), (0, [], 0))
+        self.assertEqual(self.search([[1], []]), (0, [], 0))
+
+    def test_rarest_first(self):
+        """Test if groups are read rarest first and reading stops once nothing matches."""
+        _, _, read = self.search([[1], [2], [50]])
+        self.assertEqual(self.read, [50])
+        self.assertEqual(read, 0)
+
+        self.read = []
+        self.search([[1], [2, 3], [40]])
+        self.assertEqual(self.read[0], 40)
+        self.assertEqual(self.read[-1], 1)
+
+    def test_intersect(self):
+        """Test if intersecting looks up either side in the other, whatever their integer types."""
+        a = np.array([1, 4, 9, 12, 30], dtype=np.int64)
+        b = np.array([0, 4, 5, 12, 13, 29, 30, 31], dtype=np.uint32)
+        self.assertEqual(intersect(a, b).tolist(), [4, 12, 30])
+        self.assertEqual(intersect(b, a).tolist(), [4, 12, 30])
+        self.assertEqual(contains(a, b).tolist(), [False, True, False, True, True])
+        self.assertEqual(contains(a, b[:0]).tolist(), [False] * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
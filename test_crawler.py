@@ -1,7 +1,117 @@
 import unittest
+import unittest.mock
+import functools
 import os
 import sqlite3
+import threading
+import zlib
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from crawler import crawler
+from frontier import RobotsCache, DISALLOWED, DONE, QUEUED
+
+# a tiny site for crawl tests: / -> /a, /b; /a -> /c; /c -> /d
+TEST_SITE = {
+    "/": "<html><head><title>Home</title></head><body>home <a href='/a'>a</a> <a href='/b'>b</a></body></html>",
+    "/a": "<html><body>alpha <a href='/c'>c</a> <a href='/'>home</a></body></html>",
+    "/b": "<html><body>beta</body></html>",
+    "/c": "<html><body>gamma <a href='/d'>d</a></body></html>",
+    "/d": "<html><body>delta</body></html>",
+}
+
+# pages for indexing tests, with the words, font sizes, links and title the
+# crawler should pull out of each
+INDEX_FIXTURES = [
+    ("<html><head><title>My Page</title></head><body><h1>Big</h1><p>small <b>bold</b><i>italic</i> text</p>"
+     "<a href='/x'>link one</a><script>var hidden = 1;</script><p>after</p></body></html>",
+     [("my", 7), ("page", 7), ("big", 7), ("small", 0), ("bold", 2), ("italic", 1), ("text", 0),
+      ("link", 0), ("one", 0), ("after", 0)],
+     ["http://site/x"], "My Page"),
+    ("<!DOCTYPE html><html><head><meta charset='utf-8'><title>Second &amp; Page</title><style>p{}</style></head>"
+     "<body><div><h2>Head two</h2><p>para <strong>strong</strong><em>emph</em></p>"
+     "<p>x<a href='http://other.com/y#frag'>other</a></p><img src='a.png'><br><p>tail words</p></div></body></html>",
+     [("second", 7), ("page", 7), ("head", 6), ("two", 6), ("para", 0), ("strong", 2), ("emph", 1),
+      ("other", 0), ("tail", 0), ("words", 0)],
+     ["http://other.com/y"], "Second & Page"),
+    ("<html><body><h3>three</h3><ul><li><a href='page?q=1'>q</a></li><li><a>nohref</a></li></ul>"
+     "<noscript>nojs</noscript><p>end <svg><text>drawn</text></svg><h4>four<b>unclosed</p></body></html>",
+     [("three", 5), ("nohref", 0), ("end", 0), ("four", 4), ("unclosed", 6)],
+     ["http://site/2/page?q=1", "http://site/2/"], None),
+]
+
+class SiteHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    requests = []
+    connections = 0
+    gzipped = 0
+    # served as /robots.txt when set; requests for it are not recorded
+    robots = None
+    # how many more requests for /robots.txt are dropped without an answer
+    robots_failures = 0
+
+    def setup(self):
+        SiteHandler.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        if self.path == "/robots.txt":
+            if SiteHandler.robots_failures:
+                SiteHandler.robots_failures -= 1
+                self.close_connection = True
+                return
+            self.send_robots()
+            return
+        SiteHandler.requests.append(self.path)
+        body = TEST_SITE.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        # every page but /b supports conditional requests
+        etag = '"%x"' % zlib.crc32(body.encode())
+        if self.path != "/b" and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = body.encode()
+        self.send_response(200)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            SiteHandler.gzipped += 1
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        if self.path != "/b":
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_robots(self):
+        # a missing robots.txt keeps the connection open, unlike send_error
+        body = (SiteHandler.robots or "").encode()
+        self.send_response(200 if SiteHandler.robots is not None else 404)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_test_site():
+    """Serve TEST_SITE on a free local port; returns the server and its base url."""
+    SiteHandler.requests = []
+    SiteHandler.connections = 0
+    SiteHandler.gzipped = 0
+    SiteHandler.robots = None
+    SiteHandler.robots_failures = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_port
 
 class TestCrawler(unittest.TestCase):
     def setUp(self):
@@ -96,6 +206,51 @@ class TestCrawler(unittest.TestCase):
             self.assertIn(doc_id, page_ranks)
             self.assertAlmostEqual(page_ranks[doc_id], score, places=4)
 
+    def test_page_rank_scores(self):
+        """Test if PageRank converges to the expected scores, including dangling pages."""
+        links = [(1, 2), (2, 3), (3, 1), (1, 3), (4, 1), (3, 4), (2, 4)]
+        cur = self.crawler.db_conn.cursor()
+        cur.executemany("INSERT INTO Links (from_doc_id, to_doc_id) VALUES (?, ?)", links)
+
+        page_ranks = self.crawler.page_rank()
+        expected = {1: 0.3374, 2: 0.1809, 3: 0.2578, 4: 0.2239}
+        for doc_id, score in expected.items():
+            self.assertAlmostEqual(page_ranks[doc_id], score, places=4)
+
+        # page 5 has no outgoing links; its rank is shared by every page
+        cur.execute("INSERT INTO Links (from_doc_id, to_doc_id) VALUES (4, 5)")
+        page_ranks = self.crawler.page_rank()
+        self.assertEqual(len(page_ranks), 5)
+        self.assertAlmostEqual(sum(page_ranks.values()), 1.0, places=6)
+
+    def test_page_rank_incremental(self):
+        """Test if incremental PageRank picks up new links from the stored scores."""
+        cur = self.crawler.db_conn.cursor()
+        cur.executemany("INSERT INTO Links (from_doc_id, to_doc_id) VALUES (?, ?)",
+                        [(1, 2), (2, 3), (3, 1), (4, 5), (5, 4)])
+        self.crawler.page_rank()
+        cur.execute("SELECT COUNT(*) FROM LinkChanges")
+        self.assertEqual(cur.fetchone()[0], 0)
+
+        cur.execute("INSERT INTO Links (from_doc_id, to_doc_id) VALUES (3, 6)")
+        cur.execute("SELECT from_doc_id, to_doc_id FROM LinkChanges")
+        self.assertEqual(cur.fetchall(), [(3, 6)])
+
+        incremental = self.crawler.page_rank(incremental=True)
+        scratch = self.crawler.page_rank()
+        for doc_id, score in scratch.items():
+            self.assertAlmostEqual(incremental[doc_id], score, places=5)
+
+        # only pages downstream of the change are rewritten in region mode
+        cur.execute("UPDATE PageRank SET score = 0.125 WHERE doc_id IN (4, 5)")
+        cur.execute("DELETE FROM Links WHERE from_doc_id = 3 AND to_doc_id = 6")
+        regional = self.crawler.page_rank(incremental=True, region_hops=2)
+        cur.execute("SELECT doc_id FROM PageRank WHERE score = 0.125")
+        self.assertEqual({row[0] for row in cur.fetchall()}, {4, 5})
+        # with 3 -> 6 gone, 1 -> 2 -> 3 -> 1 is a plain cycle again
+        self.assertAlmostEqual(regional[1], regional[2], places=5)
+        self.assertAlmostEqual(regional[2], regional[3], places=5)
+
     def test_get_resolved_inverted_index(self):
       """Test if the resolved inverted index is correctly generated."""
       word_id = self.crawler.word_id("example")
@@ -105,14 +260,300 @@ class TestCrawler(unittest.TestCase):
       cur.execute("INSERT INTO InvertedIndex (word_id, doc_id) VALUES (?, ?)", (word_id, doc_id))
       self.crawler.db_conn.commit()
 
-      self.crawler._word_id_cache[word_id] = "example"
-      self.crawler._document_index[doc_id] = "http://example.com"
-
       resolved_index = self.crawler.get_resolved_inverted_index()
 
       self.assertIn("example", resolved_index)
       self.assertIn("http://example.com", resolved_index["example"])
 
+    def test_index_page(self):
+      """Test if indexing a page writes its words, links and title in one go."""
+      doc_id = self.crawler.document_id("http://example.com")
+      html = ("<html><head><title>Example Page</title></head><body>"
+              "<h1>hello world</h1><p>hello <a href='/about'>about</a></p>"
+              "<a href='http://test.com'>test</a></body></html>")
+      self.crawler._index_page("http://example.com", doc_id, 0, html)
+
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT title FROM DocumentIndex WHERE id = ?", (doc_id,))
+      self.assertEqual(cur.fetchone()[0], "Example Page")
+
+      cur.execute("""SELECT word FROM Lexicon JOIN InvertedIndex ON Lexicon.id = InvertedIndex.word_id
+                     WHERE doc_id = ?""", (doc_id,))
+      words = {row[0] for row in cur.fetchall()}
+      self.assertEqual(words, {"example", "page", "hello", "world", "about", "test"})
+
+      # each posting carries the word's count and largest font in the page
+      cur.execute("""SELECT word, tf, font FROM Lexicon JOIN InvertedIndex ON Lexicon.id = InvertedIndex.word_id
+                     WHERE doc_id = ? AND word IN ('hello', 'about')""", (doc_id,))
+      self.assertEqual(sorted(cur.fetchall()), [("about", 1, 0), ("hello", 2, 7)])
+      cur.execute("SELECT length FROM DocumentIndex WHERE id = ?", (doc_id,))
+      self.assertEqual(cur.fetchone()[0], 7)
+
+      cur.execute("""SELECT url FROM DocumentIndex JOIN Links ON DocumentIndex.id = Links.to_doc_id
+                     WHERE from_doc_id = ?""", (doc_id,))
+      links = {row[0] for row in cur.fetchall()}
+      self.assertEqual(links, {"http://example.com/about", "http://test.com/"})
+
+      # links to pages we cannot crawl, or spelled differently, add nothing
+      html = ("<html><body><a href='mailto:x@example.com'>mail</a><a href='HTTP://TEST.COM:80/#x'>again</a>"
+              "<a href='/about'>about</a></body></html>")
+      self.crawler._index_page("http://example.com/about", self.crawler.document_id("http://example.com/about"),
+                               1, html)
+      cur.execute("SELECT COUNT(*) FROM DocumentIndex")
+      self.assertEqual(cur.fetchone()[0], 3)
+      cur.execute("SELECT COUNT(*) FROM Frontier WHERE url LIKE 'http://test.com%'")
+      self.assertEqual(cur.fetchone()[0], 1)
+
+      # words seen again resolve to the same ids without new Lexicon rows
+      self.assertEqual(self.crawler.word_id("hello"), self.crawler._lexicon["hello"])
+      cur.execute("SELECT COUNT(*) FROM Lexicon WHERE word = 'hello'")
+      self.assertEqual(cur.fetchone()[0], 1)
+
+    def test_index_page_rollback(self):
+      """Test if the ids of words a failed page added are forgotten along with them."""
+      url = "http://fails/"
+      with unittest.mock.patch.object(self.crawler._frontier, "finish",
+                                      side_effect=sqlite3.OperationalError("database is locked")):
+          with self.assertRaises(sqlite3.OperationalError):
+              self.crawler._index_page(url, self.crawler.document_id(url), 0, "<html><body>zeta</body></html>")
+      self.assertNotIn("zeta", self.crawler._lexicon)
+
+      url = "http://works/"
+      self.crawler._index_page(url, self.crawler.document_id(url), 0, "<html><body>zeta eta</body></html>")
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT word, id FROM Lexicon WHERE word IN ('zeta', 'eta')")
+      ids = dict(cur.fetchall())
+      self.assertEqual(len(set(ids.values())), 2)
+      self.assertEqual({word: self.crawler._lexicon[word] for word in ("zeta", "eta")}, ids)
+      self.assertEqual(self.crawler.get_resolved_inverted_index()["zeta"], [url])
+
+    def test_index_page_depth(self):
+      """Test if a queued url linked to again from a shallower page moves up, and from a deeper one stays."""
+      self.clear_frontier()
+      html = "<html><body><a href='http://x/'>x</a></body></html>"
+      cur = self.crawler.db_conn.cursor()
+      for url, depth, expected in (("http://deep/", 1, 2), ("http://seed/", 0, 1), ("http://deeper/", 3, 1)):
+          self.crawler._index_page(url, self.crawler.document_id(url), depth, html)
+          cur.execute("SELECT depth, priority, status FROM Frontier WHERE url = 'http://x/'")
+          self.assertEqual(cur.fetchone(), (expected, expected, QUEUED), url)
+
+    def test_index_document(self):
+      """Test if the streaming parser extracts words, font sizes, links and titles."""
+      for i, (html, words, links, title) in enumerate(INDEX_FIXTURES):
+          self.crawler._curr_url = "http://site/%d/" % i
+          self.crawler._font_size = 0
+          self.crawler._curr_words = []
+          self.crawler._curr_links = []
+          self.crawler._curr_title = None
+          self.crawler._index_document(html.encode())
+
+          self.assertEqual(self.crawler._curr_words, words)
+          self.assertEqual(self.crawler._curr_links, links)
+          self.assertEqual(self.crawler._curr_title, title)
+          # every tag that changed the font size was closed again
+          self.assertEqual(self.crawler._font_size, 0)
+
+    def test_crawl_concurrent(self):
+      """Test if a concurrent crawl fetches every page within the depth limit exactly once."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      try:
+          self.crawl_test_site(base, depth=2, concurrency=4)
+      finally:
+          server.shutdown()
+          server.server_close()
+
+      cur = self.crawler.db_conn.cursor()
+      words = set(self.crawler.get_resolved_inverted_index())
+      # /d is three links away from the seed, so it is never fetched
+      self.assertTrue({"home", "alpha", "beta", "gamma"}.issubset(words))
+      self.assertNotIn("delta", words)
+
+      cur.execute("SELECT title FROM DocumentIndex WHERE url = ?", (base + "/",))
+      self.assertEqual(cur.fetchone()[0], "Home")
+      self.assertEqual(sorted(SiteHandler.requests), ["/", "/a", "/b", "/c"])
+
+    def test_crawl_parse_workers(self):
+      """Test if a crawl that parses pages on worker processes indexes the same pages."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      try:
+          self.crawl_test_site(base, depth=2, concurrency=4, parse_workers=2)
+      finally:
+          server.shutdown()
+          server.server_close()
+
+      words = set(self.crawler.get_resolved_inverted_index())
+      self.assertTrue({"home", "alpha", "beta", "gamma"}.issubset(words))
+      self.assertNotIn("delta", words)
+      self.assertEqual(sorted(SiteHandler.requests), ["/", "/a", "/b", "/c"])
+
+    def test_index_pages(self):
+      """Test if pages parsed on worker processes are indexed like pages parsed in place."""
+      pages = [("http://site/%d/" % i, html) for i, (html, _, _, _) in enumerate(INDEX_FIXTURES)]
+      for url, html in pages:
+          self.crawler._index_page(url, self.crawler.document_id(url), 0, html)
+      self.crawler.merge_postings()
+      expected = self.crawler.get_resolved_inverted_index()
+
+      self.crawler.close_connection()
+      os.remove(self.db_path)
+      self.crawler = crawler(db_path=self.db_path)
+      self.assertEqual(self.crawler.index_pages(iter(pages), parse_workers=2, batch_size=2), len(pages))
+      self.assertEqual(self.crawler.get_resolved_inverted_index(), expected)
+
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT title FROM DocumentIndex WHERE url = 'http://site/0/'")
+      self.assertEqual(cur.fetchone()[0], "My Page")
+      # the same pages again are recognized as unchanged
+      self.assertEqual(self.crawler.index_pages(pages, parse_workers=2), 0)
+
+    def test_index_pages_memory_budget(self):
+      """Test if pages indexed in a tiny memory budget end up in the same posting lists."""
+      pages = [("http://site/%d/" % i, html) for i, (html, _, _, _) in enumerate(INDEX_FIXTURES)]
+      self.assertEqual(self.crawler.index_pages(pages, parse_workers=1, batch_size=1), len(pages))
+      expected = self.crawler.get_resolved_inverted_index()
+
+      self.crawler.close_connection()
+      os.remove(self.db_path)
+      self.crawler = crawler(db_path=self.db_path)
+      # the first page shows up again, changed, at the end
+      changed = [(pages[0][0], pages[0][1].replace("Big", "Huge"))]
+      self.assertEqual(self.crawler.index_pages(pages + changed, parse_workers=1, batch_size=1, memory_budget=1024),
+                       len(pages) + 1)
+      expected["huge"] = expected.pop("big")
+      self.assertEqual(self.crawler.get_resolved_inverted_index(), expected)
+
+      # content hashes were written with the postings
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT COUNT(*) FROM DocumentIndex WHERE content_hash IS NOT NULL")
+      self.assertEqual(cur.fetchone()[0], len(pages))
+      self.assertEqual(self.crawler.index_pages(pages[1:] + changed, parse_workers=1, memory_budget=1024), 0)
+
+    def test_crawl_keep_alive(self):
+      """Test if pages from one host are fetched compressed over a single reused connection."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      try:
+          self.crawl_test_site(base, depth=2)
+      finally:
+          server.shutdown()
+          server.server_close()
+
+      self.assertEqual(sorted(SiteHandler.requests), ["/", "/a", "/b", "/c"])
+      self.assertEqual(SiteHandler.connections, 1)
+      self.assertEqual(SiteHandler.gzipped, 4)
+      words = set(self.crawler.get_resolved_inverted_index())
+      self.assertTrue({"home", "alpha", "beta", "gamma"}.issubset(words))
+
+    def test_crawl_robots(self):
+      """Test if a crawl skips the pages robots.txt disallows and marks them in the frontier."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      SiteHandler.robots = "User-agent: *\nDisallow: /a\n"
+      try:
+          self.crawl_test_site(base, depth=2, concurrency=4)
+      finally:
+          server.shutdown()
+          server.server_close()
+
+      # /c is only linked from /a, so it is never found
+      self.assertEqual(sorted(SiteHandler.requests), ["/", "/b"])
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT status FROM Frontier WHERE url = ?", (base + "/a",))
+      self.assertEqual(cur.fetchone()[0], DISALLOWED)
+
+    def test_crawl_robots_unavailable(self):
+      """Test if pages of a host whose robots.txt did not come are fetched once it does, not skipped."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      # the pool retries once, so this is one failed download
+      SiteHandler.robots_failures = 2
+      try:
+          with unittest.mock.patch("crawler.RobotsCache", functools.partial(RobotsCache, retry_ttl=0.2)):
+              self.crawl_test_site(base, depth=2, concurrency=4)
+      finally:
+          server.shutdown()
+          server.server_close()
+
+      self.assertEqual(SiteHandler.robots_failures, 0)
+      self.assertEqual(sorted(SiteHandler.requests), ["/", "/a", "/b", "/c"])
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT status, COUNT(*) FROM Frontier GROUP BY status")
+      self.assertEqual(dict(cur.fetchall())[DONE], 4)
+
+    def test_crawl_resume(self):
+      """Test if a crawl continues from the stored frontier without refetching pages."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      try:
+          self.crawl_test_site(base, depth=1)
+          self.assertEqual(sorted(SiteHandler.requests), ["/", "/a", "/b"])
+
+          # pretend the first crawl died while /c was being fetched
+          cur = self.crawler.db_conn.cursor()
+          cur.execute("UPDATE Frontier SET status = 1 WHERE url = ?", (base + "/c",))
+          self.crawler.db_conn.commit()
+
+          SiteHandler.requests = []
+          self.crawl_test_site(base, depth=3)
+          self.assertEqual(sorted(SiteHandler.requests), ["/c", "/d"])
+      finally:
+          server.shutdown()
+          server.server_close()
+
+      cur = self.crawler.db_conn.cursor()
+      cur.execute("SELECT COUNT(*) FROM Frontier WHERE status = 2")
+      self.assertEqual(cur.fetchone()[0], 5)
+
+    def test_recrawl(self):
+      """Test if a recrawl only reindexes pages that changed."""
+      self.clear_frontier()
+      server, base = serve_test_site()
+      old_page = TEST_SITE["/a"]
+      try:
+          self.crawl_test_site(base, depth=1)
+          cur = self.crawler.db_conn.cursor()
+          cur.execute("SELECT etag, content_hash FROM DocumentIndex WHERE url = ?", (base + "/a",))
+          etag, old_hash = cur.fetchone()
+          self.assertIsNotNone(etag)
+
+          TEST_SITE["/a"] = "<html><body>changed <a href='/b'>b</a></body></html>"
+          SiteHandler.requests = []
+          self.crawler._index_page = unittest.mock.Mock(wraps=self.crawler._index_page)
+          self.crawler.recrawl(depth=1)
+      finally:
+          TEST_SITE["/a"] = old_page
+          server.shutdown()
+          server.server_close()
+
+      # every page was asked for, but only /a had to be indexed again
+      self.assertEqual(sorted(SiteHandler.requests), ["/", "/a", "/b"])
+      self.assertEqual([c.args[0] for c in self.crawler._index_page.call_args_list], [base + "/a"])
+
+      resolved_index = self.crawler.get_resolved_inverted_index()
+      words = {word for word, urls in resolved_index.items() if base + "/a" in urls}
+      self.assertEqual(words, {"changed"})
+      self.assertNotIn("alpha", resolved_index)
+      cur.execute("""SELECT url FROM Links JOIN DocumentIndex ON DocumentIndex.id = to_doc_id
+                     WHERE from_doc_id = (SELECT id FROM DocumentIndex WHERE url = ?)""", (base + "/a",))
+      self.assertEqual([row[0] for row in cur.fetchall()], [base + "/b"])
+      cur.execute("SELECT content_hash FROM DocumentIndex WHERE url = ?", (base + "/a",))
+      self.assertNotEqual(cur.fetchone()[0], old_hash)
+
+    def clear_frontier(self):
+      """Drop the seed urls from setUp so crawl tests never leave the test site."""
+      self.crawler.db_conn.execute("DELETE FROM Frontier")
+      self.crawler.db_conn.commit()
+
+    def crawl_test_site(self, base, depth, concurrency=1, parse_workers=0):
+      """Crawl the test site from its home page with a fresh crawler on the test database."""
+      with open(self.url_file, "w") as f:
+          f.write(base + "/")
+      self.crawler.close_connection()
+      self.crawler = crawler(db_path=self.db_path, url_file=self.url_file)
+      self.crawler.crawl(depth=depth, timeout=3, concurrency=concurrency, parse_workers=parse_workers)
+
 
 if __name__ == "__main__":
     unittest.main()
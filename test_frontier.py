@@ -0,0 +1,220 @@
+import unittest
+import unittest.mock
+import sqlite3
+import urllib3
+from urllib.robotparser import RobotFileParser
+from frontier import (Frontier, BloomFilter, HostScheduler, RobotsCache, RobotsUnavailable, normalize_url, QUEUED,
+                      FETCHING, DONE)
+
+
+class TestNormalizeUrl(unittest.TestCase):
+    def test_canonical_form(self):
+        """Test if different spellings of the same url normalize to the same string."""
+        self.assertEqual(normalize_url("HTTP://Example.COM"), "http://example.com/")
+        self.assertEqual(normalize_url("http://example.com:80/a?b=1#top"), "http://example.com/a?b=1")
+        self.assertEqual(normalize_url("https://user@example.com:443/"), "https://example.com/")
+        self.assertEqual(normalize_url("http://example.com:8080/x"), "http://example.com:8080/x")
+        self.assertEqual(normalize_url("http://[::1]:8082/"), "http://[::1]:8082/")
+
+    def test_not_crawlable(self):
+        """Test if urls we cannot crawl are rejected."""
+        self.assertIsNone(normalize_url("mailto:someone@example.com"))
+        self.assertIsNone(normalize_url("javascript:void(0)"))
+        self.assertIsNone(normalize_url("http://example.com:notaport/"))
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_membership(self):
+        """Test if added urls are always found and the false positive rate is respected."""
+        seen = BloomFilter(capacity=1000, error_rate=0.01)
+        urls = ["http://example.com/%d" % i for i in range(5000)]
+        for url in urls:
+            seen.add(url)
+
+        # the filter grew past its initial capacity without losing anything
+        self.assertTrue(all(url in seen for url in urls))
+        false_positives = sum("http://other.com/%d" % i in seen for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+
+class TestFrontier(unittest.TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        self.db_conn.execute("CREATE TABLE Frontier (url TEXT PRIMARY KEY, host TEXT, depth INTEGER, "
+                             "priority INTEGER, status INTEGER)")
+        self.frontier = Frontier(self.db_conn)
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def test_pop_order(self):
+        """Test if urls come out shallowest first and only once."""
+        self.frontier.add([("http://a/", 2), ("http://b/", 0), ("http://c/", 1), ("http://d/", 3)])
+        self.assertEqual(self.frontier.pop(2, max_depth=2), [("http://b/", 0), ("http://c/", 1)])
+        self.assertEqual(self.frontier.pop(5, max_depth=2), [("http://a/", 2)])
+        self.assertEqual(self.frontier.pop(5, max_depth=2), [])
+        self.assertEqual(len(self.frontier), 1)
+
+    def test_rediscovered_url(self):
+        """Test if a queued url found again at a smaller depth moves up, and others are untouched."""
+        self.frontier.add([("http://a/", 3), ("http://b/", 1)])
+        self.frontier.finish("http://b/", DONE)
+        self.frontier.add([("http://a/", 1), ("http://b/", 0)])
+
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT url, depth, status FROM Frontier ORDER BY url")
+        self.assertEqual(cur.fetchall(), [("http://a/", 1, QUEUED), ("http://b/", 1, DONE)])
+
+    def test_resume(self):
+        """Test if urls that were being fetched are queued again by a new frontier."""
+        self.frontier.add([("http://a/", 0)])
+        self.frontier.pop(1, max_depth=0)
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT status FROM Frontier")
+        self.assertEqual(cur.fetchone()[0], FETCHING)
+
+        frontier = Frontier(self.db_conn)
+        self.assertEqual(frontier.pop(1, max_depth=0), [("http://a/", 0)])
+
+
+class TestHostScheduler(unittest.TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        self.db_conn.execute("CREATE TABLE Frontier (url TEXT PRIMARY KEY, host TEXT, depth INTEGER, "
+                             "priority INTEGER, status INTEGER)")
+        self.frontier = Frontier(self.db_conn)
+        self.now = 0.0
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def scheduler(self, **kwargs):
+        return HostScheduler(self.frontier, clock=lambda: self.now, **kwargs)
+
+    def test_per_host_limit(self):
+        """Test if no more than `per_host` pages of a host are fetched at once, while other hosts go on."""
+        self.frontier.add([("http://a/%d" % i, 0) for i in range(4)] + [("http://b/0", 0)])
+        scheduler = self.scheduler(per_host=2)
+        urls = [url for url, _ in scheduler.pop(10, max_depth=0)]
+        self.assertEqual(sorted(urls), ["http://a/0", "http://a/1", "http://b/0"])
+        self.assertEqual(scheduler.pop(10, max_depth=0), [])
+
+        scheduler.done("http://a/0")
+        self.assertEqual(scheduler.pop(10, max_depth=0), [("http://a/2", 0)])
+
+    def test_delay(self):
+        """Test if fetches from one host start `delay` seconds apart and the scheduler says when to come back."""
+        self.frontier.add([("http://a/0", 0), ("http://a/1", 0), ("http://b/0", 0)])
+        scheduler = self.scheduler(per_host=1, delay=2.0)
+        self.assertEqual(sorted(url for url, _ in scheduler.pop(10, max_depth=0)), ["http://a/0", "http://b/0"])
+        scheduler.done("http://a/0")
+        scheduler.done("http://b/0")
+
+        self.now = 1.0
+        self.assertEqual(scheduler.pop(10, max_depth=0), [])
+        self.assertEqual(scheduler.next_ready(), 1.0)
+        self.now = 2.0
+        self.assertEqual(scheduler.pop(10, max_depth=0), [("http://a/1", 0)])
+        scheduler.done("http://a/1")
+
+        # the host is only found to be finished once it is ready again
+        self.assertEqual(scheduler.next_ready(), 2.0)
+        self.now = 4.0
+        self.assertEqual(scheduler.pop(10, max_depth=0), [])
+        self.assertIsNone(scheduler.next_ready())
+
+    def test_new_hosts(self):
+        """Test if urls queued after the scheduler started are picked up without scanning the whole frontier."""
+        scheduler = self.scheduler()
+        self.assertEqual(scheduler.pop(10, max_depth=1), [])
+        with unittest.mock.patch.object(self.frontier, "hosts", side_effect=AssertionError("rescanned")):
+            self.assertEqual(self.frontier.add([("http://c/", 1), ("http://d/", 2), ("http://c/x", 2)]), {"c", "d"})
+            self.assertEqual(scheduler.pop(10, max_depth=1), [("http://c/", 1)])
+
+            # only hosts that had urls queued or moved up are looked at again
+            self.assertEqual(self.frontier.add([("http://c/", 0), ("http://d/", 3)]), set())
+            self.assertEqual(self.frontier.add([]), set())
+            self.assertEqual(self.frontier.add([("http://d/", 1)]), {"d"})
+            self.assertEqual(scheduler.pop(10, max_depth=1), [("http://d/", 1)])
+
+        # urls queued again all at once are found by a scan
+        scheduler.done("http://c/")
+        scheduler.done("http://d/")
+        self.frontier.finish("http://c/")
+        self.frontier.requeue()
+        self.assertEqual(scheduler.pop(10, max_depth=1), [("http://c/", 1)])
+
+    def test_robots(self):
+        """Test if robots.txt rules and Crawl-delay are honored, and a second page waits for them."""
+        robots = RobotsCache("ece326-crawler")
+        rules = RobotFileParser()
+        rules.parse(["User-agent: *", "Disallow: /private", "Crawl-delay: 5"])
+
+        self.frontier.add([("http://a/%d" % i, 0) for i in range(3)])
+        scheduler = self.scheduler(robots=robots, per_host=2)
+        self.assertEqual(len(scheduler.pop(10, max_depth=0)), 1)
+
+        robots._rules["a"] = rules, float("inf")
+        self.assertFalse(robots.allowed(None, "http://a/private/x", timeout=1))
+        self.assertTrue(robots.allowed(None, "http://a/public", timeout=1))
+        self.assertEqual(robots.crawl_delay("a"), 5)
+
+        scheduler.done("http://a/0")
+        self.now = 4.0
+        self.assertEqual(scheduler.pop(10, max_depth=0), [])
+        self.now = 5.0
+        self.assertEqual(len(scheduler.pop(10, max_depth=0)), 1)
+
+    def test_robots_failures(self):
+        """Test if a host that did not answer is held back until it is retried, while an error it answered with is kept."""
+        answers = []
+
+        class Pool(object):
+            def request(self, method, url, **kwargs):
+                answer = answers.pop(0)
+                if isinstance(answer, Exception):
+                    raise answer
+                return unittest.mock.Mock(status=answer, data=b"")
+
+        robots = RobotsCache("ece326-crawler", ttl=3600, retry_ttl=60, retries=2, clock=lambda: self.now)
+        self.frontier.add([("http://a/0", 0), ("http://a/1", 0)])
+        scheduler = self.scheduler(robots=robots, per_host=2)
+        [(url, _)] = scheduler.pop(10, max_depth=0)
+
+        answers.append(urllib3.exceptions.ConnectTimeoutError("timed out"))
+        with self.assertRaises(RobotsUnavailable) as raised:
+            robots.allowed(Pool(), url, timeout=1)
+        self.assertEqual(raised.exception.retry_at, 60)
+        scheduler.done(url)
+        self.frontier.finish(url, QUEUED)
+
+        # nothing of the host is fetched until then, and its robots.txt is
+        # not downloaded again before
+        self.now = 59.0
+        self.assertEqual(scheduler.pop(10, max_depth=0), [])
+        self.assertEqual(scheduler.next_ready(), 1.0)
+        with self.assertRaises(RobotsUnavailable):
+            robots.allowed(Pool(), url, timeout=1)
+        self.now = 60.0
+        self.assertEqual(len(scheduler.pop(10, max_depth=0)), 1)
+        answers.append(200)
+        self.assertTrue(robots.allowed(Pool(), url, timeout=1))
+        self.assertIsNone(robots.retry_at("a"))
+
+        # a host that keeps failing is given up on for the full ttl
+        answers.extend([urllib3.exceptions.ConnectTimeoutError("timed out")] * 3)
+        for retry_at in (120, 180, None):
+            with self.assertRaises(RobotsUnavailable) as raised:
+                robots.allowed(Pool(), "http://c/x", timeout=1)
+            self.assertEqual(raised.exception.retry_at, retry_at)
+            self.now += 60
+
+        answers.append(503)
+        self.assertFalse(robots.allowed(Pool(), "http://b/x", timeout=1))
+        self.now += 3000.0
+        self.assertFalse(robots.allowed(Pool(), "http://b/x", timeout=1))
+        self.assertEqual(answers, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import sqlite3
+import numpy as np
+from postings import encode, decode, read_doc_ids, read_postings, merge_postings, remove_postings
+
+
+class TestPostings(unittest.TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        self.db_conn.execute("CREATE TABLE InvertedIndex (word_id INTEGER, doc_id INTEGER, tf INTEGER, font INTEGER, "
+                             "PRIMARY KEY (word_id, doc_id))")
+        self.db_conn.execute("CREATE TABLE Postings (word_id INTEGER PRIMARY KEY, doc_count INTEGER, doc_ids BLOB, "
+                             "tfs BLOB, fonts BLOB)")
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def test_round_trip(self):
+        """Test if posting lists decode to exactly what was encoded."""
+        for doc_ids in ([], [0], [1, 2, 3], [5, 127, 128, 16384, 2 ** 40, 2 ** 62]):
+            self.assertEqual(decode(encode(doc_ids)).tolist(), doc_ids)
+
+        doc_ids = np.unique(np.random.default_rng(0).integers(0, 10 ** 6, 50000))
+        blob = encode(doc_ids)
+        self.assertTrue(np.array_equal(decode(blob), doc_ids))
+        # dense lists take a little over a byte per posting
+        self.assertLess(len(blob), 2 * len(doc_ids))
+
+    def test_merge(self):
+        """Test if staged postings are merged into the posting lists and still found."""
+        self.db_conn.executemany("INSERT INTO InvertedIndex (word_id, doc_id) VALUES (?, ?)",
+                                 [(1, 5), (1, 2), (2, 7)])
+        self.assertEqual(merge_postings(self.db_conn), 3)
+        self.db_conn.executemany("INSERT INTO InvertedIndex (word_id, doc_id) VALUES (?, ?)", [(1, 3), (3, 1)])
+
+        self.assertEqual(read_postings(self.db_conn, 1)[0].tolist(), [2, 3, 5])
+        self.assertEqual(merge_postings(self.db_conn), 2)
+        self.assertEqual(read_postings(self.db_conn, 1)[0].tolist(), [2, 3, 5])
+        self.assertEqual(read_postings(self.db_conn, 3)[0].tolist(), [1])
+        self.assertEqual(read_postings(self.db_conn, 4)[0].tolist(), [])
+
+        cur = self.db_conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM InvertedIndex")
+        self.assertEqual(cur.fetchone()[0], 0)
+        cur.execute("SELECT doc_count FROM Postings WHERE word_id = 1")
+        self.assertEqual(cur.fetchone()[0], 3)
+
+    def test_term_frequencies(self):
+        """Test if term frequencies and font sizes travel with their postings through merges."""
+        self.db_conn.executemany("INSERT INTO InvertedIndex (word_id, doc_id, tf, font) VALUES (?, ?, ?, ?)",
+                                 [(1, 5, 3, 0), (1, 2, 1, 7), (1, 9, 200, 2)])
+        merge_postings(self.db_conn)
+        # document 5 was reindexed after the merge
+        self.db_conn.execute("INSERT INTO InvertedIndex (word_id, doc_id, tf, font) VALUES (1, 5, 4, 1)")
+
+        doc_ids, tfs, fonts = read_postings(self.db_conn, 1)
+        self.assertEqual(doc_ids.tolist(), [2, 5, 9])
+        self.assertEqual(tfs.tolist(), [1, 4, 200])
+        self.assertEqual(fonts.tolist(), [7, 1, 2])
+        # search reads only the document ids
+        self.assertEqual(read_doc_ids(self.db_conn, 1).tolist(), [2, 5, 9])
+        self.assertEqual(read_doc_ids(self.db_conn, 4).tolist(), [])
+        merge_postings(self.db_conn)
+        self.assertEqual([a.tolist() for a in read_postings(self.db_conn, 1)], [[2, 5, 9], [1, 4, 200], [7, 1, 2]])
+
+        # rows from before term frequencies were stored count each word once
+        self.db_conn.execute("INSERT INTO Postings (word_id, doc_count, doc_ids) VALUES (2, 2, ?)", (encode([3, 4]),))
+        self.db_conn.execute("INSERT INTO InvertedIndex (word_id, doc_id) VALUES (2, 6)")
+        self.assertEqual([a.tolist() for a in read_postings(self.db_conn, 2)], [[3, 4, 6], [1, 1, 1], [0, 0, 0]])
+
+    def test_remove(self):
+        """Test if a document is taken out of merged and staged posting lists."""
+        self.db_conn.executemany("INSERT INTO InvertedIndex (word_id, doc_id) VALUES (?, ?)",
+                                 [(1, 5), (1, 2), (2, 5)])
+        merge_postings(self.db_conn)
+        self.db_conn.execute("INSERT INTO InvertedIndex (word_id, doc_id) VALUES (3, 5)")
+
+        remove_postings(self.db_conn, 5, [1, 2, 3])
+        self.assertEqual(read_postings(self.db_conn, 1)[0].tolist(), [2])
+        self.assertEqual(read_postings(self.db_conn, 2)[0].tolist(), [])
+        self.assertEqual(read_postings(self.db_conn, 3)[0].tolist(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+# answers with the pid of the worker, after a while, so that requests overlap
+SERVER = """
+import os, sys, time
+from prefork import serve
+def app(environ, start_response):
+    time.sleep(0.05)
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode()]
+serve(app, "127.0.0.1", int(sys.argv[1]), workers=3, threads=2)
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.server = subprocess.Popen([sys.executable, "-c", SERVER, str(self.port)],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", self.port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        if self.server.poll() is None:
+            self.server.kill()
+            self.server.wait()
+
+    def get(self, _=None):
+        with urlopen("http://127.0.0.1:%d/" % self.port, timeout=5) as response:
+            return int(response.read())
+
+    def test_workers(self):
+        """Test if requests are answered by several workers at once, and a worker that dies is replaced."""
+        start = time.monotonic()
+        with ThreadPoolExecutor(12) as pool:
+            pids = list(pool.map(self.get, range(24)))
+        # 24 requests of 50 ms each, 6 at a time
+        self.assertLess(time.monotonic() - start, 24 * 0.05 / 2)
+        self.assertGreater(len(set(pids)), 1)
+        self.assertNotIn(self.server.pid, pids)
+
+        os.kill(pids[0], signal.SIGKILL)
+        time.sleep(0.2)
+        with ThreadPoolExecutor(12) as pool:
+            pids = set(pool.map(self.get, range(24)))
+        self.assertEqual(len(pids), 3)
+
+    def test_terminate(self):
+        """Test if terminating the server stops every worker."""
+        with ThreadPoolExecutor(6) as pool:
+            pids = set(pool.map(self.get, range(12)))
+        self.server.terminate()
+        self.assertEqual(self.server.wait(timeout=5), 0)
+        time.sleep(0.1)
+        for pid in pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
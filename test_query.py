@@ -0,0 +1,208 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest.mock
+from crawler import crawler
+from query import QueryEngine, ResultCache, query_groups, query_words
+from snapshots import lookup_words, lookup_documents
+from spelling import SpellingCorrector
+
+# page i links to page i + 1, so later pages rank higher
+PAGES = [("http://site/%d" % i, "<html><head><title>Page %d</title></head><body>common %s <a href='/%d'>x</a>"
+          "</body></html>" % (i, "rare" if i % 5 == 0 else "", i + 1)) for i in range(25)]
+
+
+class TestQueryEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "crawl.db")
+        bot = crawler(db_path=self.db_path)
+        for url, html in PAGES:
+            bot._index_page(url, bot.document_id(url), 0, html)
+        bot.page_rank()
+        bot.close_connection()
+        self.engine = QueryEngine(os.path.join(self.tmp.name, "index"), fallback=self.db_path)
+
+    def tearDown(self):
+        self.engine.close()
+        self.tmp.cleanup()
+
+    def test_lookups(self):
+        """Test if every word and document of a query is looked up in one go."""
+        self.assertEqual(query_words("Common RARE"), ["common", "rare"])
+        with self.engine.snapshots.current() as generation:
+            ids = lookup_words(generation.db_conn, ["common", "rare", "missing", "common"])
+            self.assertEqual(set(ids), {"common", "rare"})
+            self.assertEqual(lookup_words(generation.db_conn, []), {})
+            documents = lookup_documents(generation.db_conn, [1, 2, 999])
+            self.assertEqual(documents, {1: ("http://site/0", "Page 0"), 2: ("http://site/1", "Page 1")})
+
+    def test_search_and_pages(self):
+        """Test if a search keeps every match and pages are filled in with urls and titles."""
+        total, hits = self.engine.search("common")
+        self.assertEqual(total, 25)
+        self.assertEqual(len(hits), 25)
+        self.assertEqual([score for _, score in hits], sorted((score for _, score in hits), reverse=True))
+
+        first = self.engine.page(hits, 1)
+        self.assertEqual(len(first), 10)
+        self.assertEqual(len(self.engine.page(hits, 3)), 5)
+        self.assertEqual(self.engine.page(hits, 4), [])
+        url, title, score = first[0]
+        self.assertEqual(title, "Page " + url.rsplit("/", 1)[1])
+        self.assertEqual(score, hits[0][1])
+
+        # words that are not in the index match nothing
+        self.assertEqual(self.engine.search("missing"), (0, []))
+        # documents with both words score twice
+        single = dict(hits)
+        total, hits = self.engine.search("rare common")
+        self.assertEqual(total, 25)
+        doubled = {url for url, title, score in self.engine.page(hits, 1, per_page=25)
+                   if score > 1.5 * single[int(title.split()[1]) + 1]}
+        self.assertEqual(doubled, {"http://site/%d" % i for i in range(0, 25, 5)})
+
+    def test_old_database(self):
+        """Test if a database made before posting lists were compressed is searched as it is."""
+        db_path = os.path.join(self.tmp.name, "old.db")
+        db_conn = sqlite3.connect(db_path)
+        db_conn.executescript("""
+        CREATE TABLE Lexicon (id INTEGER PRIMARY KEY, word TEXT UNIQUE);
+        CREATE TABLE DocumentIndex (id INTEGER PRIMARY KEY, url TEXT UNIQUE, title TEXT);
+        CREATE TABLE InvertedIndex (word_id INTEGER, doc_id INTEGER, PRIMARY KEY (word_id, doc_id));
+        CREATE TABLE Links (from_doc_id INTEGER, to_doc_id INTEGER, PRIMARY KEY (from_doc_id, to_doc_id));
+        CREATE TABLE PageRank (doc_id INTEGER PRIMARY KEY, score REAL);
+        INSERT INTO Lexicon VALUES (1, 'toronto'), (2, 'city');
+        INSERT INTO DocumentIndex VALUES (1, 'http://a/', 'A'), (2, 'http://b/', NULL);
+        INSERT INTO InvertedIndex VALUES (1, 1), (1, 2), (2, 2);
+        INSERT INTO PageRank VALUES (1, 0.25), (2, 0.75);
+        """)
+        db_conn.close()
+
+        engine = QueryEngine(os.path.join(self.tmp.name, "none"), fallback=db_path)
+        self.assertEqual(engine.search("toronto"), (2, [(2, 0.75), (1, 0.25)]))
+        self.assertEqual(engine.search("toronto city", conjunctive=True), (1, [(2, 1.5)]))
+        self.assertEqual(engine.search_page("toronto")["results"][0]["url"], "http://b/")
+        engine.prepare_spelling(wait=True)
+        self.assertEqual(engine.correction("torontoo city"), "toronto city")
+        engine.close()
+
+    def test_conjunctive_search(self):
+        """Test if a conjunctive search only matches documents with every word, or one word of OR groups."""
+        self.assertEqual(query_groups("Rare common OR Missing xray"), [["rare"], ["common", "missing"], ["xray"]])
+        self.assertEqual(query_groups("OR a OR"), [])
+        # stop words are never indexed, so they are not required
+        self.assertEqual(query_groups("The rare of common or xray OR the yak"),
+                         [["rare"], ["common"], ["xray"], ["yak"]])
+
+        total, hits = self.engine.search("rare common", conjunctive=True)
+        self.assertEqual(total, 5)
+        self.assertEqual(hits, [hit for hit in self.engine.search("rare common")[1] if hit[0] % 5 == 1])
+        self.assertEqual(self.engine.search("rare missing", conjunctive=True), (0, []))
+        self.assertEqual(self.engine.search("rare OR missing common", conjunctive=True)[0], 5)
+        self.assertEqual(self.engine.search("the rare of common", conjunctive=True), (total, hits))
+        self.assertEqual(self.engine.search("rare or common", conjunctive=True), (total, hits))
+        # the same words mean something else without conjunctive
+        self.assertEqual(self.engine.search("rare common")[0], 25)
+
+    def test_correction(self):
+        """Test if queries are corrected to words of the index, keeping the words it has as they were typed."""
+        bot = crawler(db_path=self.db_path)
+        bot._index_page("http://site/city", bot.document_id("http://site/city"), 0,
+                        "<html><body>university off toronto there city to</body></html>")
+        bot.close_connection()
+
+        self.engine.prepare_spelling(wait=True)
+        self.assertEqual(self.engine.correction("Comon RARE pgae"), "common RARE page")
+        self.assertEqual(self.engine.correction("common"), "common")
+        self.assertEqual(self.engine.correction("univrsity of torontp"), "university of toronto")
+        # words the crawler never indexes are not misspellings, and short
+        # words are as close to too many others
+        for query in ("university of toronto", "the city", "a city", "is toronto", "The City", "ot city"):
+            self.assertEqual(self.engine.correction(query), query)
+
+    def test_correction_in_background(self):
+        """Test if spelling correctors are built in the background, the previous one answering meanwhile."""
+        self.assertNotIn("newword", self.engine.prepare_spelling(wait=True))
+        self.assertEqual(self.engine.correction("comon"), "common")
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(vocabulary):
+            started.set()
+            release.wait(5)
+            return SpellingCorrector(vocabulary)
+
+        bot = crawler(db_path=self.db_path)
+        bot._index_page("http://site/new", bot.document_id("http://site/new"), 0, "<html><body>newword</body></html>")
+        bot.close_connection()
+        # the crawler's database is only read for a new corrector every so often
+        self.assertNotIn("newword", self.engine.prepare_spelling(wait=True))
+        with unittest.mock.patch("query.SpellingCorrector", side_effect=slow), \
+                unittest.mock.patch("query.SPELLING_INTERVAL", 0):
+            self.assertEqual(self.engine.correction("comon"), "common")
+            self.assertTrue(started.wait(5))
+            self.assertEqual(self.engine.correction("comon newwrd"), "common newwrd")
+            release.set()
+            self.assertIn("newword", self.engine.prepare_spelling(wait=True))
+        self.assertEqual(self.engine.correction("comon newwrd"), "common newword")
+
+    def test_search_page(self):
+        """Test if a page of results comes as plain data, with the counts and timings of the search."""
+        found = self.engine.search_page("common rare", page=2, per_page=4)
+        self.assertEqual((found["query"], found["page"], found["total"], found["kept"]), ("common rare", 2, 25, 25))
+        total, hits = self.engine.search("common rare")
+        self.assertEqual([(result["url"], result["title"], result["score"]) for result in found["results"]],
+                         self.engine.page(hits, 2, 4))
+        self.assertEqual(set(found["timing"]), {"search_ms", "page_ms", "total_ms"})
+        self.assertGreaterEqual(found["timing"]["total_ms"], found["timing"]["search_ms"])
+
+        found = self.engine.search_page("rare common", per_page=3, conjunctive=True)
+        self.assertEqual((found["total"], len(found["results"])), (5, 3))
+        self.assertEqual(self.engine.search_page("common", page=9)["results"], [])
+
+    def test_cached_search(self):
+        """Test if repeated queries are answered from the cache until a new index is published."""
+        total, hits = self.engine.search("common rare")
+        self.assertEqual(self.engine.search("  Common   RARE "), (total, hits))
+        self.assertEqual(self.engine.cache.stats()["hits"], 1)
+
+        # indexing a page changes the crawler's database, and so the results
+        bot = crawler(db_path=self.db_path)
+        url = "http://site/new"
+        bot._index_page(url, bot.document_id(url), 0, "<html><body>common</body></html>")
+        self.assertEqual(self.engine.search("common rare")[0], 26)
+
+        # a published index stays the same, so it can be cached
+        bot.publish(os.path.join(self.tmp.name, "index"))
+        bot.close_connection()
+        self.assertEqual(self.engine.search("common rare")[0], 26)
+        self.assertEqual(len(self.engine.cache), 1)
+        self.engine.search("common rare")
+        self.assertEqual(self.engine.cache.stats()["hits"], 2)
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_and_ttl(self):
+        """Test if the least recently used and the expired results are dropped."""
+        now = [0.0]
+        cache = ResultCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1, [(1, 0.5)])
+        cache.put("b", 2, [(2, 0.25), (3, 0.125)])
+        self.assertEqual(cache.get("a"), (1, [(1, 0.5)]))
+        cache.put("c", 0, [])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), (0, []))
+
+        now[0] = 10.0
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats(), {"size": 1, "maxsize": 2, "ttl": 10, "hits": 2, "misses": 2,
+                                         "evictions": 1, "hit_rate": 0.5})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import os
+import tempfile
+from crawler import crawler
+from query import QueryEngine
+from serving import MappedIndex, export
+from snapshots import Generation
+
+# page i links to page i + 1, so later pages rank higher; every third page
+# has no title
+PAGES = [("http://site/%d" % i, "<html><head>%s</head><body>common word%d %s <a href='/%d'>x</a></body></html>" %
+          ("<title>Page %d</title>" % i if i % 3 else "", i % 4, "café" if i % 5 == 0 else "", i + 1))
+         for i in range(30)]
+
+
+class TestMappedIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "crawl.db")
+        self.bot = crawler(db_path=self.db_path, num_shards=3)
+        for url, html in PAGES:
+            self.bot._index_page(url, self.bot.document_id(url), 0, html)
+        self.bot.page_rank()
+        self.bot.merge_postings()
+
+    def tearDown(self):
+        self.bot.close_connection()
+        self.tmp.cleanup()
+
+    def test_same_as_database(self):
+        """Test if the serving file finds the same words, documents and results as the database it came from."""
+        path = os.path.join(self.tmp.name, "serving.idx")
+        self.assertGreater(export(self.db_path, path), 0)
+        mapped = MappedIndex(path)
+        generation = Generation(self.db_path, immutable=False)
+
+        words = ["common", "word0", "word3", "café", "missing", "a", "zzz"]
+        mapped_ids = mapped.lookup_words(words)
+        ids = generation.lookup_words(words)
+        self.assertEqual(set(mapped_ids), set(ids))
+        self.assertEqual(mapped.lookup_words([]), {})
+
+        for query in (["common"], ["word1", "common"], ["café", "word0", "word0"], ["missing"], []):
+            self.assertEqual(mapped.index.search([mapped_ids[w] for w in query if w in mapped_ids], 10),
+                             generation.index.search([ids[w] for w in query if w in ids], 10), query)
+
+        self.assertEqual(sorted(mapped.vocabulary()), sorted(generation.vocabulary()))
+
+        doc_ids = [0, 1, 2, 3, 30, 999]
+        self.assertEqual(mapped.lookup_documents(doc_ids), generation.lookup_documents(doc_ids))
+        self.assertIsNone(mapped.lookup_documents([1])[1][1])
+        mapped.close()
+        generation.close()
+
+    def test_query_engine(self):
+        """Test if a mapped query engine serves published generations from their serving file."""
+        root = os.path.join(self.tmp.name, "index")
+        engine = QueryEngine(root, fallback=self.db_path, mapped=True)
+        plain = QueryEngine(root, fallback=self.db_path)
+        # until something is published, the database is searched
+        self.assertEqual(engine.search("common word2"), plain.search("common word2"))
+
+        self.bot.publish(root)
+        with engine.snapshots.current() as generation:
+            self.assertIsInstance(generation, MappedIndex)
+        total, hits = engine.search("common word2")
+        self.assertEqual((total, hits), plain.search("common word2"))
+        self.assertEqual(engine.page(hits, 2), plain.page(hits, 2))
+        for query in ("common word2", "word1 OR word2 café", "word1 word2"):
+            self.assertEqual(engine.search(query, conjunctive=True), plain.search(query, conjunctive=True))
+        engine.close()
+        plain.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+from crawler import crawler
+from shards import ShardedIndex
+
+# a few pages linking to each other, some sharing words
+PAGES = [
+    ("http://site/%d" % i, "<html><head><title>Page %d</title></head><body>%s<a href='/%d'>next</a></body></html>"
+     % (i, " ".join(["common"] + ["word%d" % j for j in range(i % 4 + 1)]), (i + 1) % 10))
+    for i in range(10)
+]
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def build(self, name, num_shards):
+        """Index PAGES into a new database with `num_shards` shards."""
+        db_path = os.path.join(self.tmp.name, name)
+        bot = crawler(db_path=db_path, num_shards=num_shards)
+        for url, html in PAGES:
+            bot._index_page(url, bot.document_id(url), 0, html)
+        # half the postings merged, half still staged
+        bot.merge_postings()
+        url, html = PAGES[0]
+        bot._index_page(url, bot.document_id(url), 0, html.replace("common", "changed"), replace=True)
+        bot.page_rank()
+        return bot, db_path
+
+    def test_sharded_crawl(self):
+        """Test if a sharded index holds the same postings as a single file, split by document."""
+        single, _ = self.build("single.db", 1)
+        sharded, db_path = self.build("sharded.db", 3)
+        self.assertEqual(sharded.get_resolved_inverted_index(), single.get_resolved_inverted_index())
+        single.close_connection()
+        sharded.close_connection()
+
+        for shard in range(3):
+            conn = sqlite3.connect(os.path.join(self.tmp.name, "sharded.shard%d.db" % shard))
+            cur = conn.cursor()
+            cur.execute("SELECT doc_id FROM InvertedIndex")
+            self.assertTrue(all(doc_id % 3 == shard for (doc_id,) in cur.fetchall()))
+            cur.execute("SELECT COUNT(*) FROM Postings")
+            self.assertGreater(cur.fetchone()[0], 0)
+            conn.close()
+
+        # the shards stay with the database
+        bot = crawler(db_path=db_path)
+        self.assertEqual(len(bot._shards), 3)
+        bot.close_connection()
+        with self.assertRaises(ValueError):
+            crawler(db_path=db_path, num_shards=2)
+
+    def test_search(self):
+        """Test if searching every shard and merging finds the same top documents as one file."""
+        for name, num_shards in (("single.db", 1), ("sharded.db", 4)):
+            bot, db_path = self.build(name, num_shards)
+            bot.close_connection()
+            index = ShardedIndex(db_path)
+            self.assertEqual(len(index), num_shards)
+
+            total, hits = index.search([1, 2], 3)
+            if num_shards == 1:
+                expected = (total, hits)
+                full = index.search([1, 2], 100)
+            else:
+                self.assertEqual((total, hits), expected)
+                self.assertEqual(index.search([1, 2], 100), full)
+            index.close()
+
+        # scores written by another connection are picked up by the next search
+        index = ShardedIndex(db_path)
+        best = index.search([1, 2], 1)[1][0][0]
+        conn = sqlite3.connect(db_path)
+        with conn:
+            conn.execute("UPDATE PageRank SET score = 0 WHERE doc_id = ?", (best,))
+        conn.close()
+        self.assertNotEqual(index.search([1, 2], 1)[1][0][0], best)
+        index.close()
+
+        self.assertEqual(len(hits), 3)
+        self.assertEqual(hits, full[1][:3])
+        self.assertEqual([score for _, score in full[1]], sorted((score for _, score in full[1]), reverse=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+from crawler import crawler
+from snapshots import Snapshots, generations, current_database
+
+
+def page(i, word):
+    return "<html><head><title>Page %d</title></head><body>%s <a href='/%d'>next</a></body></html>" % (i, word, i + 1)
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "crawl.db")
+        self.root = os.path.join(self.tmp.name, "index")
+        self.bot = crawler(db_path=self.db_path, num_shards=2)
+
+    def tearDown(self):
+        self.bot.close_connection()
+        self.tmp.cleanup()
+
+    def index(self, i, word):
+        url = "http://site/%d" % i
+        self.bot._index_page(url, self.bot.document_id(url), 0, page(i, word))
+        self.bot.page_rank()
+
+    def search(self, generation, word):
+        cur = generation.db_conn.cursor()
+        cur.execute("SELECT id FROM Lexicon WHERE word = ?", (word,))
+        row = cur.fetchone()
+        return generation.index.search([row["id"]] if row else [], 10)[0]
+
+    def test_publish(self):
+        """Test if searches only see published generations, and switch to a new one as it is published."""
+        self.index(0, "apple")
+        snapshots = Snapshots(self.root, fallback=self.db_path)
+        with snapshots.current() as generation:
+            self.assertEqual(generation.path, self.db_path)
+            self.assertEqual(self.search(generation, "apple"), 1)
+
+        self.bot.publish(self.root)
+        self.assertEqual(current_database(self.root), os.path.join(self.root, "1", "crawl.db"))
+        self.assertTrue(os.path.exists(os.path.join(self.root, "1", "crawl.shard1.db")))
+
+        # pages indexed after publishing are invisible until the next publish
+        self.index(1, "apple")
+        running = snapshots.acquire()
+        self.assertEqual(self.search(running, "apple"), 1)
+        self.bot.publish(self.root)
+        with snapshots.current() as generation:
+            self.assertEqual(self.search(generation, "apple"), 2)
+
+        # the search that started before still works on its generation
+        self.assertEqual(self.search(running, "apple"), 1)
+        snapshots.release(running)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            running.db_conn.cursor()
+        snapshots.close()
+
+    def test_keep(self):
+        """Test if publishing deletes all but the newest generations, even ones still being read."""
+        self.index(0, "apple")
+        self.bot.publish(self.root)
+        snapshots = Snapshots(self.root)
+        with snapshots.current() as oldest:
+            for _ in range(3):
+                self.bot.publish(self.root, keep=2)
+            self.assertEqual(generations(self.root), [3, 4])
+            self.assertEqual(self.search(oldest, "apple"), 1)
+        snapshots.close()
+
+        with self.assertRaises(FileNotFoundError):
+            Snapshots(os.path.join(self.tmp.name, "nothing")).acquire()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import random
+from spelling import SpellingCorrector, deletes, edit_distance
+
+VOCABULARY = [("search", 50), ("engine", 40), ("crawler", 30), ("crawl", 25), ("index", 60), ("indexes", 5),
+              ("toronto", 8), ("university", 12), ("pagerank", 3), ("sharded", 2), ("shared", 9), ("cat", 4),
+              ("car", 7), ("cart", 1), ("international", 6)]
+
+
+class TestSpelling(unittest.TestCase):
+    def test_edit_distance(self):
+        """Test if edit distances count swaps of adjacent letters as one edit, and give up past the limit."""
+        self.assertEqual(edit_distance("search", "search", 2), 0)
+        self.assertEqual(edit_distance("serach", "search", 2), 1)
+        self.assertEqual(edit_distance("seach", "search", 2), 1)
+        self.assertEqual(edit_distance("sarch", "searches", 2), 3)
+        self.assertEqual(edit_distance("kitten", "sitting", 3), 3)
+        self.assertEqual(edit_distance("", "ab", 2), 2)
+        self.assertEqual(deletes("abc", 1), {"abc", "bc", "ac", "ab"})
+        self.assertEqual(len(deletes("abcd", 2)), 1 + 4 + 6)
+
+    def test_same_as_every_word(self):
+        """Test if the deletes index finds the word closest to misspellings, as comparing with every word does."""
+        corrector = SpellingCorrector(VOCABULARY)
+        frequencies = dict(VOCABULARY)
+        rng = random.Random(1)
+        letters = "abcdehinorstu"
+        for _ in range(500):
+            word = list(rng.choice(VOCABULARY)[0])
+            for _ in range(rng.randint(0, 3)):
+                i = rng.randrange(len(word))
+                edit = rng.choice("dis")
+                if edit == "d" and len(word) > 1:
+                    del word[i]
+                elif edit == "i":
+                    word.insert(i, rng.choice(letters))
+                else:
+                    word[i] = rng.choice(letters)
+            word = "".join(word)
+            close = [(edit_distance(word, known, 2), -frequency, known) for known, frequency in frequencies.items()]
+            close = [key for key in close if key[0] <= 2]
+            expected = min(close)[2] if close else word
+            self.assertEqual(corrector.correction(word), expected, word)
+
+    def test_known_and_cached(self):
+        """Test if known words are never corrected, frequent words win ties and corrections are memoized."""
+        corrector = SpellingCorrector(VOCABULARY, cache_size=2)
+        self.assertEqual(len(corrector), len(VOCABULARY))
+        self.assertEqual(corrector.correction("cart"), "cart")
+        # car and cat are as close, car is in more documents
+        self.assertEqual(corrector.correction("caq"), "car")
+        self.assertEqual(corrector.correction("internatoinal"), "international")
+        self.assertEqual(corrector.correction("xyzzy"), "xyzzy")
+        self.assertEqual(corrector.correction("caq"), "car")
+        info = corrector.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 4, 2))
+        corrector.correction("caq")
+        self.assertEqual(corrector.cache_info().hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
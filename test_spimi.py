@@ -0,0 +1,98 @@
+import unittest
+import sqlite3
+import numpy as np
+import postings
+from postings import read_postings
+from spimi import IndexBuilder
+
+# (doc_id, [(word_id, tf, font)]) of a few documents sharing words
+DOCUMENTS = [
+    (doc_id, [(word_id, doc_id % 3 + 1, word_id % 2) for word_id in range(1, 40) if (doc_id * word_id) % 7 < 4])
+    for doc_id in range(1, 60)
+]
+
+
+class TestIndexBuilder(unittest.TestCase):
+    def setUp(self):
+        self.db_conn = sqlite3.connect(":memory:")
+        postings.create_tables(self.db_conn.cursor())
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def add(self, builder, doc_id, words):
+        words = np.array(words, dtype=np.int64).reshape(-1, 3)
+        builder.add(doc_id, words[:, 0], words[:, 1], words[:, 2], "hash%d" % doc_id)
+
+    def expected(self, documents):
+        """What the posting lists of `documents` look like when built through InvertedIndex."""
+        conn = sqlite3.connect(":memory:")
+        cur = conn.cursor()
+        postings.create_tables(cur)
+        cur.executemany("INSERT OR REPLACE INTO InvertedIndex (word_id, doc_id, tf, font) VALUES (?, ?, ?, ?)",
+                        [(word_id, doc_id, tf, font) for doc_id, words in documents for word_id, tf, font in words])
+        postings.merge_postings(conn)
+        result = {word_id: tuple(column.tolist() for column in found)
+                  for word_id, found in postings.iter_postings(conn)}
+        conn.close()
+        return result
+
+    def postings(self, schema="main"):
+        return {word_id: tuple(column.tolist() for column in found)
+                for word_id, found in postings.iter_postings(self.db_conn, schema)}
+
+    def test_spill_and_merge(self):
+        """Test if postings spilled over many runs merge into the same posting lists as built in one go."""
+        builder = IndexBuilder(memory_budget=8 * 1024)
+        for doc_id, words in DOCUMENTS:
+            self.add(builder, doc_id, words)
+        self.assertGreater(len(builder), 5)
+
+        merged = builder.merge(self.db_conn)
+        self.assertEqual(merged, sum(len(words) for _, words in DOCUMENTS))
+        self.assertEqual(self.postings(), self.expected(DOCUMENTS))
+        self.assertEqual(list(builder.hashes()), [(doc_id, "hash%d" % doc_id) for doc_id, _ in DOCUMENTS])
+        builder.close()
+        self.assertEqual(len(builder), 0)
+
+    def test_reindexed_document(self):
+        """Test if a document added again replaces its postings, even in runs spilled before."""
+        builder = IndexBuilder(memory_budget=4 * 1024)
+        for doc_id, words in DOCUMENTS:
+            self.add(builder, doc_id, words)
+        # document 1 loses every word but its last one, which changes
+        old_words = [word_id for word_id, _, _ in DOCUMENTS[0][1]]
+        builder.remove(1, old_words)
+        self.add(builder, 1, [(old_words[-1], 9, 3)])
+        builder.merge(self.db_conn)
+
+        expected = self.expected(DOCUMENTS[1:] + [(1, [(old_words[-1], 9, 3)])])
+        self.assertEqual(self.postings(), expected)
+        builder.close()
+
+    def test_existing_postings_and_shards(self):
+        """Test if merged runs are combined with posting lists already in the database, per shard."""
+        for schema in ("shard0", "shard1"):
+            self.db_conn.execute("ATTACH DATABASE ':memory:' AS %s" % schema)
+            postings.create_tables(self.db_conn.cursor(), schema)
+        # an older posting of document 2 and one of document 101
+        postings.add_postings(self.db_conn, [(1, (np.array([2, 100]), np.array([5, 1]), np.array([0, 0])))],
+                              schema="shard0")
+
+        builder = IndexBuilder(memory_budget=4 * 1024)
+        for doc_id, words in DOCUMENTS:
+            self.add(builder, doc_id, words)
+        builder.merge(self.db_conn, ["shard0", "shard1"])
+
+        expected = self.expected(DOCUMENTS + [(100, [(1, 1, 0)])])
+        for shard, schema in enumerate(("shard0", "shard1")):
+            found = self.postings(schema)
+            self.assertTrue(all(doc_id % 2 == shard for doc_ids, _, _ in found.values() for doc_id in doc_ids))
+        doc_ids, tfs, _ = read_postings(self.db_conn, 1, "shard0")
+        self.assertEqual(doc_ids.tolist(), [doc_id for doc_id in expected[1][0] if doc_id % 2 == 0])
+        self.assertEqual(tfs[doc_ids == 2].tolist(), [3])
+        builder.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import sqlite3
+import numpy as np
+import postings
+from shards import search_shard
+from topk import build_impact_postings, has_impact_postings, search_impact, top_k
+
+
+class TestTopK(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.db_conn = sqlite3.connect(":memory:")
+        postings.create_tables(self.db_conn.cursor())
+        # word w is in about 1 of every w + 1 documents, so low ids are common
+        words = []
+        for word_id in range(1, 30):
+            doc_ids = np.flatnonzero(rng.random(5000) < 1.0 / word_id) + 1
+            words.append((word_id, (doc_ids, np.ones(len(doc_ids), dtype=np.int64),
+                                    np.zeros(len(doc_ids), dtype=np.int64))))
+        postings.add_postings(self.db_conn, words)
+        # skewed scores with plenty of ties, and documents without any
+        self.ranks = np.round(rng.pareto(1.5, 4900), 1)
+        self.assertFalse(has_impact_postings(self.db_conn))
+        build_impact_postings(self.db_conn, self.ranks)
+        self.assertTrue(has_impact_postings(self.db_conn))
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def test_same_as_exhaustive(self):
+        """Test if stopping early finds exactly the top documents that reading every posting finds."""
+        rng = np.random.default_rng(3)
+        queries = [[1], [1, 2], [2, 2, 5], [1, 2, 3, 4], [7, 29], [29], [1, 100], [100]]
+        queries += [rng.integers(1, 30, rng.integers(1, 5)).tolist() for _ in range(30)]
+        for word_ids in queries:
+            for k in (1, 10, 100, 4000):
+                total, top, _ = search_shard(self.db_conn, word_ids, k, self.ranks)
+                early_total, early_top, _ = search_impact(self.db_conn, word_ids, k, self.ranks)
+                self.assertEqual(early_top, top, (word_ids, k))
+                self.assertLessEqual(early_total, total)
+
+    def test_reads_fraction(self):
+        """Test if the top 10 for common words is found reading a small part of their postings."""
+        _, _, everything = search_shard(self.db_conn, [1, 2, 3], 10, self.ranks)
+        _, _, read = search_impact(self.db_conn, [1, 2, 3], 10, self.ranks)
+        self.assertLess(read, everything / 10)
+
+    def test_top_k(self):
+        """Test if equal scores are ordered by document id."""
+        doc_ids = np.array([1, 3, 5, 7, 9])
+        scores = np.array([1.0, 2.0, 1.0, 0.5, 1.0])
+        self.assertEqual(top_k(doc_ids, scores, 3), [(3, 2.0), (1, 1.0), (5, 1.0)])
+        self.assertEqual(top_k(doc_ids, scores, 10)[-1], (7, 0.5))
+
+
+if __name__ == "__main__":
+    unittest.main()
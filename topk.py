@@ -0,0 +1,154 @@
+"""Top-k search that stops before reading whole posting lists.
+
+A document scores its PageRank once for every query word it contains, see
+ShardedIndex.search. Reading the posting lists in document id order, every
+posting of every query word has to be read before the best k documents are
+known. Published snapshots therefore also get impact-ordered posting lists:
+each word's documents sorted by descending PageRank, in blocks of
+IMPACT_BLOCK documents, in the ImpactPostings table.
+
+search_impact reads those lists a few blocks at a time, twice as many
+every round. Everything in a list past the blocks read so far ranks no
+higher than the last document read, which bounds both the score a document
+could still gain from the list and the score of documents not seen at all.
+Once the k-th best score known for sure beats every such bound, the rest of
+the lists cannot change the top k and are never read. On common words most
+of every list is skipped.
+
+The order only holds for the PageRank scores the lists were built with, so
+they are only built on snapshots, which never change, see snapshots.py."""
+import numpy as np
+from postings import pack, unpack, iter_postings
+
+IMPACT_BLOCK = 128
+
+# most distinct words a query can have for search_impact, one bit each
+MAX_TERMS = 62
+
+
+def doc_ranks(ranks, doc_ids):
+    """The PageRank of each of `doc_ids`, from the array load_page_ranks
+    returns, 0 for documents that have none."""
+    found = np.zeros(len(doc_ids))
+    ranked = doc_ids < len(ranks)
+    found[ranked] = ranks[doc_ids[ranked]]
+    return found
+
+
+def top_k(doc_ids, scores, k):
+    """The `k` best of the sorted `doc_ids` by `scores`, as (doc_id, score)
+    pairs with the best first. Equal scores are ordered by document id, so
+    every shard layout and search strategy gives the same results."""
+    top = np.arange(len(scores))
+    if len(scores) > k:
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        better = np.flatnonzero(scores > kth)
+        top = np.concatenate([better, np.flatnonzero(scores == kth)[:k - len(better)]])
+    top = top[np.lexsort((doc_ids[top], -scores[top]))]
+    return list(zip(doc_ids[top].tolist(), scores[top].tolist()))
+
+
+def create_impact_table(cur, schema="main"):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS %s.ImpactPostings (
+        word_id INTEGER,
+        block INTEGER,
+        doc_ids BLOB,
+        PRIMARY KEY (word_id, block)
+    ) WITHOUT ROWID;
+    """ % schema)
+
+
+def has_impact_postings(db_conn, schema="main"):
+    cur = db_conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM %s.sqlite_master WHERE name = 'ImpactPostings'" % schema)
+    return cur.fetchone()[0] > 0
+
+
+def build_impact_postings(db_conn, ranks, schema="main", block_size=IMPACT_BLOCK):
+    """Write the impact-ordered posting list of every word under `schema`
+    for the PageRank scores `ranks`, replacing any there were. Documents
+    with the same score are ordered by id. Does not commit."""
+    cur = db_conn.cursor()
+    create_impact_table(cur, schema)
+    cur.execute("DELETE FROM %s.ImpactPostings" % schema)
+    rows = []
+    for word_id, (doc_ids, _, _) in iter_postings(db_conn, schema):
+        ordered = doc_ids[np.lexsort((doc_ids, -doc_ranks(ranks, doc_ids)))]
+        rows.extend((word_id, block, pack(ordered[start:start + block_size]))
+                    for block, start in enumerate(range(0, len(ordered), block_size)))
+        if len(rows) >= 1000:
+            cur.executemany("INSERT INTO %s.ImpactPostings (word_id, block, doc_ids) VALUES (?, ?, ?)" % schema,
+                            rows)
+            rows = []
+    cur.executemany("INSERT INTO %s.ImpactPostings (word_id, block, doc_ids) VALUES (?, ?, ?)" % schema, rows)
+
+
+def search_impact(db_conn, word_ids, k, ranks, schema="main"):
+    """What search_shard returns, read from the impact-ordered posting lists
+    and stopping as soon as the top `k` are certain. The number of matching
+    documents is then only a lower bound. Also returns how many postings
+    were read."""
+    terms, weights = np.unique(np.asarray(word_ids, dtype=np.int64), return_counts=True)
+    cur = db_conn.cursor()
+
+    # the documents seen so far, with a bit set for every list they were in
+    ids = np.zeros(0, dtype=np.int64)
+    seen = np.zeros(0, dtype=np.int64)
+    # the rest of every list ranks at most this high
+    bounds = np.full(len(terms), np.inf)
+    exhausted = np.zeros(len(terms), dtype=bool)
+    next_block = 0
+    # no list can settle the top k before k documents were read from it
+    step = -(-k // IMPACT_BLOCK)
+    read = 0
+    while not exhausted.all():
+        found_ids = [ids]
+        found_bits = [seen]
+        for t in np.flatnonzero(~exhausted):
+            cur.execute("SELECT doc_ids FROM %s.ImpactPostings WHERE word_id = ? AND block >= ? AND block < ? "
+                        "ORDER BY block" % schema, (int(terms[t]), next_block, next_block + step))
+            blobs = [blob for (blob,) in cur.fetchall()]
+            exhausted[t] = len(blobs) < step
+            if blobs:
+                found = unpack(b"".join(blobs))
+                bounds[t] = doc_ranks(ranks, found[-1:])[0]
+                found_ids.append(found)
+                found_bits.append(np.full(len(found), 1 << int(t), dtype=np.int64))
+                read += len(found)
+        next_block += step
+        step *= 2
+        bounds[exhausted] = -np.inf
+
+        ids, inverse = np.unique(np.concatenate(found_ids), return_inverse=True)
+        seen = np.zeros(len(ids), dtype=np.int64)
+        np.bitwise_or.at(seen, inverse, np.concatenate(found_bits))
+        if len(ids) < k:
+            continue
+
+        # what every document scores for sure, and could score at most
+        in_list = (seen[:, None] >> np.arange(len(terms))) & 1 == 1
+        scores = doc_ranks(ranks, ids)
+        known = in_list.astype(np.int64) @ weights
+        possible = (~in_list & (scores[:, None] <= bounds)).astype(np.int64) @ weights
+        lower = scores * known
+        upper = scores * (known + possible)
+
+        # a document not seen yet ranks no higher than the bound of every
+        # list it could be in
+        order = np.argsort(-bounds)
+        unseen = np.max(np.where(np.isfinite(bounds[order]), bounds[order] * np.cumsum(weights[order]), -np.inf))
+        kth = np.partition(lower, len(lower) - k)[len(lower) - k]
+        contenders = upper >= kth
+        if unseen < kth and (lower[contenders] == upper[contenders]).all():
+            break
+
+    in_list = (seen[:, None] >> np.arange(len(terms))) & 1 == 1
+    scores = doc_ranks(ranks, ids) * (in_list.astype(np.int64) @ weights)
+    total = len(ids)
+    if not exhausted.all():
+        # at least every document of the longest list matches
+        cur.execute("SELECT MAX(doc_count) FROM %s.Postings WHERE word_id IN (%s)" %
+                    (schema, ",".join("?" * len(terms))), terms.tolist())
+        total = max(total, cur.fetchone()[0] or 0)
+    return total, top_k(ids, scores, k), read